@@ -1,8 +1,58 @@
-import matplotlib
-import pandas as pd
-import numpy as np
-import matplotlib.pyplot as plt
-
-from .trade import *
-from .statistics import *
-#from .positions import *
+import importlib
+import sys
+import types
+
+########################################################################
+#### Lazy package
+#### Submodules, the names they used to star-export (trade, statistics)
+#### and the pd/np/matplotlib/plt aliases are imported on first access,
+#### so ``from portfolio.trade import Position`` loads neither
+#### matplotlib nor the statistics module.
+####
+#### Usage:
+#### import portfolio
+#### portfolio.Position / portfolio.Statistics / portfolio.sweep
+########################################################################
+
+SUBMODULES = (
+    'backtest', 'benchmarks', 'instrument', 'live', 'online', 'positions', 'records', 'replay',
+    'report', 'resample', 'signals', 'spill', 'statistics', 'storage', 'sweep', 'trade',
+)
+# Later modules shadow earlier ones, as the star imports did
+EXPORTS = ('statistics', 'trade')
+ALIASES = {'pd': 'pandas', 'np': 'numpy', 'matplotlib': 'matplotlib', 'plt': 'matplotlib.pyplot'}
+
+
+def __getattr__(name):
+    if name in SUBMODULES:
+        value = importlib.import_module('.' + name, __name__)
+    elif name in ALIASES:
+        value = importlib.import_module(ALIASES[name])
+    elif name.startswith('_'):
+        raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    else:
+        for module in EXPORTS:
+            module = importlib.import_module('.' + module, __name__)
+            if hasattr(module, name):
+                value = getattr(module, name)
+                break
+        else:
+            raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(SUBMODULES) | set(ALIASES))
+
+
+if sys.version_info < (3, 7):
+    # Module __getattr__ (PEP 562) is only looked up from 3.7
+    class _LazyModule(types.ModuleType):
+        def __getattr__(self, name):
+            return __getattr__(name)
+
+        def __dir__(self):
+            return __dir__()
+
+    sys.modules[__name__].__class__ = _LazyModule
@@ -0,0 +1,238 @@
+''' Benchmarks of the trade and statistics hot paths
+
+Run from the directory containing the portfolio package:
+
+    python -m portfolio.benchmarks.bench --bars 1000 100000 --symbols 1 10 --trade-every 10 1000
+    python -m portfolio.benchmarks.bench --save-baseline portfolio/benchmarks/baseline.json
+    python -m portfolio.benchmarks.bench --baseline portfolio/benchmarks/baseline.json
+
+Every operation is timed (best of ``--repeat`` runs, repeated until the runs
+add up to ``--min-time``) and then run once more under tracemalloc to record
+the peak memory (peak traced bytes above those traced when the run starts)
+and the number of memory blocks still allocated afterwards (retained_blocks,
+the block-count delta of tracemalloc snapshots taken around the run).
+retained_blocks_per_call divides that delta by the calls of the operation
+(bars x symbols for per-bar operations). It is not an allocation count:
+temporaries freed within the run are not counted, so it tracks memory kept
+per call (e.g. log rows), and the peak is what catches allocation churn. With
+``--baseline`` any operation slower than the baseline by more than
+``--tolerance``, or whose peak memory or retained blocks per call grew by
+more than ``--memory-tolerance``, is reported and the exit status is 1.
+Operations faster than ``--min-time`` are too noisy to compare on time.
+'''
+from collections import OrderedDict
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from portfolio.trade import Position
+from portfolio.backtest import backtest
+from portfolio.statistics import Statistics
+
+########################################################################
+#### Synthetic data
+########################################################################
+
+def random_walk(bars, symbols, seed=0, start=100.0, volatility=0.01):
+    ''' Geometric random walk prices, one column per symbol '''
+    rng = np.random.RandomState(seed)
+    return start * np.exp(np.cumsum(rng.normal(0, volatility, (bars, symbols)), axis=0))
+
+def exposure_flips(bars, symbols, trade_every, seed=0, levels=(-1, -0.5, 0, 0.5, 1)):
+    ''' Target exposures holding a random level for ``trade_every`` bars '''
+    rng = np.random.RandomState(seed + 1)
+    periods = -(-bars // trade_every)
+    return np.repeat(rng.choice(levels, (periods, symbols)), trade_every, axis=0)[:bars]
+
+def bar_timestamps(bars, start='2000-01-01'):
+    ''' Daily, hourly or minute bars so that any size spans several months within pandas limits '''
+    freq = 'D' if bars <= 10 ** 4 else 'H' if bars <= 10 ** 5 else 'T'
+    return pd.date_range(start, periods=bars, freq=freq)
+
+def make_case(bars, symbols, trade_every, seed=0):
+    return SimpleNamespace(
+        bars=bars,
+        symbols=['S{}'.format(i) for i in range(symbols)],
+        timestamps=bar_timestamps(bars),
+        prices=random_walk(bars, symbols, seed),
+        exposures=exposure_flips(bars, symbols, trade_every, seed),
+    )
+
+def run_backtests(case):
+    positions = OrderedDict()
+    for i, symbol in enumerate(case.symbols):
+        positions[symbol] = Position(fund=10000.0 / len(case.symbols))
+        backtest(positions[symbol], case.timestamps, case.prices[:, i], case.exposures[:, i])
+    return positions
+
+def make_statistics(case):
+    config = SimpleNamespace(fund=10000.0, start_time=case.timestamps[0], end_time=case.timestamps[-1])
+    return Statistics(config, run_backtests(case))
+
+########################################################################
+#### Operations
+#### name -> (setup(case), run(state), calls per run, per-bar operation)
+########################################################################
+
+def _allocate(state):
+    case, positions = state
+    timestamps = list(case.timestamps)
+    for i, symbol in enumerate(case.symbols):
+        position = positions[symbol]
+        prices = case.prices[:, i].tolist()
+        exposures = case.exposures[:, i].tolist()
+        for j in range(case.bars):
+            position.allocate(exposures[j], prices[j], timestamp=timestamps[j])
+
+def _end_date(state):
+    case, positions = state
+    timestamps = list(case.timestamps)
+    for i, symbol in enumerate(case.symbols):
+        position = positions[symbol]
+        prices = case.prices[:, i].tolist()
+        for j in range(case.bars):
+            position.end_date(timestamps[j], prices[j])
+
+def _fresh_positions(case):
+    return case, {symbol: Position(fund=10000.0 / len(case.symbols)) for symbol in case.symbols}
+
+def _calculated_statistics(case):
+    stat = make_statistics(case)
+    stat.calculate()
+    return stat
+
+OPERATIONS = OrderedDict([
+    ('Position.allocate', (_fresh_positions, _allocate, lambda case: case.bars * len(case.symbols), True)),
+    ('Position.end_date', (_fresh_positions, _end_date, lambda case: case.bars * len(case.symbols), True)),
+    ('backtest', (lambda case: case, run_backtests, lambda case: len(case.symbols), False)),
+    ('Statistics.calculate', (make_statistics, lambda stat: stat.calculate(), lambda case: 1, False)),
+    ('Statistics.monthly_return', (_calculated_statistics, lambda stat: stat.monthly_return(), lambda case: 1, False)),
+    ('Statistics.trade_summary', (_calculated_statistics, lambda stat: stat.trade_summary(), lambda case: 1, False)),
+])
+
+########################################################################
+#### Runner
+########################################################################
+
+def measure(setup, run, case, repeat, min_time=0.0, max_repeat=1000):
+    ''' Best time of at least ``repeat`` runs (more until they add up to ``min_time``),
+    then the peak traced memory and the blocks still allocated after one more run
+    '''
+    times = []
+    while len(times) < repeat or (sum(times) < min_time and len(times) < max_repeat):
+        state = setup(case)
+        gc.collect()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    state = setup(case)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    start, _ = tracemalloc.get_traced_memory()
+    run(state)
+    current, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    retained_blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename'))
+    return min(times), peak - start, retained_blocks
+
+def case_name(bars, symbols, trade_every):
+    return 'bars={} symbols={} trade_every={}'.format(bars, symbols, trade_every)
+
+def run_benchmarks(bars, symbols, trade_every, repeat=3, per_bar_limit=10 ** 5, operations=None, out=sys.stdout,
+                   min_time=0.0):
+    results = OrderedDict()
+    for n in bars:
+        for s in symbols:
+            for k in trade_every:
+                case = make_case(n, s, k)
+                name = case_name(n, s, k)
+                results[name] = OrderedDict()
+                for op, (setup, run, calls, per_bar) in OPERATIONS.items():
+                    if operations and op not in operations:
+                        continue
+                    if per_bar and n * s > per_bar_limit:
+                        continue
+                    seconds, peak, retained_blocks = measure(setup, run, case, repeat, min_time)
+                    results[name][op] = OrderedDict([
+                        ('time', seconds),
+                        ('time_per_call', seconds / calls(case)),
+                        ('peak_memory', peak),
+                        ('retained_blocks', retained_blocks),
+                        ('retained_blocks_per_call', retained_blocks / calls(case)),
+                    ])
+                    out.write('{:45s} {:28s} {:10.4f}s {:10.2f}us/call {:8.1f}MB peak {:9d} blocks retained '
+                              '{:10.2f} retained/call\n'.format(
+                                  name, op, seconds, seconds / calls(case) * 1e6, peak / 2 ** 20, retained_blocks,
+                                  retained_blocks / calls(case)))
+    return results
+
+def compare(results, baseline, tolerance, min_time=0.05, memory_tolerance=0.25, min_memory=2 ** 20,
+            min_retained_blocks=1.0):
+    ''' Returns (case, operation, metric, baseline, result) of every operation slower, using more
+    peak memory or retaining more blocks per call than tolerated. Times both under ``min_time``
+    seconds, memory differences under ``min_memory`` bytes and retained block differences under
+    ``min_retained_blocks`` per call are noise and never flagged.
+    '''
+    regressions = []
+    for name, operations in results.items():
+        for op, result in operations.items():
+            reference = baseline.get(name, {}).get(op)
+            if not reference:
+                continue
+            if (max(result['time'], reference['time']) >= min_time
+                    and result['time'] > reference['time'] * (1 + tolerance)):
+                regressions.append((name, op, 'time', reference['time'], result['time']))
+            if (result['peak_memory'] - reference['peak_memory'] >= min_memory
+                    and result['peak_memory'] > reference['peak_memory'] * (1 + memory_tolerance)):
+                regressions.append((name, op, 'peak_memory', reference['peak_memory'], result['peak_memory']))
+            if 'retained_blocks_per_call' in reference and (
+                    result['retained_blocks_per_call'] - reference['retained_blocks_per_call'] >= min_retained_blocks
+                    and result['retained_blocks_per_call'] > reference['retained_blocks_per_call'] * (1 + memory_tolerance)):
+                regressions.append((name, op, 'retained_blocks_per_call', reference['retained_blocks_per_call'],
+                                    result['retained_blocks_per_call']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--bars', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--symbols', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--trade-every', type=int, nargs='+', default=[10, 1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--per-bar-limit', type=int, default=10 ** 5,
+                        help='skip per-bar operations above this many bars x symbols')
+    parser.add_argument('--operations', nargs='+', choices=list(OPERATIONS))
+    parser.add_argument('--baseline', help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown before flagging')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='allowed peak memory and retained blocks per call growth before flagging')
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help='repeat each operation until its runs add up to this many seconds, '
+                             'faster operations are not compared')
+    parser.add_argument('--save-baseline', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.bars, args.symbols, args.trade_every, args.repeat,
+                             args.per_bar_limit, args.operations, min_time=args.min_time)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.min_time, args.memory_tolerance)
+        for name, op, metric, reference, value in regressions:
+            print('REGRESSION {} {} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(name, op, metric, reference, value, value / reference - 1))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
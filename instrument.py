@@ -0,0 +1,247 @@
+''' This instrument module times the hot paths of trading and statistics on demand
+
+'''
+from collections import OrderedDict
+import cProfile
+import io
+import json
+import pstats
+import random
+import time
+import tracemalloc
+import numpy as np
+
+from . import backtest, signals, sweep
+from .records import ColumnLog
+from .spill import HDF5Log
+from .trade import Position, Inventory, LOG_SCHEMAS
+from .statistics import Statistics
+
+import structlog
+logger = structlog.getLogger()
+
+########################################################################
+#### Instrumentation
+#### Nothing is wrapped until start(): the operations in TARGETS are
+#### replaced on their classes by timing wrappers and restored by stop(),
+#### so disabled instrumentation costs nothing. Subclass overrides (e.g.
+#### HDF5Log.to_frame) are targets of their own, functions are replaced
+#### in their module and in the modules that imported them by name
+#### (sweep worker processes are not instrumented). Latencies are inclusive
+#### (allocate includes the long/close it calls) and kept in a reservoir
+#### of ``max_samples`` per operation for the percentiles. Position
+#### operations also count the rows they add to every log, per position.
+#### cProfile and tracemalloc are optional and cover start() to stop().
+####
+#### Usage:
+#### with Instrumentation(portfolio.positions, profile=True, memory=True) as inst:
+####     backtest(...)
+#### inst.track(positions)               (names positions created inside the run)
+#### inst.snapshot() / inst.json()
+#### inst.log()                           (one structlog event)
+########################################################################
+
+TARGETS = [
+    ('Position.allocate', Position, 'allocate'),
+    ('Position.long', Position, 'long'),
+    ('Position.short', Position, 'short'),
+    ('Position.close', Position, 'close'),
+    ('Position.cover', Position, 'cover'),
+    ('Position.end_date', Position, 'end_date'),
+    ('Position.get_balance_log', Position, 'get_balance_log'),
+    ('Position.get_trade_profit', Position, 'get_trade_profit'),
+    ('Position.get_balance_series', Position, 'get_balance_series'),
+    ('Inventory._entry', Inventory, '_entry'),
+    ('Inventory._exit', Inventory, '_exit'),
+    ('ColumnLog.to_frame', ColumnLog, 'to_frame'),
+    ('HDF5Log.to_frame', HDF5Log, 'to_frame'),
+    ('backtest', backtest, 'backtest'),
+    ('backtest', signals, 'backtest'),
+    ('backtest', sweep, 'backtest'),
+    ('Statistics.calculate', Statistics, 'calculate'),
+    ('Statistics.nav_summary', Statistics, 'nav_summary'),
+    ('Statistics.trade_summary', Statistics, 'trade_summary'),
+]
+
+PERCENTILES = (50, 90, 99)
+
+
+class OperationStats(object):
+    ''' Call count, total and sampled latencies (seconds) of one operation '''
+    __slots__ = ('count', 'total', 'samples', 'max_samples', 'rng')
+
+    def __init__(self, max_samples, rng):
+        self.count = 0
+        self.total = 0.0
+        self.samples = []
+        self.max_samples = max_samples
+        self.rng = rng
+
+    def add(self, seconds:float):
+        self.count += 1
+        self.total += seconds
+        if len(self.samples) < self.max_samples:
+            self.samples.append(seconds)
+        else:
+            # Reservoir sampling keeps a uniform sample of every call
+            i = self.rng.randrange(self.count)
+            if i < self.max_samples:
+                self.samples[i] = seconds
+
+    def dict(self, percentiles=PERCENTILES):
+        result = OrderedDict([('count', self.count), ('total', self.total),
+                              ('mean', self.total / self.count if self.count else float('nan'))])
+        values = np.percentile(self.samples, percentiles) if self.samples else [float('nan')] * len(percentiles)
+        for p, value in zip(percentiles, values):
+            result['p{}'.format(p)] = float(value)
+        return result
+
+
+class Instrumentation(object):
+    '''
+    Args:
+        positions (dict): {name: Position} used to name positions, others are named by id
+        targets (list): (name, class, method) of the wrapped operations
+        profile (bool): run cProfile between start() and stop()
+        memory (bool): trace allocations with tracemalloc between start() and stop()
+        max_samples (int): latencies kept per operation for the percentiles
+    '''
+    _active = None
+
+    def __init__(self, positions=None, targets=TARGETS, profile=False, memory=False, max_samples=10000, seed=0):
+        self.names = {id(position): name for name, position in (positions or {}).items()}
+        self.targets = list(targets)
+        self.profile = profile
+        self.memory = memory
+        self.max_samples = max_samples
+        self.rng = random.Random(seed)
+        self.operations = OrderedDict()
+        self.rows = OrderedDict()
+        self.wall = 0.0
+        self.profiler = None
+        self.memory_stats = None
+        self._originals = []
+        self._started = None
+        self._tracing = False
+
+    def track(self, positions):
+        ''' Names the positions of ``positions`` ({name: Position}) created after __init__ '''
+        self.names.update((id(position), name) for name, position in positions.items())
+
+    def position_name(self, key):
+        ''' Name of the position with id ``key`` '''
+        return self.names.get(key) or 'position-{:x}'.format(key)
+
+    def _wrap(self, name, method, is_position):
+        stats = self.operations.setdefault(name, OperationStats(self.max_samples, self.rng))
+        perf_counter = time.perf_counter
+
+        if not is_position:
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    stats.add(perf_counter() - start)
+        else:
+            def wrapper(position, *args, **kwargs):
+                before = position.log_version()
+                start = perf_counter()
+                try:
+                    return method(position, *args, **kwargs)
+                finally:
+                    stats.add(perf_counter() - start)
+                    after = position.log_version()
+                    if after != before:
+                        counts = self.rows.setdefault(id(position), OrderedDict()).setdefault(name, [0] * len(after))
+                        for i, (old, new) in enumerate(zip(before, after)):
+                            counts[i] += new - old
+        wrapper.__wrapped__ = method
+        wrapper.__name__ = method.__name__
+        wrapper.__doc__ = method.__doc__
+        return wrapper
+
+    def start(self):
+        if Instrumentation._active is not None:
+            raise RuntimeError('another Instrumentation is running')
+        Instrumentation._active = self
+        for name, cls, attribute in self.targets:
+            method = cls.__dict__[attribute]
+            self._originals.append((cls, attribute, method))
+            is_position = isinstance(cls, type) and issubclass(cls, Position)
+            setattr(cls, attribute, self._wrap(name, method, is_position))
+        if self.memory:
+            # Only stop tracing in stop() if it was started here
+            self._tracing = not tracemalloc.is_tracing()
+            if self._tracing:
+                tracemalloc.start()
+        if self.profile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self._started = time.perf_counter()
+        return self
+
+    def stop(self):
+        if Instrumentation._active is not self:
+            return self
+        self.wall += time.perf_counter() - self._started
+        if self.profiler is not None:
+            self.profiler.disable()
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            if self._tracing:
+                tracemalloc.stop()
+            self.memory_stats = OrderedDict([
+                ('current', current),
+                ('peak', peak),
+                ('top', [OrderedDict([('location', str(stat.traceback)), ('size', stat.size), ('count', stat.count)])
+                         for stat in top]),
+            ])
+        for cls, attribute, method in reversed(self._originals):
+            setattr(cls, attribute, method)
+        self._originals = []
+        self._started = None
+        Instrumentation._active = None
+        return self
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def profile_stats(self, limit=20, sort='cumulative'):
+        ''' Top ``limit`` functions of the cProfile run as dicts '''
+        if self.profiler is None:
+            return []
+        stats = pstats.Stats(self.profiler, stream=io.StringIO()).sort_stats(sort)
+        rows = []
+        for (filename, line, function) in stats.fcn_list[:limit]:
+            calls, primitive, tottime, cumtime, callers = stats.stats[(filename, line, function)]
+            rows.append(OrderedDict([('function', '{}:{}({})'.format(filename, line, function)),
+                                     ('calls', calls), ('tottime', tottime), ('cumtime', cumtime)]))
+        return rows
+
+    def snapshot(self, percentiles=PERCENTILES):
+        ''' Operation latencies, log rows added per position and operation, and the profiles '''
+        result = OrderedDict([
+            ('wall', self.wall if self._started is None else self.wall + time.perf_counter() - self._started),
+            ('operations', OrderedDict((name, stats.dict(percentiles))
+                                       for name, stats in self.operations.items() if stats.count)),
+            ('rows', OrderedDict((self.position_name(position), OrderedDict((name, dict(zip(LOG_SCHEMAS, counts)))
+                                                        for name, counts in operations.items()))
+                                 for position, operations in self.rows.items())),
+        ])
+        if self.profiler is not None:
+            result['profile'] = self.profile_stats()
+        if self.memory_stats is not None:
+            result['memory'] = self.memory_stats
+        return result
+
+    def json(self, **kwargs):
+        return json.dumps(self.snapshot(), default=str, **kwargs)
+
+    def log(self, event="instrumentation", **kwargs):
+        ''' Sends the snapshot to the structlog logger as one event '''
+        logger.info(event, **dict(self.snapshot(), **kwargs))
@@ -0,0 +1,250 @@
+''' This live module drives a Portfolio from concurrent per-symbol price feeds
+
+'''
+import asyncio
+import math
+import time
+import numpy as np
+import pandas as pd
+
+from .storage import DeltaStore, DatastoreBackend
+
+import structlog
+logger = structlog.getLogger()
+
+########################################################################
+#### LiveTrader
+#### One asyncio task per symbol consumes that symbol's price queue, so a
+#### slow symbol never delays the others. Bursts are coalesced to the
+#### latest price before the strategy runs. Portfolio.end_date snapshots
+#### and saves run on their own cadence. Saves go through a DeltaStore
+#### (by default in the Datastore under the portfolio's datastore_key):
+#### the small position fields and the log rows added since the previous
+#### save are copied on the event loop (DeltaStore.prepare) and written
+#### in the executor (DeltaStore.write), so no copy of the log history is
+#### kept. Saves never overlap: a save keeps running when the task
+#### awaiting it is cancelled, and no other save starts until it is done.
+####
+#### ``strategy(symbol, timestamp, price, position)`` returns the target
+#### exposure or None to hold, it may be a coroutine function.
+####
+#### Usage:
+#### trader = LiveTrader(portfolio, strategy, snapshot_interval=60, save_interval=300)
+#### trader = LiveTrader(portfolio, strategy, save_interval=300, store=DeltaStore(SQLiteBackend(path), 'live'))
+#### feed = SimulatedFeed(portfolio.symbols, interval=0.01, bars=1000)
+#### loop.run_until_complete(trader.run(feed))
+#### trader.metrics.dict()
+########################################################################
+
+
+class LatencyStats(object):
+    ''' Count, mean and max of latencies in seconds '''
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds:float):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def dict(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else math.nan, 'max': self.max}
+
+
+class LoopMetrics(object):
+    '''
+    Attributes:
+        ticks (dict): prices received per symbol
+        coalesced (dict): prices skipped per symbol because a newer one was queued
+        queue_depth (dict): current queue length per symbol
+        max_queue_depth (dict): largest queue length seen per symbol
+        latency (dict): LatencyStats from receiving a price to applying its allocation, per symbol
+        snapshot_latency (LatencyStats): Portfolio.end_date durations
+        save_latency (LatencyStats): save durations
+    '''
+    def __init__(self, symbols):
+        self.ticks = {symbol: 0 for symbol in symbols}
+        self.coalesced = {symbol: 0 for symbol in symbols}
+        self.queue_depth = {symbol: 0 for symbol in symbols}
+        self.max_queue_depth = {symbol: 0 for symbol in symbols}
+        self.latency = {symbol: LatencyStats() for symbol in symbols}
+        self.snapshot_latency = LatencyStats()
+        self.save_latency = LatencyStats()
+
+    def dict(self):
+        return {
+            'ticks': dict(self.ticks),
+            'coalesced': dict(self.coalesced),
+            'queue_depth': dict(self.queue_depth),
+            'max_queue_depth': dict(self.max_queue_depth),
+            'latency': {symbol: stats.dict() for symbol, stats in self.latency.items()},
+            'snapshot_latency': self.snapshot_latency.dict(),
+            'save_latency': self.save_latency.dict(),
+        }
+
+
+class LiveTrader(object):
+    def __init__(self, portfolio, strategy, snapshot_interval=60, save_interval=None, store=None, executor=None):
+        self.portfolio = portfolio
+        self.strategy = strategy
+        self.snapshot_interval = snapshot_interval
+        self.save_interval = save_interval
+        self.store = store
+        self.executor = executor
+        self.queues = {}
+        self.prices = {}
+        self.timestamp = None
+        self.metrics = LoopMetrics(portfolio.symbols)
+        self._saving = None
+        self._stopped = None
+
+    def feed(self, symbol, timestamp, price):
+        ''' Queues a price, never blocks '''
+        queue = self.queues[symbol]
+        queue.put_nowait((timestamp, price, time.perf_counter()))
+        self.metrics.ticks[symbol] += 1
+        depth = queue.qsize()
+        self.metrics.queue_depth[symbol] = depth
+        if depth > self.metrics.max_queue_depth[symbol]:
+            self.metrics.max_queue_depth[symbol] = depth
+
+    async def _consume(self, symbol):
+        queue = self.queues[symbol]
+        position = self.portfolio.positions[symbol]
+        while True:
+            timestamp, price, received = await queue.get()
+            taken = 1
+            while not queue.empty():
+                timestamp, price, received = queue.get_nowait()
+                taken += 1
+            self.metrics.coalesced[symbol] += taken - 1
+            self.metrics.queue_depth[symbol] = 0
+            try:
+                exposure = self.strategy(symbol, timestamp, price, position)
+                if asyncio.iscoroutine(exposure):
+                    exposure = await exposure
+                if exposure is not None:
+                    position.allocate(exposure, price, timestamp=timestamp)
+            except Exception:
+                # One bad price or strategy error must not stop the symbol's feed
+                logger.exception("live_error", symbol=symbol, timestamp=timestamp, price=price)
+            self.prices[symbol] = price
+            if self.timestamp is None or timestamp > self.timestamp:
+                self.timestamp = timestamp
+            self.metrics.latency[symbol].add(time.perf_counter() - received)
+            for _ in range(taken):
+                queue.task_done()
+
+    def snapshot(self):
+        ''' Portfolio.end_date at the latest prices, once every symbol has a price '''
+        if len(self.prices) < len(self.portfolio.symbols):
+            return None
+        start = time.perf_counter()
+        nav = self.portfolio.end_date(self.timestamp, self.prices)
+        self.metrics.snapshot_latency.add(time.perf_counter() - start)
+        return nav
+
+    def default_store(self):
+        ''' DeltaStore in the Datastore of the portfolio, keyed by its datastore_key '''
+        return DeltaStore(DatastoreBackend(self.portfolio.client), '{}/{}'.format(*self.portfolio.datastore_key))
+
+    async def flush(self):
+        ''' Saves the portfolio without blocking the loop, skipped while a save is running '''
+        if self._saving is not None and not self._saving.done():
+            return None
+        if self.store is None:
+            self.store = self.default_store()
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        self._saving = loop.run_in_executor(self.executor, self.store.write, self.store.prepare(self.portfolio))
+        try:
+            # Cancelling this flush leaves the write (and _saving) running
+            return await asyncio.shield(self._saving)
+        finally:
+            self.metrics.save_latency.add(time.perf_counter() - start)
+
+    async def _every(self, interval, action):
+        while True:
+            await asyncio.sleep(interval)
+            result = action()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def run(self, feed=None, duration=None):
+        ''' Runs until ``feed`` is exhausted, ``duration`` seconds have passed or stop() is called '''
+        self.queues = {symbol: asyncio.Queue() for symbol in self.portfolio.symbols}
+        self._stopped = asyncio.Event()
+        tasks = [asyncio.ensure_future(self._consume(symbol)) for symbol in self.portfolio.symbols]
+        if self.snapshot_interval:
+            tasks.append(asyncio.ensure_future(self._every(self.snapshot_interval, self.snapshot)))
+        if self.save_interval:
+            tasks.append(asyncio.ensure_future(self._every(self.save_interval, self.flush)))
+        waits = [asyncio.ensure_future(self._stopped.wait())]
+        if feed is not None:
+            waits.append(asyncio.ensure_future(feed.run(self)))
+        if duration is not None:
+            waits.append(asyncio.ensure_future(asyncio.sleep(duration)))
+        try:
+            done, pending = await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+            # Let the consumers drain what the feed queued
+            await asyncio.gather(*(queue.join() for queue in self.queues.values()))
+        finally:
+            for task in tasks + waits:
+                task.cancel()
+            await asyncio.gather(*(tasks + waits), return_exceptions=True)
+            if self._saving is not None:
+                # A periodic save cancelled above is still writing
+                await asyncio.gather(self._saving, return_exceptions=True)
+        self.snapshot()
+        if self.save_interval:
+            await self.flush()
+        logger.info("live", **self.metrics.dict())
+        return self.metrics
+
+########################################################################
+#### SimulatedFeed
+#### Random-walk prices for local runs: every symbol ticks on its own
+#### schedule, in bursts of ``burst`` prices, with ``delays`` to make some
+#### symbols slower than others.
+####
+#### Usage:
+#### feed = SimulatedFeed(['BTCUSD', 'ETHUSD'], interval=0.01, bars=1000, delays={'ETHUSD': 0.05})
+########################################################################
+
+
+class SimulatedFeed(object):
+    def __init__(self, symbols, interval=0.01, bars=1000, burst=1, delays=None, prices=None,
+                 start='2020-01-01', freq='T', seed=0):
+        self.symbols = list(symbols)
+        self.interval = interval
+        self.bars = bars
+        self.burst = burst
+        self.delays = delays or {}
+        self.timestamps = pd.date_range(start, periods=bars, freq=freq)
+        if prices is None:
+            rng = np.random.RandomState(seed)
+            walks = 100 * np.exp(np.cumsum(rng.normal(0, 0.01, (bars, len(self.symbols))), axis=0))
+            prices = {symbol: walks[:, i] for i, symbol in enumerate(self.symbols)}
+        self.prices = {symbol: np.asarray(prices[symbol], dtype=float) for symbol in self.symbols}
+
+    async def _run_symbol(self, trader, symbol):
+        prices = self.prices[symbol].tolist()
+        delay = self.interval + self.delays.get(symbol, 0)
+        for i in range(0, self.bars, self.burst):
+            for j in range(i, min(i + self.burst, self.bars)):
+                trader.feed(symbol, self.timestamps[j], prices[j])
+            await asyncio.sleep(delay)
+
+    async def run(self, trader):
+        await asyncio.gather(*(self._run_symbol(trader, symbol) for symbol in self.symbols))
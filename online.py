@@ -0,0 +1,135 @@
+''' This online module keeps portfolio metrics up to date bar by bar
+
+'''
+import numpy as np
+import math
+
+########################################################################
+#### OnlineMetrics
+#### Running equivalents of statistics.max_drawdown, annualized_return
+#### and sharpe_ratio, updated in O(1) per bar. Returns mean and variance
+#### are tracked with Welford's algorithm (Chan's update for batches).
+#### State is kept in plain slots since update runs on every end_date,
+#### it is not a pydantic model: it serializes with the position through
+#### dict() and is rebuilt with OnlineMetrics(**state).
+#### Divisions by zero (a zero nav, a flat nav without variance) give
+#### inf/nan like the NumPy batch versions instead of raising. NaN navs
+#### and NaN drawdowns (0 / 0 from a zero peak) never lower the peak or
+#### raise the maximum drawdown, in update and extend alike.
+####
+#### Usage:
+#### metrics = OnlineMetrics()
+#### metrics.update(nav)
+#### metrics.extend(navs)
+#### metrics.max_drawdown()
+#### metrics.annualized_return()
+#### metrics.sharpe_ratio()
+########################################################################
+
+
+def ratio(a, b):
+    ''' a / b with NumPy's inf/nan for b == 0 '''
+    if b == 0:
+        return math.nan if a == 0 or math.isnan(a) else math.copysign(math.inf, a) * math.copysign(1, b)
+    return a / b
+
+
+class OnlineMetrics(object):
+    '''
+    Attributes:
+        count (int): number of values seen
+        first (float): first value
+        last (float): latest value
+        peak (float): running maximum
+        max_dd (float): maximum drawdown so far
+        returns (int): number of bar-to-bar returns seen
+        mean (float): mean of the returns
+        m2 (float): sum of squared deviations of the returns
+    '''
+    __slots__ = ('count', 'first', 'last', 'peak', 'max_dd', 'returns', 'mean', 'm2')
+
+    def __init__(self, count=0, first=0, last=0, peak=0, max_dd=0, returns=0, mean=0, m2=0):
+        self.count = int(count)
+        self.first = float(first)
+        self.last = float(last)
+        self.peak = float(peak)
+        self.max_dd = float(max_dd)
+        self.returns = int(returns)
+        self.mean = float(mean)
+        self.m2 = float(m2)
+
+    def dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return 'OnlineMetrics({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in self.dict().items()))
+
+    def update(self, value:float):
+        if self.count == 0:
+            self.first = value
+            self.peak = value
+        else:
+            r = ratio(value, self.last) - 1
+            self.returns += 1
+            delta = r - self.mean
+            self.mean += delta / self.returns
+            self.m2 += delta * (r - self.mean)
+        if value > self.peak:
+            self.peak = value
+        drawdown = 1 - ratio(value, self.peak)
+        if drawdown > self.max_dd:
+            self.max_dd = drawdown
+        self.last = value
+        self.count += 1
+
+    def extend(self, values):
+        ''' Update with many values at once, equivalent to calling update on each '''
+        values = np.asarray(values, dtype=float)
+        if len(values) == 0:
+            return
+        if self.count == 0:
+            self.first = values[0]
+            self.peak = values[0]
+            current, previous = values[1:], values[:-1]
+        else:
+            current, previous = values, np.r_[self.last, values[:-1]]
+        # fmax skips NaN values like the comparisons of update
+        peaks = np.fmax.accumulate(np.r_[self.peak, values])[1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r = current / previous - 1
+            drawdowns = 1 - values / peaks
+        if len(r) > 0:
+            n = self.returns + len(r)
+            mean = r.mean()
+            delta = mean - self.mean
+            self.m2 += ((r - mean) ** 2).sum() + delta ** 2 * self.returns * len(r) / n
+            self.mean += delta * len(r) / n
+            self.returns = n
+        drawdowns = drawdowns[~np.isnan(drawdowns)]
+        if len(drawdowns) > 0:
+            self.max_dd = max(self.max_dd, float(drawdowns.max()))
+        self.peak = float(peaks[-1])
+        self.last = float(values[-1])
+        self.count += len(values)
+
+    def max_drawdown(self):
+        return self.max_dd
+
+    def annualized_return(self, initial_fund=None):
+        if self.count == 0:
+            return math.nan
+        if initial_fund is None:
+            initial_fund = self.first
+        base = 1 + ratio(self.last - initial_fund, initial_fund)
+        # A loss beyond the initial fund has no real root, NaN like the NumPy version instead of a complex
+        if not base >= 0:
+            return math.nan
+        return math.pow(base, 365 / self.count) - 1
+
+    def variance(self):
+        if self.returns < 2:
+            return math.nan
+        return self.m2 / (self.returns - 1)
+
+    def sharpe_ratio(self, rff=0.03):
+        return ratio(self.annualized_return() - rff, math.sqrt(self.variance()) * math.sqrt(365))
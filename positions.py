@@ -1,6 +1,9 @@
-from pydantic import BaseModel
 from portfolio import trade
-import json
+from portfolio.online import OnlineMetrics
+from portfolio.storage import DatastoreBackend, PortfolioManager
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
 from google.cloud import datastore
 
 import structlog
@@ -14,6 +17,7 @@ class Portfolio(object):
         self.positions = {symbol: trade.Position(fund=fund * allo) for symbol, allo in allocations.items()}
         self.client = None
         self.datastore_key = ('Positions', 10000)
+        self.metrics = OnlineMetrics()
     
     def connect(self, project_id):
         self.client = datastore.Client(project_id)
@@ -26,32 +30,79 @@ class Portfolio(object):
         result = {'positions':{}}
         for symbol, pos in p.positions.items():
             result['positions'][symbol] = pos.dict()
-            del result['positions'][symbol]['commision']
         result['symbols'] = p.symbols
         result['fund'] = p.fund
         result['allocations'] = p.allocations
+        result['metrics'] = p.metrics.dict()
         return result
     
+    def end_date(self, timestamp, prices):
+        ''' Records the end of a bar for every position and updates the running metrics of the total nav '''
+        nav = 0
+        for symbol, pos in self.positions.items():
+            pos.end_date(timestamp, prices[symbol])
+            nav += pos.get_nav(prices[symbol])
+        self.metrics.update(nav)
+        return nav
+
+    def rebalance(self, targets, prices, timestamp=None, notes=""):
+        ''' Allocates every symbol of ``targets`` ({symbol: exposure}) at ``prices`` in one call,
+        a NaN target holds the current exposure. Same positions as allocate per symbol
+        (see trade.allocate_positions), in about the same time.
+
+        Returns:
+            DataFrame: one row per trade with symbol, timestamp, trade, amount, price and fee
+        '''
+        symbols = list(targets.keys())
+        trades = trade.allocate_positions(
+            [self.positions[symbol] for symbol in symbols],
+            [targets[symbol] for symbol in symbols],
+            [prices[symbol] for symbol in symbols],
+            timestamp=timestamp, notes=notes)
+        batch = pd.DataFrame(OrderedDict([
+            ('symbol', np.array(symbols, dtype=object)[trades.pop('position')]),
+            ('timestamp', timestamp),
+        ] + list(trades.items())))
+        logger.info("rebalance", symbols=len(symbols), trades=len(batch))
+        return batch
+
+    def restore(self, result):
+        ''' Inverse of Portfolio.serialize '''
+        self.symbols = result['symbols']
+        self.fund = result['fund']
+        self.allocations = result['allocations']
+        self.positions = {symbol: trade.Position(**pos) for symbol, pos in result['positions'].items()}
+        self.metrics = OnlineMetrics(**result.get('metrics', {}))
+
+    def manager(self, kind):
+        ''' PortfolioManager of this portfolio alone, over the ``kind`` entities of its Datastore client '''
+        backend = DatastoreBackend(self.client, kind, properties=True)
+        return PortfolioManager(backend, {self.datastore_key[1]: self}, kind=None)
+
     def load(self, kind, key_name):
-        key = self.client.key(kind, key_name)
-        result = self.client.get(key)
-        logger.log("load", kind=kind, key=key, result=result)
+        ''' Restores the entity ``key_name`` of ``kind`` saved by Portfolio.save, returns it or None
+
+        Single-entity form of PortfolioManager.load_all, use a manager (or DeltaStore) for many portfolios.
+        '''
+        self.datastore_key = (kind, key_name)
+        result = self.manager(kind).backend.get(key_name)
+        logger.info("load", kind=kind, key=key_name, found=result is not None)
         if result:
-            self.symbols = result['symbols']
-            self.fund = result['fund']
-            self.allocations = result['allocations']
-            self.positions = {symbol: trade.Position(**pos) for symbol, pos in result['positions'].items()}
-            self.datastore_key = (kind, key_name)
+            self.restore(result)
             return result
+        return None
+
+    def save(self, result=None):
+        ''' Saves Portfolio.serialize(self), or an already serialized ``result``, as one entity
+
+        Single-entity form of PortfolioManager.save_all, use a manager (or DeltaStore) for many portfolios.
+        '''
+        kind, key_name = self.datastore_key
+        manager = self.manager(kind)
+        if result is not None:
+            manager.backend.put(key_name, result)
         else:
-            self.datastore_key = (kind, key_name)
-            return None
-        
-    def save(self):
-        print(self.datastore_key[0], self.datastore_key[1])
-        key = self.client.key(self.datastore_key[0], self.datastore_key[1])
-        entity = datastore.Entity(key=key)
-        entity.update(Portfolio.serialize(self))
-        result = self.client.put(entity)
-        logger.log("save", kind=self.datastore_key[0], key=self.datastore_key[1], result=result)
-        return result
\ No newline at end of file
+            outcome = manager.save_all()[key_name]
+            if isinstance(outcome, Exception):
+                raise outcome
+        logger.info("save", kind=kind, key=key_name)
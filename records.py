@@ -0,0 +1,268 @@
+''' This records module provides column-oriented storage for position logs
+
+'''
+import datetime
+import numpy as np
+import pandas as pd
+
+FLOAT = 'float'
+CATEGORY = 'category'
+DATETIME = 'datetime'
+OBJECT = 'object'
+FLUSH_SIZE = 1024
+NAT = np.datetime64('NaT').astype(np.int64)
+MISSING = -1
+
+########################################################################
+#### ColumnLog
+#### Append-only log of flat records stored as growable typed columns.
+#### Float fields share one 2-D buffer, string fields are stored as
+#### categorical codes (None as MISSING), timestamps as datetime64 (None
+#### as NaT) and anything else as objects. A datetime field receiving
+#### values that are not naive datetimes or None falls back to objects.
+#### Single appends are staged and written to the buffers in blocks.
+####
+#### Usage:
+#### log = ColumnLog([('price', FLOAT), ('trade', CATEGORY)])
+#### log.append({'price': 1.0, 'trade': 'LONG'})
+#### log.extend({'price': prices, 'trade': 'LONG'})
+#### log.to_frame()
+#### log.records()
+########################################################################
+
+
+def is_array(value):
+    return isinstance(value, (np.ndarray, pd.Index, pd.Series, list, tuple))
+
+
+def object_array(values):
+    ''' Object array of ``values``, filled one by one as numpy is slow to inspect e.g. Timestamps '''
+    result = np.empty(len(values), dtype=object)
+    for i, value in enumerate(values):
+        result[i] = value
+    return result
+
+
+def to_datetime64(value):
+    ''' datetime64[ns] array of ``value``, or None if it holds anything else than naive datetimes and None '''
+    if isinstance(value, pd.Series):
+        value = pd.Index(value)
+    if isinstance(value, pd.DatetimeIndex):
+        return value.values if value.tz is None else None
+    if isinstance(value, np.ndarray) and value.dtype.kind == 'M':
+        return value.astype('M8[ns]')
+    values = value if is_array(value) else [value]
+    result = np.empty(len(values), dtype='M8[ns]')
+    nanoseconds = result.view(np.int64)
+    for i, v in enumerate(values):
+        if v is None:
+            nanoseconds[i] = NAT
+        elif isinstance(v, datetime.datetime) and v.tzinfo is None:
+            nanoseconds[i] = v.value if isinstance(v, pd.Timestamp) else pd.Timestamp(v).value
+        elif isinstance(v, np.datetime64):
+            result[i] = v
+        else:
+            return None
+    return result
+
+
+def read_only(array):
+    ''' View of ``array`` that cannot be written to, the log buffers stay the only writers '''
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+def to_datetimes(values):
+    ''' Timestamps of a datetime64 array, NaT as None '''
+    return object_array([None if v is pd.NaT else v for v in pd.DatetimeIndex(values)])
+
+
+class ColumnLog(object):
+    def __init__(self, schema, records=(), capacity=16):
+        self.schema = list(schema)
+        self.fields = [name for name, kind in self.schema]
+        self.kinds = dict(self.schema)
+        self._floats = [name for name, kind in self.schema if kind == FLOAT]
+        self._float_pos = {name: i for i, name in enumerate(self._floats)}
+        self._size = 0
+        self._capacity = max(int(capacity), 1)
+        self._float_buffer = np.empty((len(self._floats), self._capacity))
+        self._buffers = {}
+        self._categories = {}
+        self._codes = {}
+        self._pending = []
+        for name, kind in self.schema:
+            if kind == CATEGORY:
+                self._buffers[name] = np.empty(self._capacity, dtype=np.int32)
+                self._categories[name] = []
+                self._codes[name] = {}
+            elif kind == DATETIME:
+                self._buffers[name] = np.empty(self._capacity, dtype='M8[ns]')
+            elif kind == OBJECT:
+                self._buffers[name] = np.empty(self._capacity, dtype=object)
+        for record in records:
+            self.append(record)
+
+    def __len__(self):
+        return self._size + len(self._pending)
+
+    def __iter__(self):
+        for start in range(0, len(self), FLUSH_SIZE):
+            for record in self.records(start, start + FLUSH_SIZE):
+                yield record
+
+    def __getitem__(self, item):
+        ''' Record (or list of records for a slice), only the requested rows are decoded '''
+        size = len(self)
+        if isinstance(item, slice):
+            start, stop, step = item.indices(size)
+            if step == 1:
+                return self.records(start, max(start, stop))
+            return [self[i] for i in range(start, stop, step)]
+        i = item + size if item < 0 else item
+        if not 0 <= i < size:
+            raise IndexError('ColumnLog index out of range')
+        return self.records(i, i + 1)[0]
+
+    def __repr__(self):
+        return 'ColumnLog(fields={}, size={})'.format(self.fields, len(self))
+
+    def _reserve(self, size):
+        ''' Grow the buffers by doubling until ``size`` rows fit '''
+        if size <= self._capacity:
+            return
+        capacity = self._capacity
+        while capacity < size:
+            capacity *= 2
+        float_buffer = np.empty((len(self._floats), capacity))
+        float_buffer[:, :self._size] = self._float_buffer[:, :self._size]
+        self._float_buffer = float_buffer
+        for name, buffer in self._buffers.items():
+            grown = np.empty(capacity, dtype=buffer.dtype)
+            grown[:self._size] = buffer[:self._size]
+            self._buffers[name] = grown
+        self._capacity = capacity
+
+    def _to_object(self, name):
+        ''' Switch a datetime field to object storage '''
+        buffer = np.empty(self._capacity, dtype=object)
+        buffer[:self._size] = to_datetimes(self._buffers[name][:self._size])
+        self._buffers[name] = buffer
+        self.kinds[name] = OBJECT
+
+    def _code(self, name, value):
+        if value is None:
+            return MISSING
+        codes = self._codes[name]
+        if value not in codes:
+            codes[value] = len(self._categories[name])
+            self._categories[name].append(value)
+        return codes[value]
+
+    def _encode(self, name, values):
+        ''' Category codes of ``values``, factorize marks None with -1 which stays MISSING '''
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        mapping = np.array([self._code(name, u) for u in uniques] + [MISSING], dtype=np.int32)
+        return mapping[codes]
+
+    def _decode(self, name, codes):
+        ''' Category values of ``codes``, MISSING as None '''
+        categories = np.empty(len(self._categories[name]) + 1, dtype=object)
+        categories[:-1] = self._categories[name]
+        return categories[codes]
+
+    def _flush(self):
+        ''' Write the staged rows to the buffers '''
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self._extend({name: [record[name] for record in pending] for name in self.fields})
+
+    def append(self, record):
+        self._pending.append(record)
+        if len(self._pending) >= FLUSH_SIZE:
+            self._flush()
+
+    def extend(self, columns):
+        ''' Append many rows at once from a dict of equal length arrays (or scalars) '''
+        self._flush()
+        self._extend(columns)
+
+    def _extend(self, columns):
+        size = max([len(value) for value in columns.values() if is_array(value)] or [1])
+        start, end = self._size, self._size + size
+        self._reserve(end)
+        for name in self.fields:
+            value = columns[name]
+            kind = self.kinds[name]
+            if kind == DATETIME:
+                converted = to_datetime64(value)
+                if converted is not None:
+                    self._buffers[name][start:end] = converted
+                    continue
+                self._to_object(name)
+                kind = OBJECT
+            if kind == FLOAT:
+                self._float_buffer[self._float_pos[name], start:end] = value
+            elif kind == CATEGORY:
+                if not is_array(value):
+                    self._buffers[name][start:end] = self._code(name, value)
+                else:
+                    self._buffers[name][start:end] = self._encode(name, value)
+            elif is_array(value):
+                self._buffers[name][start:end] = object_array(value)
+            else:
+                self._buffers[name][start:end] = [value] * size
+        self._size = end
+
+    def column(self, name, start=0):
+        ''' Read-only view of a single column, categorical fields are returned as pd.Categorical '''
+        self._flush()
+        kind = self.kinds[name]
+        if kind == FLOAT:
+            return read_only(self._float_buffer[self._float_pos[name], start:self._size])
+        elif kind == CATEGORY:
+            return pd.Categorical.from_codes(self._buffers[name][start:self._size].copy(), categories=self._categories[name])
+        else:
+            return read_only(self._buffers[name][start:self._size])
+
+    def to_frame(self, index=None, start=0, copy=False):
+        ''' Rows from ``start`` as a DataFrame over read-only views of the buffers,
+        or over copies independent of the log with ``copy``
+        '''
+        self._flush()
+        floats = self._float_buffer[:, start:self._size].T
+        frame = pd.DataFrame(floats.copy() if copy else read_only(floats), index=index, columns=self._floats, copy=False)
+        for loc, name in enumerate(self.fields):
+            if self.kinds[name] != FLOAT:
+                value = self.column(name, start)
+                frame.insert(loc, name, value.copy() if copy and isinstance(value, np.ndarray) else value)
+        return frame
+
+    def columns(self, start=0, end=None, copy=False):
+        ''' Arrays of the rows from ``start`` to ``end``, read-only views of the buffers
+        (writable copies with ``copy``), categorical fields are decoded
+        '''
+        self._flush()
+        end = self._size if end is None else min(end, self._size)
+        result = {}
+        for name in self.fields:
+            kind = self.kinds[name]
+            if kind == CATEGORY:
+                result[name] = self._decode(name, self._buffers[name][start:end])
+                continue
+            if kind == FLOAT:
+                value = self._float_buffer[self._float_pos[name], start:end]
+            else:
+                value = self._buffers[name][start:end]
+            result[name] = value.copy() if copy else read_only(value)
+        return result
+
+    def records(self, start=0, end=None):
+        ''' List of dicts of the rows from ``start`` to ``end``, as the logs were stored before '''
+        columns = self.columns(start, end)
+        for name in self.fields:
+            if self.kinds[name] == DATETIME:
+                columns[name] = to_datetimes(columns[name])
+        return [dict(zip(self.fields, row)) for row in zip(*[columns[name].tolist() for name in self.fields])]
@@ -0,0 +1,291 @@
+''' This replay module rebuilds Position state from its trade log
+
+'''
+import math
+import numpy as np
+import pandas as pd
+
+from .records import ColumnLog
+from .trade import Position, Commission, LOG_SCHEMAS, TRADE_PROFIT_SCHEMA, charge_fills
+
+import structlog
+logger = structlog.getLogger()
+
+########################################################################
+#### Replay
+#### The trade log is the event log of a position: fund, fee, inventory
+#### and trade_profit follow from replaying its LONG/SHORT/CLOSE/COVER
+#### rows on top of a snapshot, with the same float operations as the
+#### Position methods. Fees (charge_fills), cash and fee totals are
+#### vectorized, only the average entry price is carried through a scalar
+#### loop.
+####
+#### Replays from a snapshot are exact. Positions without one start from
+#### unwound_state, whose fund and fee are unwound by subtraction, so
+#### their replayed and recosted fund/fee/nav differ from a fresh run in
+#### the last digits; take a snapshot before trading for exact results.
+####
+#### The trade log does not record the target exposure or base rate:
+#### strategy_exposure comes from the last balance_log row after the
+#### replayed trades (the real exposure after the last trade otherwise)
+#### and base_rate from the snapshot.
+####
+#### Usage:
+#### snapshots = Snapshots(every=1000)
+#### snapshots.take(position)             (periodically, e.g. after end_date)
+#### snapshots.recover(position)          (snapshot + tail replay)
+#### snapshots.rollback(position, timestamp)
+#### recost(position, TradePercentage(0.0005), snapshots.snapshots[0])
+########################################################################
+
+STATE = ('fund', 'fee', 'inv', 'strategy_exposure', 'base_rate', 'leverage', 'commision')
+
+
+def snapshot(position):
+    ''' Compact state of ``position`` with the lengths of its logs '''
+    state = position.dict(include=set(STATE))
+    state.update({log: len(getattr(position, log)) for log in LOG_SCHEMAS})
+    state['timestamp'] = None
+    if len(position.trade_log) > 0:
+        state['timestamp'] = position.trade_log.column('timestamp', len(position.trade_log) - 1)[0]
+    return state
+
+
+def unwound_state(position):
+    ''' Approximate state before the first trade, for positions without a snapshot
+
+    fund and fee are unwound by subtraction (exact up to rounding) and stateful
+    commission models keep their current state, so their total_fee quotes differ.
+    '''
+    trades = position.trade_log.columns()
+    size, price = np.abs(trades['amount']), trades['price']
+    sign = np.where(np.isin(trades['trade'], ['LONG', 'COVER']), -1.0, 1.0)
+    state = dict(position.dict(include=set(STATE)), trade_log=0, trade_profit=0, balance_log=0, timestamp=None)
+    state['fund'] = position.fund - float(np.sum(sign * size * price))
+    state['fee'] = position.fee - float(np.sum(trades['fee']))
+    state['inv'] = {'inventory': [], 'islong': True}
+    return state
+
+
+def replay(trades, state, commision=None):
+    ''' Applies the trade log columns ``trades`` to the snapshot ``state``
+
+    Args:
+        trades (dict): trade_log columns, as ColumnLog.columns()
+        state (dict): snapshot the trades follow
+        commision (Commission): re-cost the fills with this model instead of using the logged fees
+
+    Returns:
+        (dict, dict, array): new state, trade_profit columns of the exits and the fee of every trade
+    '''
+    kinds = trades['trade'].tolist()
+    amounts = trades['amount']
+    sizes = np.abs(amounts)
+    prices = trades['price']
+    live = Commission.from_dict(state['commision']) if isinstance(state['commision'], dict) else state['commision'].copy()
+    model = live if commision is None else commision.copy()
+    base_rate = state['base_rate']
+    inventory = state['inv']['inventory']
+    held, avg = (float(inventory[0][0]), float(inventory[0][1])) if inventory else (0.0, 0.0)
+    islong = state['inv']['islong']
+
+    exits, enter_prices, pnls, sides = [], [], [], []
+    for i, (kind, size, price) in enumerate(zip(kinds, sizes.tolist(), prices.tolist())):
+        if kind == 'LONG' or kind == 'SHORT':
+            if held == 0:
+                islong = kind == 'LONG'
+                held, avg = size, price
+            else:
+                new_held = held + size
+                avg = (held * avg + size * price) / new_held
+                held = new_held
+        else:
+            exits.append(i)
+            enter_prices.append(avg)
+            pnls.append((price - avg) / avg if islong else (avg - price) / avg)
+            sides.append('LONG' if islong else 'SHORT')
+            if math.isclose(held, size):
+                held, avg = 0.0, 0.0
+            else:
+                held = held - size
+    exits = np.asarray(exits, dtype=np.intp)
+    enter_prices = np.asarray(enter_prices, dtype=float)
+    charged, quotes = charge_fills(model, prices, sizes, exits, enter_prices)
+    fees = np.asarray(trades['fee'] if commision is None else charged, dtype=float)
+    total_fees = fees[exits] + quotes
+
+    # Cash and fee totals accumulate in trade order, like the Position methods
+    cash = np.where(np.isin(trades['trade'], ['LONG', 'COVER']), -1.0, 1.0) * (sizes * prices)
+    state = dict(state)
+    state['fund'] = float(np.cumsum(np.r_[state['fund'], cash])[-1])
+    state['fee'] = float(np.cumsum(np.r_[state['fee'], fees])[-1])
+    state['inv'] = {'inventory': [(held, avg)] if held != 0 else [], 'islong': islong}
+    state['commision'] = model.dict()
+    state['trade_log'] += len(kinds)
+    state['trade_profit'] += len(exits)
+    if len(kinds):
+        state['timestamp'] = trades['timestamp'][-1]
+
+    realized_pnl = np.asarray(pnls, dtype=float)
+    realized_profit_pt = sizes[exits] * realized_pnl
+    profits = {
+        'timestamp': trades['timestamp'][exits],
+        'amount': np.where(np.asarray(sides, dtype=object) == 'LONG', sizes[exits], -sizes[exits]),
+        'exit_price': prices[exits],
+        'enter_price': enter_prices,
+        'realized_gross_profit': realized_profit_pt * base_rate * enter_prices,
+        'realized_profit_pt': realized_profit_pt,
+        'realized_pnl': realized_pnl,
+        'total_fee': total_fees,
+        'trade': np.asarray(sides, dtype=object),
+    }
+    return state, profits, fees
+
+
+def rows_until(timestamps, timestamp):
+    ''' Number of rows of a sorted timestamp column at or before ``timestamp``,
+    for naive (datetime64) and tz-aware (Timestamp objects) columns alike
+    '''
+    return int(pd.Index(timestamps).searchsorted(pd.Timestamp(timestamp), side='right'))
+
+
+def strategy_exposure(position, state, end=None):
+    ''' Target exposure after the replayed trades, see the module notes '''
+    timestamps = pd.Index(position.balance_log.column('timestamp')[:end])
+    if len(timestamps) and isinstance(timestamps, pd.DatetimeIndex) and (state['timestamp'] is None or timestamps[-1] >= state['timestamp']):
+        return float(position.balance_log.column('strategy_exposure')[len(timestamps) - 1])
+    if state['trade_log'] == 0 or len(position.trade_log) == 0:
+        return state['strategy_exposure']
+    amount, held, price = 0.0, state['inv']['inventory'], position.trade_log.column('price', state['trade_log'] - 1)[0]
+    if held:
+        amount = held[0][0] if state['inv']['islong'] else -held[0][0]
+    return Position.cal_exposure(state['fund'], amount, price)
+
+
+def apply_state(position, state):
+    position.fund = state['fund']
+    position.fee = state['fee']
+    position.inv.inventory = state['inv']['inventory']
+    position.inv.islong = state['inv']['islong']
+    position.strategy_exposure = state['strategy_exposure']
+    position.commision = Commission.from_dict(state['commision'])
+
+
+def build_log(name, columns):
+    log = ColumnLog(LOG_SCHEMAS[name])
+    log.extend(columns)
+    return log
+
+
+class Snapshots(object):
+    ''' Snapshots of one position taken at least ``every`` trades apart '''
+    def __init__(self, every=1000, snapshots=None):
+        self.every = every
+        self.snapshots = list(snapshots or [])
+
+    def take(self, position, force=False):
+        ''' Takes a snapshot if ``every`` trades were made since the last one '''
+        trades = len(position.trade_log)
+        if force or not self.snapshots or trades - self.snapshots[-1]['trade_log'] >= self.every:
+            self.snapshots.append(snapshot(position))
+            return self.snapshots[-1]
+        return None
+
+    def latest(self, trades=None, timestamp=None):
+        ''' Last snapshot at or before ``trades`` trades and ``timestamp`` '''
+        for state in reversed(self.snapshots):
+            if trades is not None and state['trade_log'] > trades:
+                continue
+            if timestamp is not None and state['timestamp'] is not None and state['timestamp'] > timestamp:
+                continue
+            return state
+        return None
+
+    def recover(self, position):
+        ''' Restores the state of ``position`` from the latest snapshot and its logs, returns the trades replayed '''
+        state = self.latest(len(position.trade_log))
+        if state is None:
+            raise ValueError('no snapshot at or before {} trades'.format(len(position.trade_log)))
+        start = state['trade_log']
+        state, profits, fees = replay(position.trade_log.columns(start), state)
+        state['strategy_exposure'] = strategy_exposure(position, state)
+        apply_state(position, state)
+        logger.info("recover", trades=state['trade_log'] - start)
+        return state['trade_log'] - start
+
+    def rollback(self, position, timestamp):
+        ''' New Position as it was after the trades and end_dates at or before ``timestamp`` '''
+        trades = rows_until(position.trade_log.column('timestamp'), timestamp)
+        state = self.latest(trades)
+        if state is None:
+            raise ValueError('no snapshot before {}'.format(timestamp))
+        state, profits, fees = replay(position.trade_log.columns(state['trade_log'], trades), state)
+        bars = rows_until(position.balance_log.column('timestamp'), timestamp)
+        state['strategy_exposure'] = strategy_exposure(position, state, bars)
+        rolled = Position(
+            trade_log=build_log('trade_log', position.trade_log.columns(0, trades)),
+            trade_profit=build_log('trade_profit', position.trade_profit.columns(0, state['trade_profit'])),
+            balance_log=build_log('balance_log', position.balance_log.columns(0, bars)))
+        apply_state(rolled, state)
+        rolled.base_rate = state['base_rate']
+        rolled.leverage = state['leverage']
+        return rolled
+
+
+def same_values(a, b):
+    ''' Element-wise equality where NaT equals NaT and NaN equals NaN '''
+    a, b = np.asarray(a), np.asarray(b)
+    if a.dtype.kind == 'M' and b.dtype.kind == 'M':
+        return np.array_equal(a.astype('M8[ns]').view('i8'), b.astype('M8[ns]').view('i8'))
+    if a.dtype.kind == 'f' and b.dtype.kind == 'f':
+        return a.shape == b.shape and bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+    return np.array_equal(a, b)
+
+
+def verify(position, state=None):
+    ''' Fields of ``position`` that differ from a replay of its trade log (from ``state`` or the unwound start) '''
+    if state is None:
+        state = unwound_state(position)
+    replayed, profits, fees = replay(position.trade_log.columns(state['trade_log']), state)
+    mismatches = {}
+    for name in ('fund', 'fee'):
+        if not math.isclose(replayed[name], getattr(position, name), rel_tol=1e-9, abs_tol=1e-9):
+            mismatches[name] = (getattr(position, name), replayed[name])
+    if replayed['inv'] != position.inv.dict():
+        mismatches['inv'] = (position.inv.dict(), replayed['inv'])
+    stored = position.trade_profit.columns(state['trade_profit'])
+    for name, kind in TRADE_PROFIT_SCHEMA:
+        if len(stored[name]) != len(profits[name]) or not same_values(stored[name], profits[name]):
+            mismatches['trade_profit.' + name] = (stored[name], profits[name])
+    return mismatches
+
+
+def recost(position, commision, state=None):
+    ''' Copy of ``position`` with every fee recomputed by ``commision``, replayed from ``state``
+
+    Without a snapshot it starts from unwound_state and fund/fee/nav differ from a
+    fresh backtest by rounding, see the module notes.
+    '''
+    if state is None:
+        state = unwound_state(position)
+    trades = position.trade_log.columns(copy=True)
+    done = state['trade_log']
+    replayed, profits, fees = replay({name: column[done:] for name, column in trades.items()}, state, commision)
+    trades['fee'][done:] = fees
+    balance = position.balance_log.columns(copy=True)
+    # A bar carries the fees of the trades at or before its timestamp
+    paid = np.r_[0.0, np.cumsum(fees)][np.searchsorted(trades['timestamp'][done:], balance['timestamp'], side='right')]
+    after = np.searchsorted(balance['timestamp'], state['timestamp'], side='right') if state['timestamp'] is not None else 0
+    balance['fee'][after:] = state['fee'] + paid[after:]
+    balance['nav'] = balance['gav'] - balance['fee']
+    profit_log = position.trade_profit.columns(0, state['trade_profit'])
+    profit_log = {name: np.concatenate([profit_log[name], profits[name]]) for name in profit_log}
+    result = Position(
+        trade_log=build_log('trade_log', trades),
+        trade_profit=build_log('trade_profit', profit_log),
+        balance_log=build_log('balance_log', balance))
+    replayed['strategy_exposure'] = position.strategy_exposure
+    apply_state(result, replayed)
+    result.base_rate = position.base_rate
+    result.leverage = position.leverage
+    return result
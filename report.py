@@ -0,0 +1,120 @@
+''' This report module renders the charts of Statistics.report to image files
+
+'''
+import os
+import numpy as np
+import pandas as pd
+
+from .statistics import drawdowns
+
+########################################################################
+#### Report
+#### report_data collects what the charts need into small pandas/numpy
+#### objects (long curves are thinned to ``points`` bars, keeping the
+#### deepest drawdown of every thinned step) so they pickle cheaply to a
+#### worker process. render_report draws them on Agg canvases: matplotlib
+#### is imported on first use and pyplot and the global backend are never
+#### touched, so it runs headless and next to an interactive session.
+####
+#### Usage:
+#### data = report_data(stat)
+#### render_report(data, 'reports/')     (or in a worker, see Statistics.report)
+########################################################################
+
+CHARTS = ('equity', 'drawdown', 'monthly_returns', 'trade_distribution')
+
+
+def thin(series, points, reduce=None):
+    ''' Every k-th value of ``series`` (and the last one) so that at most about ``points`` remain,
+    or ``reduce`` (e.g. np.maximum) of each step of k values
+    '''
+    step = -(-len(series) // points) if points else 1
+    if step <= 1:
+        return series
+    starts = np.arange(0, len(series), step)
+    if reduce is not None:
+        return pd.Series(reduce.reduceat(series.values, starts), index=series.index[starts], name=series.name)
+    return series.iloc[np.r_[starts, len(series) - 1] if starts[-1] != len(series) - 1 else starts]
+
+
+def report_data(stat, points=5000):
+    ''' Equity, drawdown, monthly calendar and realized trade returns of a Statistics '''
+    equity = stat.equity
+    drawdown = pd.Series(drawdowns(equity), index=equity.index, name='drawdown')
+    trades = stat.trade_profit
+    return {
+        'equity': thin(equity, points),
+        'drawdown': thin(drawdown, points, np.maximum),
+        'monthly_returns': stat.calendar_returns('monthly'),
+        'trades': {side: trades['realized_pnl'].values[(trades['trade'] == side).values].astype(float)
+                   for side in ('LONG', 'SHORT')},
+    }
+
+
+def _figure(size):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    figure = Figure(figsize=size)
+    FigureCanvasAgg(figure)
+    return figure
+
+
+def plot_equity(figure, data):
+    ax = figure.add_subplot(111)
+    ax.plot(data['equity'].index, data['equity'].values, linewidth=1)
+    ax.set_title('Equity')
+    ax.grid(alpha=0.3)
+
+
+def plot_drawdown(figure, data):
+    ax = figure.add_subplot(111)
+    drawdown = data['drawdown']
+    ax.fill_between(drawdown.index, -drawdown.values * 100, 0, color='tab:red', alpha=0.5)
+    ax.set_title('Drawdown %')
+    ax.grid(alpha=0.3)
+
+
+def plot_monthly_returns(figure, data):
+    ax = figure.add_subplot(111)
+    table = data['monthly_returns'] * 100
+    limit = np.nanmax(np.abs(table.values)) if table.size and np.isfinite(table.values).any() else 1
+    ax.imshow(table.values, cmap='RdYlGn', vmin=-limit, vmax=limit, aspect='auto')
+    ax.set_xticks(np.arange(table.shape[1]))
+    ax.set_xticklabels([str(column) for column in table.columns])
+    ax.set_yticks(np.arange(table.shape[0]))
+    ax.set_yticklabels([str(row) for row in table.index])
+    for (i, j), value in np.ndenumerate(table.values):
+        if np.isfinite(value):
+            ax.text(j, i, '{:.1f}'.format(value), ha='center', va='center', fontsize=7)
+    ax.set_title('Monthly Return %')
+
+
+def plot_trade_distribution(figure, data):
+    ax = figure.add_subplot(111)
+    pnls = [data['trades'][side] * 100 for side in ('LONG', 'SHORT')]
+    if sum(len(pnl) for pnl in pnls):
+        ax.hist(pnls, bins=50, stacked=True, label=['Long', 'Short'])
+        ax.legend()
+    ax.set_title('Trade Return %')
+    ax.grid(alpha=0.3)
+
+
+def render_report(data, directory, fmt='png', dpi=100, charts=CHARTS):
+    ''' Draws ``charts`` from report_data into ``directory``, returns the file paths '''
+    os.makedirs(directory, exist_ok=True)
+    plots = {
+        'equity': (plot_equity, (10, 4)),
+        'drawdown': (plot_drawdown, (10, 3)),
+        'monthly_returns': (plot_monthly_returns, (10, 1 + 0.4 * len(data['monthly_returns']))),
+        'trade_distribution': (plot_trade_distribution, (8, 4)),
+    }
+    paths = []
+    for chart in charts:
+        plot, size = plots[chart]
+        figure = _figure(size)
+        plot(figure, data)
+        figure.tight_layout()
+        path = os.path.join(directory, '{}.{}'.format(chart, fmt))
+        figure.savefig(path, dpi=dpi)
+        paths.append(path)
+    return paths
@@ -0,0 +1,149 @@
+''' This resample module estimates drawdown and return distributions by Monte Carlo resampling
+
+'''
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from .statistics import drawdowns_matrix, annualized_return_matrix, sharpe_ratio_matrix
+
+########################################################################
+#### Resampling
+#### Paths are generated in batches of ``batch_size`` as 2-D arrays
+#### (bars x paths) and only their metrics leave the workers. Every run of
+#### STREAM_PATHS paths draws from its own RandomState seeded from
+#### ``seed`` and batches hold whole runs, so results only depend on
+#### ``seed``, not on ``batch_size`` or the number of processes.
+####
+#### trade paths:  fund + cumulative net profit of the trades, resampled
+####               with replacement ('bootstrap') or shuffled ('permute')
+#### return paths: equity compounded from daily returns resampled in
+####               circular blocks of ``block`` days (block bootstrap)
+####
+#### Usage:
+#### bootstrap_trades(stat.trade_profit, fund=10000, days=365, n_paths=20000)
+#### bootstrap_returns(stat.equity, n_paths=20000, block=20)
+########################################################################
+
+PERCENTILES = (5, 25, 50, 75, 95)
+# Paths drawn from one seeded RandomState, batch sizes are rounded up to a multiple
+STREAM_PATHS = 100
+
+
+def batch_seeds(seed, batches):
+    ''' One reproducible seed per batch '''
+    return np.random.RandomState(seed).randint(0, 2 ** 31 - 1, size=batches).tolist()
+
+
+def streams(n_paths, seed, batch_size):
+    ''' [(paths, seed)] runs of every batch, the same runs whatever ``batch_size`` '''
+    runs = [(min(STREAM_PATHS, n_paths - start), run_seed) for start, run_seed
+            in zip(range(0, n_paths, STREAM_PATHS), batch_seeds(seed, -(-n_paths // STREAM_PATHS)))]
+    per_batch = max(-(-batch_size // STREAM_PATHS), 1)
+    return [runs[i:i + per_batch] for i in range(0, len(runs), per_batch)]
+
+
+def trade_paths(profits, fund, paths, method, rng):
+    ''' Equity after each trade (trades + 1 x paths) '''
+    n = len(profits)
+    if method == 'bootstrap':
+        index = rng.randint(0, n, size=(n, paths))
+    elif method == 'permute':
+        index = np.argsort(rng.random_sample((n, paths)), axis=0)
+    else:
+        raise ValueError('method must be bootstrap or permute, not {!r}'.format(method))
+    values = np.empty((n + 1, paths))
+    values[0] = fund
+    np.cumsum(profits[index], axis=0, out=values[1:])
+    values[1:] += fund
+    return values
+
+
+def block_paths(returns, paths, block, rng):
+    ''' Equity compounded from circular blocks of ``returns`` (returns + 1 x paths), starting at 1 '''
+    n = len(returns)
+    blocks = -(-n // block)
+    starts = rng.randint(0, n, size=(blocks, paths))
+    index = ((starts[:, None, :] + np.arange(block)[None, :, None]) % n).reshape(blocks * block, paths)[:n]
+    values = np.ones((n + 1, paths))
+    np.cumprod(1 + returns[index], axis=0, out=values[1:])
+    return values
+
+
+def _trade_batch(profits, fund, days, method, runs):
+    values = np.hstack([trade_paths(profits, fund, paths, method, np.random.RandomState(seed)) for paths, seed in runs])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return OrderedDict([
+            ('max_drawdown', drawdowns_matrix(values).max(axis=0)),
+            ('cagr', (values[-1] / fund) ** (365 / days) - 1),
+            ('net_profit', values[-1] - fund),
+        ])
+
+
+def _return_batch(returns, block, rff, runs):
+    values = np.hstack([block_paths(returns, paths, block, np.random.RandomState(seed)) for paths, seed in runs])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return OrderedDict([
+            ('max_drawdown', drawdowns_matrix(values).max(axis=0)),
+            ('cagr', annualized_return_matrix(values)),
+            ('sharpe', sharpe_ratio_matrix(values, rff)),
+        ])
+
+
+def run_batches(task, args, n_paths, seed, processes, batch_size):
+    ''' Runs ``task(*args, runs)`` over batches of [(paths, seed)] runs, returns the concatenated metrics '''
+    jobs = [args + (runs,) for runs in streams(n_paths, seed, batch_size)]
+    if processes == 1:
+        results = [task(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(processes) as executor:
+            results = list(executor.map(task, *zip(*jobs)))
+    return OrderedDict((name, np.concatenate([result[name] for result in results])) for name in results[0])
+
+
+def summarize(metrics, percentiles=PERCENTILES):
+    ''' Mean, standard deviation and percentiles of every metric (metrics x statistics) '''
+    columns = ['mean', 'std'] + ['{}%'.format(p) for p in percentiles]
+    rows = []
+    for name, values in metrics.items():
+        values = values[np.isfinite(values)]
+        rows.append([values.mean(), values.std()] + list(np.percentile(values, percentiles)) if len(values)
+                    else [np.nan] * len(columns))
+    return pd.DataFrame(rows, index=list(metrics), columns=columns)
+
+
+def bootstrap_trades(trade_profit, fund, days, n_paths=10000, method='bootstrap', seed=0,
+                     processes=None, batch_size=1000, percentiles=PERCENTILES, raw=False):
+    ''' Distribution of max drawdown, CAGR and net profit over resampled trade sequences
+
+    Args:
+        trade_profit (DataFrame): realized trades, as Statistics.trade_profit
+        fund (float): initial capital
+        days (float): length of the period the trades span, to annualize
+        method (str): 'bootstrap' (with replacement) or 'permute' (same trades, shuffled order)
+        raw (bool): return the metric of every path instead of the summary
+    '''
+    profits = (trade_profit['realized_gross_profit'] - trade_profit['total_fee']).values.astype(float)
+    metrics = run_batches(_trade_batch, (profits, float(fund), float(days), method), n_paths, seed, processes, batch_size)
+    return metrics if raw else summarize(metrics, percentiles)
+
+
+def daily_returns(equity):
+    ''' Returns between the last values of consecutive days '''
+    daily = equity.resample('D').last().dropna() if isinstance(equity.index, pd.DatetimeIndex) else equity
+    return daily.pct_change().values[1:].astype(float)
+
+
+def bootstrap_returns(equity, n_paths=10000, block=20, rff=0.03, seed=0,
+                      processes=None, batch_size=1000, percentiles=PERCENTILES, raw=False):
+    ''' Distribution of max drawdown, CAGR and Sharpe ratio over block-bootstrapped daily returns
+
+    Args:
+        equity (Series): equity curve, as Statistics.equity
+        block (int): length in days of the resampled blocks, keeps short-range autocorrelation
+        raw (bool): return the metric of every path instead of the summary
+    '''
+    returns = daily_returns(equity)
+    metrics = run_batches(_return_batch, (returns, int(block), rff), n_paths, seed, processes, batch_size)
+    return metrics if raw else summarize(metrics, percentiles)
@@ -0,0 +1,274 @@
+''' This signals module turns TA-Lib indicators into target exposures
+
+'''
+from collections import OrderedDict
+import glob
+import hashlib
+import os
+import numpy as np
+
+from .backtest import backtest
+
+import structlog
+logger = structlog.getLogger()
+
+########################################################################
+#### Indicator
+#### One TA-Lib function (abstract API) with its parameters and the
+#### output to keep. Only an indicator with an explicit ``warmup`` (bars
+#### of history added to the TA-Lib lookback) may be computed over the
+#### tail of a series: the tail then approximates a full computation
+#### (recursive indicators like EMA, RSI, MACD or ATR converge within the
+#### warmup, running sums round differently) and is cached under its own
+#### key. Without a warmup every series is computed in full, so caching
+#### never changes results. Keys include the TA-Lib unstable period set
+#### with talib.set_unstable_period, which changes the outputs.
+####
+#### Usage:
+#### rsi = Indicator('RSI', timeperiod=14, warmup=200)
+#### rsi.compute({'close': prices})
+########################################################################
+
+
+def unstable_period(name):
+    ''' TA-Lib unstable period of the function ``name``, 0 for functions without one '''
+    import talib
+    get_unstable_period = getattr(talib, 'get_unstable_period', None)
+    try:
+        return get_unstable_period(name) if get_unstable_period is not None else 0
+    except KeyError:
+        # Functions without an unstable period ID (SMA, MACD, BBANDS, ...)
+        return 0
+
+
+class Indicator(object):
+    def __init__(self, name, output=0, warmup=None, **params):
+        self.name = name.upper()
+        self.output = output
+        self.warmup = warmup
+        self.params = params
+
+    def __repr__(self):
+        return 'Indicator({!r}, output={!r}, {})'.format(
+            self.name, self.output, ', '.join('{}={!r}'.format(k, v) for k, v in sorted(self.params.items())))
+
+    def key(self):
+        key = '{}({})[{}]'.format(self.name, ','.join('{}={!r}'.format(k, v) for k, v in sorted(self.params.items())), self.output)
+        unstable = unstable_period(self.name)
+        if unstable:
+            key = '{}@{}'.format(key, unstable)
+        # Tail computed values are approximations, never shared with exact ones
+        return key if self.warmup is None else '{}~{}'.format(key, self.warmup)
+
+    def function(self):
+        from talib import abstract
+        return abstract.Function(self.name, **self.params)
+
+    def lookback(self):
+        ''' Bars of history needed before the first valid value '''
+        return self.function().lookback + (self.warmup or 0)
+
+    def incremental(self):
+        ''' Whether the tail of a series may be computed alone, see the notes above '''
+        return self.warmup is not None
+
+    def compute(self, data):
+        function = self.function()
+        outputs = function(data)
+        if isinstance(outputs, (list, tuple)):
+            output = self.output
+            if not isinstance(output, int):
+                output = function.output_names.index(output)
+            outputs = outputs[output]
+        return np.asarray(outputs, dtype=float)
+
+########################################################################
+#### IndicatorCache
+#### Memoizes indicator outputs in memory (LRU) and optionally on disk,
+#### keyed by (symbol, indicator key, length, fingerprint of the data).
+#### When the data extends a cached series of an incremental indicator
+#### only the new bars, plus the indicator lookback, are computed. The
+#### memory and the disk keep the latest values of every series only.
+####
+#### Usage:
+#### cache = IndicatorCache(maxsize=256, directory='.indicators')
+#### cache.get('BTCUSD', Indicator('SMA', timeperiod=20), {'close': prices})
+########################################################################
+
+
+def as_inputs(data):
+    ''' Dict of float arrays, a single array is taken as close prices '''
+    if not isinstance(data, dict):
+        data = {'close': data}
+    return {name: np.ascontiguousarray(values, dtype=float) for name, values in data.items()}
+
+
+def fingerprint(data, end=None):
+    ''' Hash of the first ``end`` bars of every input '''
+    digest = hashlib.sha1()
+    for name in sorted(data):
+        digest.update(name.encode())
+        digest.update(data[name][:end].tobytes())
+    return digest.hexdigest()
+
+
+def data_length(data):
+    return len(next(iter(data.values())))
+
+
+class IndicatorCache(object):
+    def __init__(self, maxsize=128, directory=None):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.tails = 0
+        self.misses = 0
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    @staticmethod
+    def series_name(symbol, indicator):
+        return hashlib.sha1('{}/{}'.format(symbol, indicator.key()).encode()).hexdigest()
+
+    def _path(self, series, length, digest):
+        return os.path.join(self.directory, '{}-{}-{}.npy'.format(series, length, digest))
+
+    def _remember(self, key, values):
+        self.memory[key] = values
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxsize:
+            self.memory.popitem(last=False)
+
+    def _lookup(self, series, length, digest):
+        key = (series, length, digest)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory is not None and os.path.exists(self._path(*key)):
+            values = np.load(self._path(*key))
+            self._remember(key, values)
+            return values
+        return None
+
+    def _store(self, series, length, digest, values):
+        # Replace the previous values of the series, a growing series takes one entry
+        for key in [key for key in self.memory if key[0] == series]:
+            del self.memory[key]
+        self._remember((series, length, digest), values)
+        if self.directory is not None:
+            path = self._path(series, length, digest)
+            with open(path + '.tmp', 'wb') as f:
+                np.save(f, values)
+            os.replace(path + '.tmp', path)
+            # Replace the previous file of the series, disk use stays one file per series
+            for previous in glob.glob(os.path.join(self.directory, series + '-*-*.npy')):
+                if previous != path:
+                    os.remove(previous)
+
+    def _prefixes(self, series, length):
+        ''' Cached (length, fingerprint) of the series shorter than ``length``, longest first '''
+        found = {(n, digest) for s, n, digest in self.memory if s == series and n < length}
+        if self.directory is not None:
+            for path in glob.glob(os.path.join(self.directory, series + '-*-*.npy')):
+                parts = os.path.basename(path)[:-len('.npy')].split('-')
+                if len(parts) == 3 and int(parts[1]) < length:
+                    found.add((int(parts[1]), parts[2]))
+        return sorted(found, reverse=True)
+
+    def get(self, symbol, indicator, data, digest=None):
+        ''' Output of ``indicator`` over ``data``, computed only where not cached '''
+        data = as_inputs(data)
+        length = data_length(data)
+        series = self.series_name(symbol, indicator)
+        digest = digest or fingerprint(data)
+        values = self._lookup(series, length, digest)
+        if values is not None:
+            self.hits += 1
+            return values
+        for n, prefix in (self._prefixes(series, length) if indicator.incremental() else []):
+            if fingerprint(data, n) == prefix:
+                head = self._lookup(series, n, prefix)
+                if head is None:
+                    continue
+                start = max(0, n - indicator.lookback())
+                tail = indicator.compute({name: column[start:] for name, column in data.items()})
+                values = np.concatenate([head, tail[n - start:]])
+                self.tails += 1
+                break
+        else:
+            values = indicator.compute(data)
+            self.misses += 1
+        self._store(series, length, digest, values)
+        return values
+
+    def clear(self, disk=False):
+        self.memory.clear()
+        if disk and self.directory is not None:
+            for path in glob.glob(os.path.join(self.directory, '*.npy')):
+                os.remove(path)
+
+########################################################################
+#### Exposure rules
+#### Map indicator values to target exposures in [-1, 1], NaN (warmup
+#### bars) maps to 0.
+########################################################################
+
+
+def threshold(values, lower, upper, reverse=True):
+    ''' Oscillators: long below ``lower``, short above ``upper`` (the opposite with reverse=False) '''
+    values = np.asarray(values, dtype=float)
+    side = 1.0 if reverse else -1.0
+    with np.errstate(invalid='ignore'):
+        return np.where(values < lower, side, np.where(values > upper, -side, 0.0))
+
+
+def sign(values):
+    ''' Long when positive, short when negative, e.g. a MACD histogram '''
+    return np.nan_to_num(np.sign(np.asarray(values, dtype=float)))
+
+
+def crossover(fast, slow):
+    ''' Long while ``fast`` is above ``slow``, short while below '''
+    return sign(np.asarray(fast, dtype=float) - np.asarray(slow, dtype=float))
+
+
+def scaled(values, scale):
+    ''' values / scale clipped to [-1, 1] '''
+    return np.clip(np.nan_to_num(np.asarray(values, dtype=float) / scale), -1, 1)
+
+########################################################################
+#### SignalPipeline
+#### Computes named indicators through the cache and maps them to target
+#### exposures with ``rule(indicators)``, ready for the backtest.
+####
+#### Usage:
+#### pipeline = SignalPipeline({'rsi': Indicator('RSI', timeperiod=14, warmup=200)},
+####                          lambda ind: threshold(ind['rsi'], 30, 70),
+####                          IndicatorCache(directory='.indicators'))
+#### exposures = pipeline.exposures('BTCUSD', {'close': prices})
+#### result = pipeline.backtest(position, 'BTCUSD', timestamps, {'close': prices})
+########################################################################
+
+
+class SignalPipeline(object):
+    def __init__(self, indicators, rule, cache=None):
+        self.indicators = OrderedDict(indicators)
+        self.rule = rule
+        self.cache = cache if cache is not None else IndicatorCache()
+
+    def indicator_values(self, symbol, data):
+        data = as_inputs(data)
+        digest = fingerprint(data)
+        return OrderedDict((name, self.cache.get(symbol, indicator, data, digest))
+                           for name, indicator in self.indicators.items())
+
+    def exposures(self, symbol, data):
+        exposures = np.asarray(self.rule(self.indicator_values(symbol, data)), dtype=float)
+        return np.clip(np.nan_to_num(exposures), -1, 1)
+
+    def backtest(self, position, symbol, timestamps, data, price='close', notes=""):
+        data = as_inputs(data)
+        exposures = self.exposures(symbol, data)
+        logger.info("signals", symbol=symbol, hits=self.cache.hits, tails=self.cache.tails, misses=self.cache.misses)
+        return backtest(position, timestamps, data[price], exposures, notes=notes)
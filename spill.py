@@ -0,0 +1,147 @@
+''' This spill module keeps position logs on disk in chunked, compressed HDF5 datasets
+
+'''
+from collections import OrderedDict
+import atexit
+import json
+import weakref
+import numpy as np
+import pandas as pd
+
+from .records import ColumnLog, FLOAT, CATEGORY, DATETIME, FLUSH_SIZE, is_array, to_datetime64
+
+########################################################################
+#### HDF5Log
+#### ColumnLog whose rows live in one resizable HDF5 dataset per field
+#### (float64, datetime64 as int64 nanoseconds, categories as int32 codes
+#### with the categories in a group attribute). Only the staged rows of
+#### the current block stay in memory and columns are read on demand, so
+#### memory does not grow with the length of the run. Opening an existing
+#### group replaces its rows unless ``resume`` is set. Staged rows are
+#### written by flush()/close(), when the log is garbage collected and at
+#### interpreter exit.
+####
+#### Usage:
+#### position.spill('backtest.h5', group='BTCUSD')
+#### position.close_logs()
+#### or
+#### log = HDF5Log(BALANCE_LOG_SCHEMA, 'backtest.h5', 'BTCUSD/balance_log')
+#### log.append(row)
+#### log.column('nav')
+#### log.close()
+#### HDF5Log(BALANCE_LOG_SCHEMA, 'backtest.h5', 'BTCUSD/balance_log', resume=True)
+########################################################################
+
+_open_logs = weakref.WeakSet()
+
+
+@atexit.register
+def _close_open_logs():
+    for log in list(_open_logs):
+        try:
+            log.close()
+        except Exception:
+            pass
+
+
+class HDF5Log(ColumnLog):
+    def __init__(self, schema, path, group, records=(), chunk_size=FLUSH_SIZE * 16, compression='gzip', resume=False):
+        import h5py
+        # Sets up the schema and the staging state, rows are written to the file instead of the buffers
+        super().__init__(schema, capacity=1)
+        self.path = path
+        self.file = h5py.File(path, 'a')
+        if not resume and group in self.file:
+            del self.file[group]
+        self.group = self.file.require_group(group)
+        for name, kind in self.schema:
+            if kind not in (FLOAT, CATEGORY, DATETIME):
+                raise TypeError('HDF5Log cannot store {} field {}'.format(kind, name))
+            dtype = {FLOAT: 'f8', CATEGORY: 'i4', DATETIME: 'i8'}[kind]
+            if name not in self.group:
+                self.group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                          chunks=(chunk_size,), compression=compression, shuffle=True)
+            if kind == CATEGORY:
+                self._categories[name] = json.loads(self.group.attrs.get('categories/' + name, '[]'))
+                self._codes[name] = {value: code for code, value in enumerate(self._categories[name])}
+        self._size = len(self.group[self.fields[0]])
+        _open_logs.add(self)
+        for record in records:
+            self.append(record)
+
+    def __repr__(self):
+        return 'HDF5Log(path={!r}, group={!r}, size={})'.format(self.path, self.group.name, len(self))
+
+    def _to_object(self, name):
+        raise TypeError('HDF5Log field {} only stores naive datetimes or None'.format(name))
+
+    def _extend(self, columns):
+        size = max([len(value) for value in columns.values() if is_array(value)] or [1])
+        start, end = self._size, self._size + size
+        for name in self.fields:
+            value = columns[name]
+            kind = self.kinds[name]
+            if kind == FLOAT:
+                data = np.broadcast_to(np.asarray(value, dtype=float), (size,))
+            elif kind == DATETIME:
+                data = to_datetime64(value)
+                if data is None:
+                    self._to_object(name)
+                data = np.broadcast_to(data.view(np.int64), (size,))
+            elif not is_array(value):
+                data = np.full(size, self._code(name, value), dtype=np.int32)
+            else:
+                data = self._encode(name, value)
+            dataset = self.group[name]
+            dataset.resize((end,))
+            dataset[start:end] = data
+        for name in self._categories:
+            self.group.attrs['categories/' + name] = json.dumps(self._categories[name])
+        self._size = end
+
+    def _read(self, name, start=0, end=None):
+        end = self._size if end is None else end
+        data = self.group[name][start:end]
+        if self.kinds[name] == DATETIME:
+            return data.view('M8[ns]')
+        return data
+
+    def column(self, name, start=0):
+        self._flush()
+        data = self._read(name, start)
+        if self.kinds[name] == CATEGORY:
+            return pd.Categorical.from_codes(data, categories=self._categories[name])
+        return data
+
+    def columns(self, start=0, end=None, copy=False):
+        ''' Rows read from disk, always new arrays '''
+        self._flush()
+        result = {}
+        for name in self.fields:
+            data = self._read(name, start, end)
+            if self.kinds[name] == CATEGORY:
+                data = self._decode(name, data)
+            result[name] = data
+        return result
+
+    def to_frame(self, index=None, start=0, copy=False):
+        return pd.DataFrame(OrderedDict((name, self.column(name, start)) for name in self.fields),
+                            index=index, columns=self.fields)
+
+    def flush(self):
+        ''' Writes the staged rows and flushes the file '''
+        self._flush()
+        self.file.flush()
+
+    def close(self):
+        if not self.file.id.valid:
+            return
+        self.flush()
+        self.file.close()
+        _open_logs.discard(self)
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
@@ -1,18 +1,26 @@
 from collections import OrderedDict
+import numbers
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from copy import copy
 
 ########################################################################
 #### Statistics
 #### Initilize with strategy config and dict of ``positions`` of trading pairs (from trade.py)
+#### equity, gav, balance_log and trade_profit are computed on first use and
+#### cached until any position records a new trade or end_date.
 ####
 #### Usage:
 #### stat = Statistics(config, positions)
-#### stat.calculate()
+#### stat.calculate() (optional, computes everything up front)
 #### stat.trade_summary()
+#### stat.trade_analytics()
 #### stat.nav_summary()
-#### stat.report()
+#### stat.symbol_summary()
+#### stat.rolling_metrics()
+#### stat.calendar_returns('monthly') / stat.periodic_returns('weekly', by_symbol=True)
+#### stat.bootstrap_trades() / stat.bootstrap_returns()
+#### stat.report('reports/') / stat.report('reports/', background=True)
 ########################################################################
 
 
@@ -20,19 +28,49 @@ class Statistics(object):
     def __init__(self, config, positions, fixed_cash=0):
         self.config = config
         self.positions = positions
-        self.balance_log = None
-        self.equity = None
-        self.trade_profit = None
         self.fixed_cash = fixed_cash
+        self._cache = {}
+
+    def version(self):
+        return (self.fixed_cash, tuple((s, p.log_version()) for s, p in self.positions.items()))
+
+    def cached(self, name, compute):
+        ''' Returns the cached ``name`` or computes it if any position changed since '''
+        version = self.version()
+        if name not in self._cache or self._cache[name][0] != version:
+            self._cache[name] = (version, compute())
+        return self._cache[name][1]
 
     def calculate(self):
+        return self.equity, self.gav, self.balance_log, self.trade_profit
+
+    def sum_balance(self, name):
         symbols = list(self.positions.keys())
-        self.equity = pd.concat([self.positions[s].get_balance_log()['nav'] for s in symbols], keys=symbols, axis=1).sum(axis=1) + self.fixed_cash
-        self.gav = pd.concat([self.positions[s].get_balance_log()['gav'] for s in symbols], keys=symbols, axis=1).sum(axis=1) + self.fixed_cash
-        self.balance_log = pd.concat([self.positions[s].get_balance_log() for s in symbols], keys=symbols, axis=1)
-        self.trade_profit = pd.concat([self.positions[s].get_trade_profit() for s in symbols], keys=symbols)
-        self.trade_profit.reset_index(inplace=True)
-        self.trade_profit = self.trade_profit.set_index('timestamp').sort_index()
+        return pd.concat([self.positions[s].get_balance_series(name) for s in symbols], keys=symbols, axis=1).sum(axis=1) + self.fixed_cash
+
+    @property
+    def equity(self):
+        return self.cached('equity', lambda: self.sum_balance('nav'))
+
+    @property
+    def gav(self):
+        return self.cached('gav', lambda: self.sum_balance('gav'))
+
+    @property
+    def balance_log(self):
+        def compute():
+            symbols = list(self.positions.keys())
+            return pd.concat([self.positions[s].get_balance_log() for s in symbols], keys=symbols, axis=1)
+        return self.cached('balance_log', compute)
+
+    @property
+    def trade_profit(self):
+        def compute():
+            symbols = list(self.positions.keys())
+            trade_profit = pd.concat([self.positions[s].get_trade_profit() for s in symbols], keys=symbols)
+            trade_profit.reset_index(inplace=True)
+            return trade_profit.set_index('timestamp').sort_index()
+        return self.cached('trade_profit', compute)
 
     def get_long_trades(self):
         return self.trade_profit[self.trade_profit['trade'] == 'LONG']
@@ -61,49 +99,123 @@ class Statistics(object):
         else:
             return pd.DataFrame([results], columns=results.keys()).T
 
+    def symbol_nav(self):
+        ''' nav of every symbol (bars x symbols) from the balance log, gaps are forward filled '''
+        return self.balance_log.xs('nav', axis=1, level=1).ffill().bfill()
+
+    def symbol_summary(self, rff=0.03):
+        ''' nav_summary metrics of every symbol in one vectorized pass '''
+        return matrix_metrics(self.symbol_nav(), rff=rff)
+
+    def rolling_metrics(self, windows=('30D', '90D', '365D'), rff=0.03, gross=False):
+        ''' Rolling return, volatility, Sharpe ratio and drawdown of the equity (or gav if ``gross``) '''
+        return rolling_metrics(self.gav if gross else self.equity, windows, rff)
+
+    def bootstrap_trades(self, **kwargs):
+        ''' Percentiles of max drawdown, CAGR and net profit over resampled trade sequences (see resample.py) '''
+        from .resample import bootstrap_trades
+        days = (self.config.end_time - self.config.start_time) / pd.Timedelta(days=1)
+        return bootstrap_trades(self.trade_profit, self.config.fund, days, **kwargs)
+
+    def bootstrap_returns(self, **kwargs):
+        ''' Percentiles of max drawdown, CAGR and Sharpe ratio over block-bootstrapped daily returns (see resample.py) '''
+        from .resample import bootstrap_returns
+        return bootstrap_returns(self.equity, **kwargs)
+
+    def symbol_navs(self):
+        ''' {symbol: (timestamps, nav)} columns of the balance logs, without copies for Position '''
+        return OrderedDict((symbol, (position.get_balance_series('timestamp').values, position.get_balance_series('nav').values))
+                           for symbol, position in self.positions.items())
+
+    def periodic_returns(self, freq='monthly', by_symbol=False):
+        ''' Returns of the portfolio over every period of ``freq`` (see periodic_returns),
+        or of every symbol and the portfolio (TOTAL column) if ``by_symbol``
+        '''
+        returns = self.cached(('periodic_returns', freq),
+                              lambda: periodic_returns(self.symbol_navs(), freq, self.fixed_cash))
+        return returns if by_symbol else returns[TOTAL]
+
+    def calendar_returns(self, freq='monthly', symbol=None):
+        ''' Calendar pivot of the returns of the portfolio, or of ``symbol`` '''
+        returns = self.periodic_returns(freq, by_symbol=True)
+        return calendar_table(returns[TOTAL if symbol is None else symbol])
+
     def monthly_return(self):
-        df = copy(self.equity.to_frame(name='returns'))
-        df['year'] = df.index.year
-        df['month'] = df.index.month
-        end_date_of_month = df.asfreq('BM').set_index(['year', 'month'])
-        first_date_of_month = df.asfreq('BMS').set_index(['year', 'month'])
-        pct = end_date_of_month.pct_change()
-        if pd.isna(pct['returns'][0]):
-            pct['returns'][0] = end_date_of_month['returns'][0] / first_date_of_month['returns'][0] - 1
-        return pct
+        ''' Monthly returns of the portfolio indexed by (year, month) '''
+        returns = self.periodic_returns('monthly').dropna()
+        index = pd.MultiIndex.from_arrays([returns.index.year, returns.index.month], names=['year', 'month'])
+        return pd.DataFrame({'returns': returns.values}, index=index)
 
     def trade_summary(self, raw=False):
         columns = ['All', 'Long', 'Short']
-        long_trades = self.get_long_trades()
-        short_trades = self.get_short_trades()
-        def cal_trades(trades):
-            winning_mask = trades['realized_pnl']>0
-            lossing_mask = trades['realized_pnl']<=0
-            return OrderedDict([
-                ["Total Trades", len(trades)],
-                ["Avg. Profit/Loss", trades['realized_gross_profit'].mean()],
-                ["Avg. Profit/Loss %", trades['realized_pnl'].mean()],
-                ["Winning Trades", winning_mask.sum()],
-                ["Winning Trades %", winning_mask.sum()/len(trades)*100],
-                ["Winning Trades Avg. Profit", trades[winning_mask]['realized_gross_profit'].mean()],
-                ["Winning Trades Avg. Profit %", trades[winning_mask]['realized_pnl'].mean()],
-                ["Lossing Trades", lossing_mask.sum()],
-                ["Lossing Trades %", lossing_mask.sum()/len(trades)*100],
-                ["Lossing Trades Avg. Profit", trades[lossing_mask]['realized_gross_profit'].mean()],
-                ["Lossing Trades Avg. Profit %", trades[lossing_mask]['realized_pnl'].mean()],
-            ])
-        results = [
-            cal_trades(self.trade_profit),
-            cal_trades(long_trades),
-            cal_trades(short_trades),
-        ]
+        trades = self.trade_profit
+        long_trades = (trades['trade'] == 'LONG').values
+        short_trades = (trades['trade'] == 'SHORT').values
+        n = len(trades)
+        codes = np.r_[np.zeros(n, dtype=np.intp), np.where(long_trades, 1, 2)]
+        keep = np.r_[np.ones(n, dtype=bool), long_trades | short_trades]
+        gross = np.tile(trades['realized_gross_profit'].values.astype(float), 2)[keep]
+        pnl = np.tile(trades['realized_pnl'].values.astype(float), 2)[keep]
+        summary = grouped_trade_metrics(gross, pnl, codes[keep], columns)
         if raw:
+            results = [OrderedDict((name, summary[name].values[i]) for name in TRADE_METRICS) for i in range(len(columns))]
+            for result in results:
+                result["Total Trades"] = int(result["Total Trades"])
             return results
         else:
-            return pd.DataFrame(results, index=columns, columns=results[0].keys()).T
+            return summary.T
 
-    def report(self):
-        pass
+    def trade_excursions(self):
+        ''' MAE and MFE (fractions of the entry price) of every trade_profit row, in its order '''
+        def compute():
+            found = positions_excursions(self.positions)
+            trades = self.trade_profit
+            offsets, start = {}, 0
+            for symbol, (mae, mfe) in found.items():
+                offsets[symbol] = start
+                start += len(mae)
+            rows = trades['level_0'].map(offsets).values.astype(np.intp) + trades['level_1'].values.astype(np.intp)
+            mae = np.concatenate([mae for mae, mfe in found.values()] or [[]])[rows]
+            mfe = np.concatenate([mfe for mae, mfe in found.values()] or [[]])[rows]
+            return pd.DataFrame({'mae': mae, 'mfe': mfe}, index=trades.index, columns=['mae', 'mfe'])
+        return self.cached('trade_excursions', compute)
+
+    def trade_analytics(self):
+        ''' trade_summary metrics and average MAE/MFE of All, Long, Short and every symbol (groups x metrics) '''
+        trades = self.trade_profit
+        symbols, names = pd.factorize(trades['level_0'])
+        sides = np.select([(trades['trade'] == 'LONG').values, (trades['trade'] == 'SHORT').values], [1, 2], -1)
+        n = len(trades)
+        codes = np.r_[np.zeros(n, dtype=np.intp), sides, symbols + 3]
+        keep = codes >= 0
+        excursion = self.trade_excursions()
+        def stacked(values):
+            return np.tile(np.asarray(values, dtype=float), 3)[keep]
+        return grouped_trade_metrics(
+            stacked(trades['realized_gross_profit']), stacked(trades['realized_pnl']), codes[keep],
+            ['All', 'Long', 'Short'] + list(names),
+            extra=OrderedDict([
+                ("Avg. MAE %", stacked(excursion['mae'])),
+                ("Avg. MFE %", stacked(excursion['mfe'])),
+            ]))
+
+    def report(self, directory='report', fmt='png', background=False, executor=None, **kwargs):
+        ''' Renders the equity, drawdown, monthly return and trade distribution charts into ``directory``
+        (see report.py), returns the file paths
+
+        With ``background`` the charts are drawn in a worker process (of ``executor`` if given)
+        and a Future of the paths is returned right after the data is collected.
+        '''
+        from .report import report_data, render_report
+        data = report_data(self)
+        if not background:
+            return render_report(data, directory, fmt, **kwargs)
+        if executor is not None:
+            return executor.submit(render_report, data, directory, fmt, **kwargs)
+        executor = ProcessPoolExecutor(1)
+        future = executor.submit(render_report, data, directory, fmt, **kwargs)
+        executor.shutdown(wait=False)
+        return future
 
 ########################################################################
 #### Metrics
@@ -143,3 +255,379 @@ def sharpe_ratio(ts, rff=0.03):
     ar = annualized_return(ts)
     #Sharpe ratio
     return (ar - rff)/(r.std()*np.sqrt(365))
+
+########################################################################
+#### Cross-sectional metrics
+#### Same metrics over a 2-D array or DataFrame of equity curves
+#### (bars x curves), computed for every column in one vectorized pass
+####
+#### Usage:
+#### matrix_metrics(df)  # one row per column of df
+########################################################################
+
+def _curves(curves):
+    ''' (values, index, columns) of a DataFrame or 2-D array of equity curves '''
+    if isinstance(curves, pd.DataFrame):
+        return curves.values.astype(float), curves.index, curves.columns
+    values = np.asarray(curves, dtype=float)
+    if values.ndim == 1:
+        values = values[:, None]
+    return values, None, pd.RangeIndex(values.shape[1])
+
+def drawdowns_matrix(values):
+    return 1 - values / np.maximum.accumulate(values, axis=0)
+
+def max_drawdown_matrix(values):
+    ''' Maximum drawdown of every column with the bar positions of its peak (start) and trough (end) '''
+    maximums = np.maximum.accumulate(values, axis=0)
+    dd = 1 - values / maximums
+    end = np.argmax(dd, axis=0)
+    # Position of the running maximum, i.e. the first bar reaching the peak
+    at_peak = np.ones(values.shape, dtype=bool)
+    at_peak[1:] = values[1:] > maximums[:-1]
+    peak_position = np.maximum.accumulate(np.where(at_peak, np.arange(len(values))[:, None], 0), axis=0)
+    columns = np.arange(values.shape[1])
+    return dd[end, columns], peak_position[end, columns], end
+
+def annualized_return_matrix(values, initial_fund=None):
+    if initial_fund is None:
+        initial_fund = values[0]
+    ar = (values[-1] - initial_fund) / initial_fund
+    return (1 + ar) ** (365 / len(values)) - 1
+
+def returns_matrix(values):
+    return values[1:] / values[:-1] - 1
+
+def sharpe_ratio_matrix(values, rff=0.03):
+    r = returns_matrix(values)
+    return (annualized_return_matrix(values) - rff) / (r.std(axis=0, ddof=1) * np.sqrt(365))
+
+def sortino_ratio_matrix(values, rff=0.03):
+    ''' Like sharpe_ratio_matrix with the downside deviation (root mean square of negative returns) '''
+    r = returns_matrix(values)
+    downside = np.sqrt(np.mean(np.minimum(r, 0) ** 2, axis=0))
+    return (annualized_return_matrix(values) - rff) / (downside * np.sqrt(365))
+
+def matrix_metrics(curves, rff=0.03, initial_fund=None):
+    ''' Per-curve metrics of a DataFrame or 2-D array of equity curves (bars x curves)
+
+    Drawdown start/end are index labels for a DataFrame (bar positions for arrays)
+    and the duration is their difference.
+    '''
+    values, index, columns = _curves(curves)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mdd, start, end = max_drawdown_matrix(values)
+        if index is not None:
+            start, end = index[start], index[end]
+        return pd.DataFrame(OrderedDict([
+            ["Maximum Drawdown %", mdd * 100],
+            ["Drawdown Start", start],
+            ["Drawdown End", end],
+            ["Drawdown Duration", end - start],
+            ["Annual Return %", annualized_return_matrix(values, initial_fund) * 100],
+            ["Sharpe Ratio", sharpe_ratio_matrix(values, rff)],
+            ["Sortino Ratio", sortino_ratio_matrix(values, rff)],
+        ]), index=columns)
+
+########################################################################
+#### Rolling metrics
+#### Rolling return, volatility, Sharpe ratio and drawdown of an equity
+#### series for several windows. Windows are pandas offsets ('30D') or
+#### numbers of bars. Sums over each window come from prefix sums and
+#### the window peak from pandas' rolling max (a monotonic deque), so
+#### every window is O(n).
+####
+#### Usage:
+#### rolling_metrics(equity, windows=('30D', '90D', '365D'))
+########################################################################
+
+def window_starts(index, window):
+    ''' Position of the first bar of the window ending at every bar, (t - window, t] for offsets '''
+    if isinstance(window, numbers.Integral):
+        return np.maximum(np.arange(len(index)) - window + 1, 0)
+    times = index.values
+    return np.searchsorted(times, times - pd.Timedelta(window).to_timedelta64(), side='right')
+
+def rolling_metrics(ts, windows=('30D', '90D', '365D'), rff=0.03):
+    ''' One column per (window, metric), aligned with ``ts``
+
+    return and sharpe follow annualized_return and sharpe_ratio over the bars
+    of the window, volatility is the annualized std of the bar returns and
+    drawdown is measured from the highest value within the window.
+    '''
+    values = ts.values.astype(float)
+    n = len(values)
+    r = np.r_[0, values[1:] / values[:-1] - 1]
+    # Prefix sums of returns centered on their mean to limit cancellation
+    centered = r - r[1:].mean() if n > 1 else r
+    centered[0] = 0
+    s1 = np.cumsum(centered)
+    s2 = np.cumsum(centered ** 2)
+    ends = np.arange(n)
+    results = OrderedDict()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for window in windows:
+            starts = window_starts(ts.index, window)
+            m = ends - starts  # returns in the window
+            total = s1 - s1[starts]
+            squares = s2 - s2[starts]
+            std = np.sqrt(np.maximum(squares - total ** 2 / m, 0) / (m - 1))
+            ar = (values / values[starts]) ** (365 / (m + 1)) - 1
+            volatility = std * np.sqrt(365)
+            peak = ts.rolling(window, min_periods=1).max().values
+            results[(window, 'return')] = ar
+            results[(window, 'volatility')] = volatility
+            results[(window, 'sharpe')] = (ar - rff) / volatility
+            results[(window, 'drawdown')] = 1 - values / peak
+    frame = pd.DataFrame(results, index=ts.index)
+    frame.columns = pd.MultiIndex.from_tuples(list(results.keys()))
+    return frame
+
+########################################################################
+#### Trade analytics
+#### trade_summary metrics of any number of trade groups (All, Long,
+#### Short, symbols) from one set of bincounts over group codes, and the
+#### maximum adverse / favorable excursion (MAE / MFE) of every realized
+#### trade. The window of a trade runs from the bar its position was
+#### opened to the bar it was closed; windows are found with searchsorted
+#### on the balance log and reduced with one np.minimum/maximum.reduceat
+#### over the prices of all positions.
+####
+#### Usage:
+#### grouped_trade_metrics(gross, pnl, codes, groups)
+#### position_excursions(position)
+########################################################################
+
+TRADE_METRICS = [
+    "Total Trades",
+    "Avg. Profit/Loss",
+    "Avg. Profit/Loss %",
+    "Winning Trades",
+    "Winning Trades %",
+    "Winning Trades Avg. Profit",
+    "Winning Trades Avg. Profit %",
+    "Lossing Trades",
+    "Lossing Trades %",
+    "Lossing Trades Avg. Profit",
+    "Lossing Trades Avg. Profit %",
+]
+
+def _group_mean(values, codes, mask, ngroups):
+    ''' Mean of ``values`` over the rows selected by ``mask`` in each group, NaN values are skipped '''
+    mask = mask & ~np.isnan(values)
+    counts = np.bincount(codes[mask], minlength=ngroups)
+    sums = np.bincount(codes[mask], weights=values[mask], minlength=ngroups)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def grouped_trade_metrics(gross, pnl, codes, groups, extra=None):
+    ''' TRADE_METRICS of every group (groups x metrics)
+
+    Args:
+        gross (array): realized_gross_profit of every row
+        pnl (array): realized_pnl of every row
+        codes (array): group position of every row, a trade is repeated once per group it belongs to
+        groups (list): group names
+        extra (dict): more {name: values} columns to average per group
+    '''
+    ngroups = len(groups)
+    codes = np.asarray(codes, dtype=np.intp)
+    every = np.ones(len(codes), dtype=bool)
+    winning = pnl > 0
+    lossing = pnl <= 0
+    total = np.bincount(codes, minlength=ngroups)
+    wins = np.bincount(codes, weights=winning, minlength=ngroups).astype(int)
+    losses = np.bincount(codes, weights=lossing, minlength=ngroups).astype(int)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        columns = OrderedDict(zip(TRADE_METRICS, [
+            total,
+            _group_mean(gross, codes, every, ngroups),
+            _group_mean(pnl, codes, every, ngroups),
+            wins,
+            wins / total * 100,
+            _group_mean(gross, codes, winning, ngroups),
+            _group_mean(pnl, codes, winning, ngroups),
+            losses,
+            losses / total * 100,
+            _group_mean(gross, codes, lossing, ngroups),
+            _group_mean(pnl, codes, lossing, ngroups),
+        ]))
+    for name, values in (extra or {}).items():
+        columns[name] = _group_mean(values, codes, every, ngroups)
+    return pd.DataFrame(columns, index=groups)
+
+def trade_windows(bar_times, bar_amounts, exit_times, islong):
+    ''' (open bar, exit bar) of every exit of a position, from its balance log '''
+    n = len(bar_times)
+    exit_bar = np.minimum(np.searchsorted(bar_times, exit_times, side='left'), n - 1)
+    sides = np.sign(bar_amounts)
+    change = np.r_[True, sides[1:] != sides[:-1]]
+    run_start = np.maximum.accumulate(np.where(change, np.arange(n), 0))
+    before = np.maximum(exit_bar - 1, 0)
+    # Held during the bar before the exit: the trade opened with that run, otherwise within the exit bar
+    held = (exit_bar > 0) & (sides[before] == np.where(islong, 1, -1))
+    return np.where(held, run_start[before], exit_bar), exit_bar
+
+def window_extremes(values, starts, ends):
+    ''' Minimum and maximum of ``values[start:end + 1]`` for every window '''
+    if len(starts) == 0:
+        return np.empty(0), np.empty(0)
+    padded = np.r_[values, values[-1]]
+    bounds = np.column_stack([starts, ends + 1]).ravel()
+    return np.minimum.reduceat(padded, bounds)[::2], np.maximum.reduceat(padded, bounds)[::2]
+
+def excursions(lowest, highest, enter_price, islong):
+    ''' MAE and MFE as fractions of the entry price (both >= 0) '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mae = np.where(islong, (enter_price - lowest) / enter_price, (highest - enter_price) / enter_price)
+        mfe = np.where(islong, (highest - enter_price) / enter_price, (enter_price - lowest) / enter_price)
+    return np.maximum(mae, 0), np.maximum(mfe, 0)
+
+def positions_excursions(positions):
+    ''' MAE and MFE of the trade_profit rows of every position, {symbol: (mae, mfe)} '''
+    prices, starts, ends, enter, islong, sizes = [], [], [], [], [], []
+    offset = 0
+    for symbol, position in positions.items():
+        bar_times = position.get_balance_series('timestamp').values
+        trade_profit = position.get_trade_profit()
+        exit_times = trade_profit['timestamp'].values
+        long_trades = np.asarray(trade_profit['trade']) == 'LONG'
+        if len(bar_times) == 0 or bar_times.dtype.kind != 'M' or exit_times.dtype.kind != 'M':
+            # Without timestamped bars the windows are unknown
+            sizes.append((symbol, len(exit_times), False))
+            continue
+        start, end = trade_windows(bar_times, position.get_balance_series('amount').values, exit_times, long_trades)
+        prices.append(position.get_balance_series('price').values)
+        starts.append(start + offset)
+        ends.append(end + offset)
+        enter.append(trade_profit['enter_price'].values)
+        islong.append(long_trades)
+        sizes.append((symbol, len(exit_times), True))
+        offset += len(bar_times)
+    values = np.concatenate(prices) if prices else np.empty(0)
+    lowest, highest = window_extremes(values, np.concatenate(starts or [[]]).astype(np.intp),
+                                      np.concatenate(ends or [[]]).astype(np.intp))
+    mae, mfe = excursions(lowest, highest, np.concatenate(enter or [[]]), np.concatenate(islong or [[]]).astype(bool))
+    results, i = OrderedDict(), 0
+    for symbol, size, known in sizes:
+        if known:
+            results[symbol] = (mae[i:i + size], mfe[i:i + size])
+            i += size
+        else:
+            results[symbol] = (np.full(size, np.nan), np.full(size, np.nan))
+    return results
+
+########################################################################
+#### Periodic returns
+#### Returns over calendar periods (days, weeks, months, quarters, years
+#### or any pandas period alias) of each nav series and of their total.
+#### The last bar of every period is found with one searchsorted over
+#### the period boundaries, so only the period closes are read from the
+#### balance logs. Offsets without a period equivalent ('BM', '30D')
+#### fall back to one pandas resample per series. A period without bars
+#### is NaN and the next return is taken against the last close before
+#### it; the first period is measured against the first bar.
+####
+#### Usage:
+#### periodic_returns({'BTCUSD': (timestamps, navs)}, 'monthly')
+#### calendar_table(returns['Total'])
+########################################################################
+
+PERIODS = {'daily': 'D', 'weekly': 'W', 'monthly': 'M', 'quarterly': 'Q', 'yearly': 'A'}
+TOTAL = 'Total'
+
+def period_bounds(start, end, freq):
+    ''' Periods of ``freq`` from ``start`` to ``end`` and their start times, followed by the end of the last one '''
+    periods = pd.period_range(pd.Timestamp(start).to_period(freq), pd.Timestamp(end).to_period(freq), freq=freq)
+    bounds = np.r_[periods.to_timestamp(how='start').values, (periods[-1:] + 1).to_timestamp(how='start').values]
+    return periods, bounds
+
+def last_bars(timestamps, bounds):
+    ''' Index of the last bar of every period, -1 if the period has no bar '''
+    firsts = np.searchsorted(timestamps, bounds[:-1], side='left')
+    lasts = np.searchsorted(timestamps, bounds[1:], side='left') - 1
+    return np.where(lasts >= firsts, lasts, -1)
+
+def _forward_fill(closes, initial):
+    ''' ``closes`` (periods x series) with NaN rows replaced by the previous close, ``initial`` before the first '''
+    rows = np.where(np.isnan(closes), -1, np.arange(len(closes))[:, None])
+    rows = np.maximum.accumulate(rows, axis=0)
+    filled = np.take_along_axis(closes, np.maximum(rows, 0), axis=0)
+    return np.where(rows >= 0, filled, initial[None, :])
+
+def period_closes(navs, freq):
+    ''' Last value of every series in every period (periods x series) and the period labels '''
+    names = list(navs)
+    start = min(timestamps[0] for timestamps, values in navs.values() if len(timestamps))
+    end = max(timestamps[-1] for timestamps, values in navs.values() if len(timestamps))
+    try:
+        index, bounds = period_bounds(start, end, freq)
+    except (ValueError, AttributeError):
+        index, bounds = None, None
+    if index is None:
+        closes = pd.concat([pd.Series(values, index=pd.DatetimeIndex(timestamps)).resample(freq).last()
+                            for timestamps, values in navs.values()], axis=1)
+        return closes.values.astype(float), closes.index
+    closes = np.full((len(index), len(names)), np.nan)
+    for i, (timestamps, values) in enumerate(navs.values()):
+        if len(timestamps):
+            bars = last_bars(np.asarray(timestamps, dtype='M8[ns]'), bounds.astype('M8[ns]'))
+            closes[bars >= 0, i] = np.asarray(values, dtype=float)[bars[bars >= 0]]
+    return closes, index
+
+def chained_returns(closes, initial):
+    ''' Return of every non-NaN close against the previous one (the first against ``initial``) '''
+    previous = np.r_[initial[None, :], _forward_fill(closes, initial)[:-1]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return closes / previous - 1
+
+def periodic_returns(navs, freq='monthly', fixed_cash=0, total=True):
+    ''' Returns of every nav series over each period of ``freq`` (periods x series)
+
+    Args:
+        navs (dict): {name: (timestamps, values)} sorted by timestamp, as the balance_log columns
+        freq (str): key of PERIODS, a pandas period alias ('W', '2M') or any pandas offset
+        fixed_cash (float): cash added to the total
+        total (bool): add a TOTAL column, the return of the summed navs where a series
+            without a bar in the period keeps its last nav (or its first one before it starts)
+    '''
+    navs = OrderedDict((name, (timestamps, values)) for name, (timestamps, values) in navs.items())
+    freq = PERIODS.get(freq, freq)
+    closes, index = period_closes(navs, freq)
+    initial = np.array([values[0] if len(values) else np.nan for timestamps, values in navs.values()], dtype=float)
+    returns = pd.DataFrame(chained_returns(closes, initial), index=index, columns=list(navs))
+    if total:
+        # Periods where no series has a bar have no total close either
+        summed = np.nansum(_forward_fill(closes, initial), axis=1) + fixed_cash
+        summed[np.isnan(closes).all(axis=1)] = np.nan
+        returns[TOTAL] = chained_returns(summed[:, None], np.array([np.nansum(initial) + fixed_cash]))[:, 0]
+    return returns
+
+CALENDARS = {
+    'D': (lambda times: [times.year, times.month], lambda times: times.day),
+    'W': (lambda times: [times.year], lambda times: (times.dayofyear - 1) // 7 + 1),
+    'M': (lambda times: [times.year], lambda times: times.month),
+    'Q': (lambda times: [times.year], lambda times: times.quarter),
+    'A': (lambda times: [times.year], None),
+    'Y': (lambda times: [times.year], None),
+}
+
+def calendar_table(returns):
+    ''' Calendar pivot of period returns: years x months (quarters, weeks), or (year, month) x days,
+    with the returns of each row compounded in TOTAL
+    '''
+    index = returns.index
+    code = index.freqstr if isinstance(index, pd.PeriodIndex) else (index.freqstr or '')
+    # Multiples ('2M', '30D') span more than one calendar cell
+    if code[:1].isdigit() or code[:1] not in CALENDARS:
+        raise ValueError('no calendar layout for {!r} periods'.format(index.freqstr))
+    times = index.to_timestamp(how='end') if isinstance(index, pd.PeriodIndex) else index
+    rows, columns = CALENDARS[code[:1]]
+    keys = rows(times)
+    names = ['year', 'month'][:len(keys)]
+    values = pd.Series(np.asarray(returns, dtype=float), index=pd.MultiIndex.from_arrays(
+        keys + [columns(times) if columns is not None else np.zeros(len(times), dtype=int)], names=names + ['period']))
+    table = values.unstack('period') if columns is not None else pd.DataFrame(index=values.index.droplevel('period'))
+    table[TOTAL] = (1 + values.fillna(0)).groupby(level=names).prod() - 1
+    table.columns.name = None
+    return table
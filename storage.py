@@ -0,0 +1,433 @@
+''' This storage module persists portfolios as state snapshots plus append-only log segments
+
+'''
+from concurrent.futures import ThreadPoolExecutor
+import pickle
+import sqlite3
+import threading
+import time
+
+from .trade import Position, LOG_SCHEMAS
+from .online import OnlineMetrics
+
+import structlog
+logger = structlog.getLogger()
+
+########################################################################
+#### Storage backends
+#### Key/value stores of picklable values. Implementations only need
+#### get, put and delete, the multi variants can be overridden to batch
+#### calls.
+########################################################################
+
+
+class StorageBackend(object):
+    def get(self, key):
+        raise NotImplementedError
+
+    def put(self, key, value):
+        raise NotImplementedError
+
+    def get_multi(self, keys):
+        return [self.get(key) for key in keys]
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def put_multi(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.delete(key)
+
+
+class MemoryBackend(StorageBackend):
+    ''' In-memory fake, ``latency`` (seconds) is added to every call and ``failures`` keys raise IOError '''
+    def __init__(self, latency=0, failures=()):
+        self.data = {}
+        self.latency = latency
+        self.failures = set(failures)
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def _call(self, keys):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        failed = self.failures.intersection(keys)
+        if failed:
+            raise IOError('storage failure for {}'.format(sorted(failed)))
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def put(self, key, value):
+        self.put_multi([(key, value)])
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        self._call(keys)
+        with self.lock:
+            return [pickle.loads(self.data[key]) if key in self.data else None for key in keys]
+
+    def put_multi(self, items):
+        items = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in items]
+        self._call([key for key, value in items])
+        with self.lock:
+            self.data.update(items)
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        keys = list(keys)
+        self._call(keys)
+        with self.lock:
+            for key in keys:
+                self.data.pop(key, None)
+
+
+class SQLiteBackend(StorageBackend):
+    ''' Local backend storing pickled values in a single SQLite table '''
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS store (key TEXT PRIMARY KEY, value BLOB)')
+        self.connection.commit()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def put(self, key, value):
+        self.put_multi([(key, value)])
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            with self.lock:
+                rows = self.connection.execute(
+                    'SELECT key, value FROM store WHERE key IN ({})'.format(','.join('?' * len(chunk))), chunk).fetchall()
+            found.update((key, pickle.loads(value)) for key, value in rows)
+        return [found.get(key) for key in keys]
+
+    def put_multi(self, items):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO store (key, value) VALUES (?, ?)',
+                                        [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in items])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM store WHERE key = ?', [(key,) for key in keys])
+
+
+class DatastoreBackend(StorageBackend):
+    ''' Google Cloud Datastore backend, one unindexed pickled blob per entity, or with ``properties``
+    dict values stored as entity properties (the format of Portfolio.save, kind 'Positions')
+
+    Multi calls are split to the Datastore limits of MAX_PUT entities per commit
+    and MAX_GET keys per lookup.
+    '''
+    MAX_PUT = 500
+    MAX_GET = 1000
+
+    def __init__(self, client, kind='PortfolioStore', properties=False):
+        from google.cloud import datastore
+        self.datastore = datastore
+        self.client = client
+        self.kind = kind
+        self.properties = properties
+
+    def _entity(self, key, value):
+        if self.properties:
+            entity = self.datastore.Entity(key=self.client.key(self.kind, key))
+            entity.update(value)
+        else:
+            entity = self.datastore.Entity(key=self.client.key(self.kind, key), exclude_from_indexes=('value',))
+            entity['value'] = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        return entity
+
+    def _value(self, entity):
+        return dict(entity) if self.properties else pickle.loads(entity['value'])
+
+    def get_multi(self, keys):
+        keys = list(keys)
+        found = {}
+        for i in range(0, len(keys), self.MAX_GET):
+            entities = self.client.get_multi([self.client.key(self.kind, key) for key in keys[i:i + self.MAX_GET]])
+            found.update((entity.key.id_or_name, self._value(entity)) for entity in entities)
+        return [found.get(key) for key in keys]
+
+    def get(self, key):
+        return self.get_multi([key])[0]
+
+    def put_multi(self, items):
+        entities = [self._entity(key, value) for key, value in items]
+        for i in range(0, len(entities), self.MAX_PUT):
+            self.client.put_multi(entities[i:i + self.MAX_PUT])
+
+    def put(self, key, value):
+        self.put_multi([(key, value)])
+
+    def delete_multi(self, keys):
+        keys = [self.client.key(self.kind, key) for key in keys]
+        for i in range(0, len(keys), self.MAX_PUT):
+            self.client.delete_multi(keys[i:i + self.MAX_PUT])
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+########################################################################
+#### DeltaStore
+#### Saves a small snapshot (fund, fee, inventory, exposure, ...) of every
+#### position and only the log rows added since the previous save, as
+#### new segments of at most ``segment_rows`` rows (so no value outgrows
+#### a backend's entity size limit). Segments are written before the
+#### snapshot that lists them, so an interrupted save leaves the previous
+#### snapshot valid; compact() merges small segments and deletes the ones
+#### it replaced after the new snapshot is written. A store that saves
+#### before any load() writes every log in full and reads the stored
+#### snapshot first, so the segments of the previous one are deleted.
+####
+#### Usage:
+#### store = DeltaStore(SQLiteBackend('portfolio.db'), 'strategy-1')
+#### store.save(portfolio)
+#### store.write(store.prepare(portfolio)) # prepare and write in different threads
+#### store.load(portfolio)
+########################################################################
+
+LOGS = list(LOG_SCHEMAS)
+
+
+class DeltaStore(object):
+    def __init__(self, backend, key, segment_rows=10000):
+        self.backend = backend
+        self.key = key
+        self.segment_rows = segment_rows
+        self.segments = {}
+        # Whether self.segments is what the stored snapshot lists
+        self.synced = False
+
+    def segment_key(self, symbol, log, start):
+        return '{}/{}/{}/{}'.format(self.key, symbol, log, start)
+
+    @staticmethod
+    def log_length(pos, log):
+        return len(getattr(pos, log))
+
+    @staticmethod
+    def log_slice(pos, log, start, end):
+        return getattr(pos, log).columns(start, end)
+
+    def snapshot(self, portfolio, segments=None):
+        segments = self.segments if segments is None else segments
+        positions = {}
+        for symbol, pos in portfolio.positions.items():
+            positions[symbol] = {
+                'state': pos.dict(exclude=set(LOGS) | {'timestamp_log'}),
+                'segments': segments.get(symbol, {}),
+            }
+        return {
+            'symbols': list(portfolio.symbols),
+            'fund': portfolio.fund,
+            'allocations': dict(portfolio.allocations),
+            'metrics': portfolio.metrics.dict(),
+            'positions': positions,
+        }
+
+    def save(self, portfolio, compact=False):
+        ''' Writes the rows added since the last save and the new snapshot
+
+        With ``compact`` every log is rewritten in full segments of ``segment_rows``
+        and the segments this replaces are deleted.
+        '''
+        return self.write(self.prepare(portfolio, compact))
+
+    def prepare(self, portfolio, compact=False):
+        ''' Copies the new log rows and the snapshot of a save without writing anything,
+        so ``portfolio`` can keep trading while write() runs elsewhere
+        '''
+        items = []
+        segments = {}
+        for symbol, pos in portfolio.positions.items():
+            segments[symbol] = {}
+            for log in LOGS:
+                done = [] if compact else list(self.segments.get(symbol, {}).get(log, []))
+                start = done[-1][1] if done else 0
+                end = self.log_length(pos, log)
+                for first in range(start, end, self.segment_rows):
+                    last = min(first + self.segment_rows, end)
+                    items.append((self.segment_key(symbol, log, first), self.log_slice(pos, log, first, last)))
+                    done.append((first, last))
+                segments[symbol][log] = done
+        return items, segments, self.snapshot(portfolio, segments)
+
+    def write(self, prepared):
+        ''' Writes the segments then the snapshot of prepare() and deletes the stale segments '''
+        items, segments, snapshot = prepared
+        stored = self.segments if self.synced else self.stored_segments()
+        self.backend.put_multi(items)
+        self.backend.put(self.key, snapshot)
+        self.segments = segments
+        self.synced = True
+        stale = set(self.segment_keys(stored)) - set(self.segment_keys(segments))
+        if stale:
+            self.backend.delete_multi(sorted(stale))
+        logger.info("save", key=self.key, segments=len(items), deleted=len(stale))
+        return len(items)
+
+    def stored_segments(self):
+        ''' Segments listed by the stored snapshot '''
+        snapshot = self.backend.get(self.key)
+        if snapshot is None:
+            return {}
+        return {symbol: pos['segments'] for symbol, pos in snapshot['positions'].items()}
+
+    def segment_keys(self, segments):
+        return [self.segment_key(symbol, log, start)
+                for symbol, logs in segments.items() for log, done in logs.items() for start, end in done]
+
+    def load(self, portfolio):
+        ''' Restores ``portfolio`` from its snapshot and log segments, returns False if nothing is stored '''
+        snapshot = self.backend.get(self.key)
+        if snapshot is None:
+            return False
+        keys = []
+        for symbol, pos in snapshot['positions'].items():
+            for log, done in pos['segments'].items():
+                keys.extend(self.segment_key(symbol, log, start) for start, end in done)
+        values = dict(zip(keys, self.backend.get_multi(keys)))
+        positions = {}
+        for symbol, pos in snapshot['positions'].items():
+            position = Position(**pos['state'])
+            for log, done in pos['segments'].items():
+                for start, end in done:
+                    # A segment may hold more rows than listed if a later save was interrupted
+                    value = values[self.segment_key(symbol, log, start)]
+                    getattr(position, log).extend({name: column[:end - start] for name, column in value.items()})
+            positions[symbol] = position
+        portfolio.symbols = snapshot['symbols']
+        portfolio.fund = snapshot['fund']
+        portfolio.allocations = snapshot['allocations']
+        portfolio.metrics = OnlineMetrics(**snapshot['metrics'])
+        portfolio.positions = positions
+        self.segments = {symbol: pos['segments'] for symbol, pos in snapshot['positions'].items()}
+        self.synced = True
+        logger.info("load", key=self.key, segments=len(keys))
+        return True
+
+    def compact(self, portfolio):
+        ''' Rewrites every log in full segments and deletes the segments replaced '''
+        return self.save(portfolio, compact=True)
+
+########################################################################
+#### PortfolioManager
+#### Loads and saves many portfolios (in the Portfolio.serialize format)
+#### with multi-get/multi-put batches run on a bounded thread pool over
+#### one shared backend. A failed batch is retried key by key so a
+#### failure only affects the portfolios it belongs to. Portfolios are
+#### stored under their registered name (``kind``/name, or the name alone
+#### with kind=None). The entities of Portfolio.save (kind 'Positions',
+#### keyed by name) are read and written with a properties backend.
+####
+#### Usage:
+#### manager = PortfolioManager(DatastoreBackend(client, 'Positions', properties=True), kind=None, max_workers=8)
+#### manager.register('strategy-1', portfolio)
+#### manager.load_all()
+#### manager.save_all()
+########################################################################
+
+
+class PortfolioManager(object):
+    def __init__(self, backend, portfolios=None, max_workers=8, batch_size=500, kind='Positions'):
+        self.backend = backend
+        self.portfolios = dict(portfolios or {})
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+        self.kind = kind
+
+    def register(self, name, portfolio):
+        self.portfolios[name] = portfolio
+
+    def key(self, name):
+        ''' Storage key of the portfolio registered as ``name``, unique per name '''
+        return name if self.kind is None else '{}/{}'.format(self.kind, name)
+
+    def _batches(self, names):
+        names = list(self.portfolios) if names is None else list(names)
+        return [names[i:i + self.batch_size] for i in range(0, len(names), self.batch_size)]
+
+    def _run(self, task, batches):
+        ''' Runs ``task`` on every batch in the pool, returns the merged {name: outcome} '''
+        outcomes = {}
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for result in executor.map(task, batches):
+                outcomes.update(result)
+        return outcomes
+
+    def _get_batch(self, names):
+        keys = [self.key(name) for name in names]
+        try:
+            values = self.backend.get_multi(keys)
+        except Exception:
+            values = []
+            for key in keys:
+                try:
+                    values.append(self.backend.get(key))
+                except Exception as e:
+                    values.append(e)
+        outcomes = {}
+        for name, value in zip(names, values):
+            if isinstance(value, Exception):
+                outcomes[name] = value
+            elif value is None:
+                outcomes[name] = False
+            else:
+                try:
+                    self.portfolios[name].restore(value)
+                    outcomes[name] = True
+                except Exception as e:
+                    outcomes[name] = e
+        return outcomes
+
+    def _put_batch(self, names):
+        outcomes = {}
+        items = []
+        for name in names:
+            portfolio = self.portfolios[name]
+            try:
+                items.append((name, self.key(name), type(portfolio).serialize(portfolio)))
+            except Exception as e:
+                outcomes[name] = e
+        try:
+            self.backend.put_multi([(key, value) for name, key, value in items])
+            outcomes.update((name, True) for name, key, value in items)
+        except Exception:
+            for name, key, value in items:
+                try:
+                    self.backend.put(key, value)
+                    outcomes[name] = True
+                except Exception as e:
+                    outcomes[name] = e
+        return outcomes
+
+    def load_all(self, names=None):
+        ''' Returns {name: True if loaded, False if not stored, or the exception raised} '''
+        outcomes = self._run(self._get_batch, self._batches(names))
+        logger.info("load_all", loaded=sum(o is True for o in outcomes.values()),
+                    failed=[name for name, o in outcomes.items() if isinstance(o, Exception)])
+        return outcomes
+
+    def save_all(self, names=None):
+        ''' Returns {name: True if saved or the exception raised} '''
+        outcomes = self._run(self._put_batch, self._batches(names))
+        logger.info("save_all", saved=sum(o is True for o in outcomes.values()),
+                    failed=[name for name, o in outcomes.items() if isinstance(o, Exception)])
+        return outcomes
@@ -0,0 +1,123 @@
+''' This sweep module runs parameter grid searches across processes
+
+'''
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from .trade import Position
+from .backtest import backtest
+from .statistics import Statistics
+
+########################################################################
+#### Sweep
+#### Price series are written once to memory-mapped files which every
+#### worker maps read-only; only the parameters of each run are sent to
+#### the workers and only the raw summaries are sent back.
+####
+#### ``strategy(prices, **params)`` must be a module level function
+#### returning the target exposure of every bar.
+####
+#### Usage:
+#### results = sweep(strategy, [{'window': 10}, {'window': 20}], config,
+####                 timestamps, {'BTCUSD': prices}, fund=10000)
+#### for params, nav_summary, trade_summary in results: ...
+########################################################################
+
+
+class SharedArray(object):
+    ''' Read-only array backed by a memory-mapped file, cheap to pickle '''
+    def __init__(self, path, dtype, shape):
+        self.path = path
+        self.dtype = dtype
+        self.shape = shape
+
+    @classmethod
+    def create(cls, array, path):
+        array = np.ascontiguousarray(array)
+        mm = np.memmap(path, dtype=array.dtype, mode='w+', shape=array.shape)
+        mm[:] = array
+        mm.flush()
+        return cls(path, array.dtype.str, array.shape)
+
+    def open(self):
+        return np.memmap(self.path, dtype=np.dtype(self.dtype), mode='r', shape=self.shape)
+
+
+_shared = {}
+
+def _init_worker(timestamps, prices):
+    _shared['timestamps'] = pd.Index(timestamps.open())
+    _shared['prices'] = {symbol: array.open() for symbol, array in prices.items()}
+
+def _run_chunk(strategy, chunk, config, fund, allocations, commision):
+    timestamps = _shared['timestamps']
+    results = []
+    for params in chunk:
+        positions = {}
+        for symbol, prices in _shared['prices'].items():
+            position = Position(fund=fund * allocations[symbol])
+            if commision is not None:
+                position.set_commision(commision.copy())
+            backtest(position, timestamps, prices, strategy(prices, **params))
+            positions[symbol] = position
+        stat = Statistics(config, positions)
+        results.append((params, stat.nav_summary(raw=True), stat.trade_summary(raw=True)))
+    return results
+
+
+def sweep(strategy, params, config, timestamps, prices, fund, allocations=None, commision=None,
+          processes=None, chunksize=1, progress=None):
+    ''' Backtest ``strategy`` once per parameter set
+
+    Args:
+        strategy (callable): ``strategy(prices, **params)`` returns the exposures of a symbol
+        params (list): parameter dicts, one run each
+        config: strategy config used by Statistics (fund, start_time, end_time)
+        timestamps (array-like): timestamps shared by every symbol
+        prices (dict): price array of each symbol
+        fund (float): total fund of each run
+        allocations (dict): fraction of the fund of each symbol (equal weights by default)
+        commision (Commission): commission of every position (Position default if None)
+        processes (int): number of worker processes (os.cpu_count() if None, 1 runs in-process)
+        chunksize (int): number of parameter sets sent to a worker at once
+        progress (callable): called as ``progress(done, total)`` when a chunk completes
+
+    Returns:
+        list: ``(params, nav_summary, trade_summary)`` in the order of ``params``
+    '''
+    params = list(params)
+    if allocations is None:
+        allocations = {symbol: 1 / len(prices) for symbol in prices}
+    timestamps = np.asarray(pd.Index(timestamps))
+    if timestamps.dtype == object:
+        raise ValueError('timestamps must be datetime or numeric')
+    chunks = [params[i:i + chunksize] for i in range(0, len(params), chunksize)]
+    results = [None] * len(chunks)
+    directory = tempfile.mkdtemp(prefix='portfolio-sweep-')
+    try:
+        shared_timestamps = SharedArray.create(timestamps, os.path.join(directory, 'timestamps'))
+        shared_prices = {symbol: SharedArray.create(np.asarray(values, dtype=float), os.path.join(directory, str(i)))
+                         for i, (symbol, values) in enumerate(prices.items())}
+        if processes == 1:
+            _init_worker(shared_timestamps, shared_prices)
+            for i, chunk in enumerate(chunks):
+                results[i] = _run_chunk(strategy, chunk, config, fund, allocations, commision)
+                if progress is not None:
+                    progress(i + 1, len(chunks))
+            _shared.clear()
+        else:
+            with ProcessPoolExecutor(processes, initializer=_init_worker,
+                                     initargs=(shared_timestamps, shared_prices)) as executor:
+                futures = {executor.submit(_run_chunk, strategy, chunk, config, fund, allocations, commision): i
+                           for i, chunk in enumerate(chunks)}
+                for done, future in enumerate(as_completed(futures), 1):
+                    results[futures[future]] = future.result()
+                    if progress is not None:
+                        progress(done, len(chunks))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return [result for chunk in results for result in chunk]
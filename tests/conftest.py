@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+
+# Target exposures the markets pick from, flips and partial exits included
+LEVELS = (-1, -0.5, -0.2, 0, 0.3, 0.5, 1)
+
+# Commission.from_dict values, built per test so the modules below import lazily
+COMMISSIONS = [
+    {'model': 'TradePercentage', 'percentage': 0.001},
+    {'model': 'FixedPlusPercentage', 'fixed': 1, 'percentage': 0.0005},
+    {'model': 'MakerTaker', 'maker': -0.0001, 'taker': 0.0007},
+    {'model': 'MinimumFee', 'base': {'model': 'TradePercentage', 'percentage': 0.001}, 'minimum': 0.5},
+    # Tiers small enough that a run crosses both boundaries
+    {'model': 'TieredVolume', 'tiers': [(0, 0.001), (1e4, 0.0008), (1e5, 0.0005)]},
+    {'model': 'MinimumFee', 'base': {'model': 'TieredVolume', 'tiers': [(0, 0.002), (5e4, 0.001)]}, 'minimum': 0.05},
+]
+
+
+def commission_id(value):
+    return value['model'] if value['model'] != 'MinimumFee' else 'MinimumFee-' + value['base']['model']
+
+
+def make_market(bars, hold=1, seed=0, volatility=0.01, levels=LEVELS):
+    ''' Hourly random-walk prices and target exposures, each held for ``hold`` bars '''
+    rng = np.random.RandomState(seed)
+    timestamps = pd.date_range('2020', periods=bars, freq='H')
+    prices = 100 * np.exp(np.cumsum(rng.normal(0, volatility, bars)))
+    exposures = np.repeat(rng.choice(levels, -(-bars // hold)), hold)[:bars]
+    return timestamps, prices, exposures
+
+
+def make_config(timestamps, fund=10000.0):
+    return SimpleNamespace(fund=fund, start_time=timestamps[0], end_time=timestamps[-1])
+
+
+@pytest.fixture
+def market():
+    return make_market
+
+
+@pytest.fixture
+def config():
+    return make_config
+
+
+@pytest.fixture(params=COMMISSIONS, ids=commission_id)
+def commision(request):
+    from portfolio.trade import Commission
+    return Commission.from_dict(request.param)
+
+
+@pytest.fixture
+def commissions():
+    from portfolio.trade import Commission
+    return [Commission.from_dict(value) for value in COMMISSIONS]
+
+
+@pytest.fixture
+def statistics():
+    ''' Builds Statistics over ``symbols`` backtested random markets sharing one fund '''
+    from portfolio.trade import Position
+    from portfolio.backtest import backtest
+    from portfolio.statistics import Statistics
+
+    def build(bars=3000, symbols=3, hold=9, seed=0):
+        positions = OrderedDict()
+        for i in range(symbols):
+            timestamps, prices, exposures = make_market(bars, hold, seed=seed + i)
+            positions['S{}'.format(i)] = Position(fund=10000.0 / symbols)
+            backtest(positions['S{}'.format(i)], timestamps, prices, exposures)
+        return Statistics(make_config(timestamps), positions)
+    return build
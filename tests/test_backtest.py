@@ -0,0 +1,79 @@
+import itertools
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pydantic')
+
+from portfolio.trade import Position, TradePercentage
+from portfolio.backtest import backtest
+
+
+def per_bar(position, timestamps, prices, exposures, notes=""):
+    for timestamp, price, exposure in zip(timestamps, prices, exposures):
+        position.allocate(exposure, price, timestamp=timestamp, notes=notes)
+        position.end_date(timestamp, price)
+
+
+@pytest.mark.parametrize('hold', [1, 3, 50])
+def test_backtest_equals_the_per_bar_loop(market, commision, hold):
+    timestamps, prices, exposures = market(3000, hold)
+    expected = Position(fund=1e4, commision=commision.copy())
+    per_bar(expected, timestamps, prices, exposures)
+    position = Position(fund=1e4, commision=commision.copy())
+    result = backtest(position, timestamps, prices, exposures)
+    assert position == expected
+    assert position.commision == expected.commision
+    pd.testing.assert_frame_equal(result.get_trade_log(), expected.get_trade_log())
+    pd.testing.assert_frame_equal(result.get_trade_profit(), expected.get_trade_profit())
+
+
+def test_backtest_in_chunks_with_none_notes(market):
+    timestamps, prices, exposures = market(2000, 2, seed=1)
+    expected = Position(fund=1e4, commision=TradePercentage(0.001))
+    per_bar(expected, timestamps, prices, exposures, notes=None)
+    position = Position(fund=1e4, commision=TradePercentage(0.001))
+    for start in range(0, 2000, 300):
+        end = start + 300
+        backtest(position, timestamps[start:end], prices[start:end], exposures[start:end], notes=None)
+    assert position == expected
+
+
+# Flips, partial exits and targets within math.isclose of the previous one
+EDGES = [-1, -0.5, -0.5 - 1e-12, -1e-12, 0, 1e-12, 0.3, 0.3 + 1e-12, 1]
+
+
+def test_backtest_equals_the_per_bar_loop_on_edge_targets():
+    exposures = np.array(list(itertools.chain.from_iterable(itertools.product(EDGES, EDGES))), dtype=float)
+    n = len(exposures)
+    timestamps = pd.date_range('2020', periods=n, freq='H')
+    prices = 100 * np.exp(np.cumsum(np.random.RandomState(2).normal(0, 0.01, n)))
+    expected = Position(fund=1e4, commision=TradePercentage(0.001))
+    per_bar(expected, timestamps, prices, exposures)
+    position = Position(fund=1e4, commision=TradePercentage(0.001))
+    result = backtest(position, timestamps, prices, exposures)
+    assert position == expected
+    pd.testing.assert_frame_equal(result.get_trade_log(), expected.get_trade_log())
+    pd.testing.assert_frame_equal(result.get_trade_profit(), expected.get_trade_profit())
+
+
+@pytest.mark.parametrize('old', EDGES)
+def test_cal_trade_agrees_with_cal_allocation(old):
+    position = Position(fund=1e4)
+    position.allocate(old, 100.0)
+    for new in EDGES:
+        trade = Position.cal_trade(position.fund, position.get_amount(), 110.0, old, new)
+        changed, exit_amount, entry_amount = Position.cal_allocation(
+            [position.fund], [position.get_amount()], [110.0], [old], [new])
+        assert bool(changed[0]) == (trade is not None), (old, new)
+        if trade is not None:
+            assert exit_amount[0] == pytest.approx(trade[0] or 0.0, rel=1e-12), (old, new)
+            assert entry_amount[0] == pytest.approx(trade[1] or 0.0, rel=1e-12), (old, new)
+
+
+def test_no_exit_leg_when_nothing_is_held():
+    # A partial cover cleared by isclose leaves a short target with nothing held
+    assert Position.cal_trade(1e4, 0, 100.0, -1e-12, 0) == (None, None)
+    assert Position.cal_trade(1e4, 0, 100.0, 0.5, 0.2) == (None, None)
+    changed, exit_amount, entry_amount = Position.cal_allocation([1e4], [0.0], [100.0], [0.5], [0.2])
+    assert changed[0] and exit_amount[0] == 0 and entry_amount[0] == 0
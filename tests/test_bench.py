@@ -0,0 +1,33 @@
+import io
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+from portfolio.benchmarks.bench import OPERATIONS, measure, make_case, run_benchmarks, compare
+
+
+def test_measure_reports_retained_blocks_of_kept_rows():
+    case = make_case(2000, 1, 10)
+    setup, run, calls, per_bar = OPERATIONS['Position.end_date']
+    seconds, peak, retained_blocks = measure(setup, run, case, repeat=1)
+    assert seconds > 0 and peak > 0
+    # Every end_date keeps its balance log row
+    assert retained_blocks > 0
+
+
+def test_compare_flags_growth_beyond_the_noise_floors():
+    results = run_benchmarks([500], [1], [10], repeat=1, operations=['Position.allocate'], out=io.StringIO())
+    name = 'bars=500 symbols=1 trade_every=10'
+    result = results[name]['Position.allocate']
+    assert set(result) == {'time', 'time_per_call', 'peak_memory', 'retained_blocks', 'retained_blocks_per_call'}
+    assert compare(results, results, tolerance=0.25) == []
+    reference = dict(result, time=1.0, peak_memory=result['peak_memory'] + 2 ** 22,
+                     retained_blocks_per_call=result['retained_blocks_per_call'] + 10)
+    assert compare(results, {name: {'Position.allocate': reference}}, tolerance=0.25) == []
+    slower = dict(result, time=result['time'] * 2 + 1, peak_memory=result['peak_memory'] * 2 + 2 ** 22,
+                  retained_blocks_per_call=result['retained_blocks_per_call'] * 2 + 2)
+    flagged = compare({name: {'Position.allocate': slower}}, results, tolerance=0.25)
+    assert [metric for _, _, metric, _, _ in flagged] == ['time', 'peak_memory', 'retained_blocks_per_call']
+    noise = dict(result, retained_blocks_per_call=result['retained_blocks_per_call'] + 0.5)
+    assert compare({name: {'Position.allocate': noise}}, results, tolerance=0.25) == []
@@ -0,0 +1,69 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+from portfolio import backtest as backtest_module, sweep as sweep_module
+from portfolio.instrument import Instrumentation, TARGETS
+from portfolio.trade import Position
+from portfolio.statistics import Statistics
+
+
+def originals():
+    return [(cls, attribute, cls.__dict__[attribute]) for name, cls, attribute in TARGETS]
+
+
+def test_stop_restores_every_target():
+    before = originals()
+    with pytest.raises(ZeroDivisionError):
+        with Instrumentation() as inst:
+            for cls, attribute, method in before:
+                assert cls.__dict__[attribute].__wrapped__ is method
+            with pytest.raises(RuntimeError):
+                Instrumentation().start()
+            1 / 0
+    assert inst.stop() is inst
+    for (cls, attribute, method), (_, _, restored) in zip(before, originals()):
+        assert restored is method, (cls, attribute)
+    # A new run can start once the previous one stopped
+    Instrumentation().start().stop()
+    assert originals() == before
+
+
+def test_counts_calls_and_log_rows_per_position(market, config):
+    timestamps, prices, exposures = market(300, hold=3, seed=5)
+    looped = Position(fund=1e4)
+    batched = Position(fund=1e4)
+    with Instrumentation({'looped': looped}) as inst:
+        for timestamp, price, exposure in zip(timestamps, prices, exposures):
+            looped.allocate(exposure, price, timestamp=timestamp)
+            looped.end_date(timestamp, price)
+        inst.track({'batched': batched})
+        backtest_module.backtest(batched, timestamps, prices, exposures)
+        Statistics(config(timestamps), {'S0': looped}).nav_summary()
+    snapshot = inst.snapshot()
+    operations = snapshot['operations']
+    assert operations['Position.allocate']['count'] == 300
+    assert operations['Position.end_date']['count'] == 300
+    assert operations['backtest']['count'] == 1
+    assert operations['Statistics.nav_summary']['count'] == 1
+    assert operations['Position.long']['count'] + operations['Position.short']['count'] > 0
+    assert all(stats['p50'] <= stats['p99'] for stats in operations.values())
+    rows = snapshot['rows']
+    assert rows['looped']['Position.allocate'] == {'trade_log': len(looped.trade_log),
+                                                   'trade_profit': len(looped.trade_profit), 'balance_log': 0}
+    assert rows['looped']['Position.end_date']['balance_log'] == 300
+    assert 'batched' not in rows or 'Position.allocate' not in rows['batched']
+    assert json.loads(inst.json())['operations']['backtest']['count'] == 1
+
+
+def test_counts_backtests_run_by_an_in_process_sweep(market, config):
+    timestamps, prices, _ = market(200, seed=6)
+    params = [{'level': level} for level in (-1, 0.5, 1)]
+    with Instrumentation() as inst:
+        sweep_module.sweep(lambda prices, level: np.full(len(prices), level), params, config(timestamps),
+                           pd.Index(timestamps), {'S0': prices, 'S1': prices[::-1].copy()}, fund=1e4, processes=1)
+    assert inst.snapshot()['operations']['backtest']['count'] == 6
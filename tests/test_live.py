@@ -0,0 +1,52 @@
+import asyncio
+import threading
+import time
+import pytest
+
+pytest.importorskip('structlog')
+pytest.importorskip('google.cloud.datastore')
+
+from portfolio.positions import Portfolio
+from portfolio.live import LiveTrader, SimulatedFeed
+from portfolio.storage import MemoryBackend, DeltaStore
+
+
+class SlowStore(DeltaStore):
+    ''' DeltaStore counting writes and overlapping writes '''
+    def __init__(self, *args, **kwargs):
+        super(SlowStore, self).__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+        self.state = {'active': 0, 'overlaps': 0, 'saves': 0}
+
+    def write(self, prepared):
+        with self.lock:
+            self.state['active'] += 1
+            self.state['saves'] += 1
+            self.state['overlaps'] += self.state['active'] > 1
+        time.sleep(0.4)
+        try:
+            return super(SlowStore, self).write(prepared)
+        finally:
+            with self.lock:
+                self.state['active'] -= 1
+
+
+def test_final_save_waits_for_a_cancelled_periodic_save():
+    backend = MemoryBackend()
+    store = SlowStore(backend, 'live')
+    portfolio = Portfolio(1000.0, {'A': 0.5, 'B': 0.5})
+    trader = LiveTrader(portfolio, lambda symbol, timestamp, price, position: 0.5 if price > 100 else -0.5,
+                        snapshot_interval=0.05, save_interval=0.1, store=store)
+    feed = SimulatedFeed(['A', 'B'], interval=0.001, bars=100000)
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(trader.run(feed, duration=0.3))
+    finally:
+        loop.close()
+    assert store.state['saves'] == 2
+    assert store.state['overlaps'] == 0
+
+    loaded = Portfolio(0, {})
+    assert DeltaStore(backend, 'live').load(loaded)
+    for symbol, position in portfolio.positions.items():
+        assert loaded.positions[symbol] == position
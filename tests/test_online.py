@@ -0,0 +1,68 @@
+import math
+import numpy as np
+import pandas as pd
+import pytest
+
+from portfolio.online import OnlineMetrics
+from portfolio.statistics import max_drawdown, annualized_return, sharpe_ratio
+
+
+def online(values, batch):
+    metrics = OnlineMetrics()
+    if batch:
+        metrics.extend(values)
+    else:
+        for value in values:
+            metrics.update(float(value))
+    return metrics
+
+
+def assert_same(online_value, batch_value):
+    if math.isnan(batch_value):
+        assert math.isnan(online_value)
+    else:
+        assert online_value == pytest.approx(float(batch_value), rel=1e-9)
+
+
+@pytest.mark.parametrize('batch', [False, True])
+@pytest.mark.parametrize('navs', [
+    [1000.0] * 50,
+    list(1000 * np.exp(np.cumsum(np.random.RandomState(0).normal(0, 0.01, 500)))),
+    [100.0, 0.0, 0.0, 50.0],
+], ids=['flat', 'random', 'zero'])
+def test_online_metrics_match_batch_metrics(navs, batch):
+    series = pd.Series(navs, index=pd.date_range('2020', periods=len(navs)))
+    metrics = online(navs, batch)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        assert_same(metrics.max_drawdown(), max_drawdown(series))
+        assert_same(metrics.annualized_return(), annualized_return(series))
+        assert_same(metrics.sharpe_ratio(), sharpe_ratio(series))
+
+
+def test_negative_nav_gives_a_real_annualized_return():
+    navs = [100.0, 50.0, -20.0, -30.0]
+    series = pd.Series(navs, index=pd.date_range('2020', periods=len(navs)))
+    for batch in (False, True):
+        metrics = online(navs, batch)
+        assert isinstance(metrics.annualized_return(), float)
+        assert math.isnan(metrics.annualized_return())
+        assert math.isnan(metrics.sharpe_ratio())
+        with np.errstate(invalid='ignore'):
+            assert_same(metrics.annualized_return(), annualized_return(series))
+    assert online([100.0, 50.0], False).annualized_return() == pytest.approx(0.5 ** (365 / 2) - 1)
+
+
+@pytest.mark.parametrize('navs', [[0.0, 0.0, 5.0, 4.0], [100.0, np.nan, 90.0, 95.0, 80.0], [100.0, 120.0, 0.0, 0.0]],
+                         ids=['zero-peak', 'nan-nav', 'zero-nav'])
+def test_extend_skips_nan_drawdowns_like_update(navs):
+    updated, extended = online(navs, False), online(navs, True)
+    assert extended.peak == updated.peak
+    assert extended.max_drawdown() == updated.max_drawdown()
+    peaks = np.fmax.accumulate(navs)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        assert updated.max_drawdown() == np.nanmax(1 - np.array(navs) / peaks)
+    # Splitting the batch does not change the result
+    split = OnlineMetrics()
+    split.extend(navs[:2])
+    split.extend(navs[2:])
+    assert split.dict() == pytest.approx(extended.dict(), nan_ok=True)
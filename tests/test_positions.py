@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('structlog')
+pytest.importorskip('google.cloud.datastore')
+
+from portfolio.positions import Portfolio
+
+
+def test_rebalance_equals_allocate_per_position(commissions):
+    symbols = ['S{}'.format(i) for i in range(500)]
+    looped = Portfolio(1e6, {symbol: 1 / 500 for symbol in symbols})
+    batched = Portfolio(1e6, {symbol: 1 / 500 for symbol in symbols})
+    for portfolio in (looped, batched):
+        for i, symbol in enumerate(symbols):
+            portfolio.positions[symbol].set_commision(commissions[i % len(commissions)].copy())
+    rng = np.random.RandomState(0)
+    for k in range(40):
+        timestamp = pd.Timestamp('2020') + pd.Timedelta(days=k)
+        prices = dict(zip(symbols, 100 * np.exp(rng.normal(0, 0.05, 500))))
+        targets = dict(zip(symbols, rng.choice([-1, -0.5, -0.2, 0, 0.2, 0.5, 1, np.nan], 500)))
+        if k == 5:
+            targets = {symbol: 0.3 for symbol in symbols[:10]}
+        for symbol, target in targets.items():
+            if not np.isnan(target):
+                looped.positions[symbol].allocate(target, prices[symbol], timestamp=timestamp, notes='r')
+        batched.rebalance(targets, prices, timestamp, notes='r')
+    for symbol in symbols:
+        assert batched.positions[symbol] == looped.positions[symbol], symbol
+        assert batched.positions[symbol].commision == looped.positions[symbol].commision, symbol
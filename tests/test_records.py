@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pydantic')
+
+from portfolio.records import ColumnLog, FLOAT, CATEGORY
+from portfolio.trade import Position
+
+
+def test_none_notes_are_read_back_as_none():
+    position = Position(fund=1000.0)
+    position.allocate(1, 100.0, notes=None)
+    assert position.trade_log[0]['notes'] is None
+
+    position = Position(fund=1000.0)
+    position.allocate(1, 100.0, notes='entry')
+    position.allocate(0, 110.0, notes=None)
+    assert [row['notes'] for row in position.trade_log] == ['entry', None]
+    assert position.get_trade_log()['notes'].isnull().tolist() == [False, True]
+
+
+def test_categories_with_none_in_appends_and_extends():
+    log = ColumnLog([('price', FLOAT), ('trade', CATEGORY)])
+    log.append({'price': 1.0, 'trade': None})
+    log.append({'price': 2.0, 'trade': 'LONG'})
+    log.extend({'price': np.array([3.0, 4.0, 5.0]), 'trade': ['SHORT', None, 'LONG']})
+    log.extend({'price': 6.0, 'trade': None})
+    assert log.columns()['trade'].tolist() == [None, 'LONG', 'SHORT', None, 'LONG', None]
+    assert [row['trade'] for row in log] == [None, 'LONG', 'SHORT', None, 'LONG', None]
+    assert list(log.column('trade').categories) == ['LONG', 'SHORT']
+
+
+def test_frames_and_columns_are_read_only_views_unless_copied():
+    log = ColumnLog([('price', FLOAT), ('trade', CATEGORY)])
+    log.extend({'price': np.array([1.0, 2.0, 3.0]), 'trade': 'LONG'})
+    price = log.columns()['price']
+    assert not price.flags.writeable
+    assert np.shares_memory(price, log.to_frame()['price'].values)
+    with pytest.raises(ValueError):
+        price[0] = 0.0
+    copied = log.columns(copy=True)['price']
+    copied[0] = 0.0
+    assert log.column('price').tolist() == [1.0, 2.0, 3.0]
+    assert not np.shares_memory(log.to_frame(copy=True)['price'].values, price)
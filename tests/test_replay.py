@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+from portfolio.trade import Position, TradePercentage
+from portfolio.backtest import backtest
+from portfolio.replay import Snapshots, verify, snapshot, recost
+
+def traded(timestamps=None, n=200, seed=1):
+    position = Position(fund=1e4, commision=TradePercentage(0.001))
+    start = snapshot(position)
+    rng = np.random.RandomState(seed)
+    exposures = rng.choice([-1, -0.5, 0, 0.5, 1], n)
+    prices = 100 + rng.normal(0, 1, n).cumsum()
+    for i in range(n):
+        position.allocate(exposures[i], prices[i], timestamp=None if timestamps is None else timestamps[i])
+    return position, start
+
+
+def test_verify_without_timestamps_reports_no_mismatch():
+    position, start = traded()
+    assert np.isnat(position.trade_profit.column('timestamp')).all()
+    assert verify(position, start) == {}
+    assert verify(position) == {}
+
+
+def test_verify_reports_a_changed_fund():
+    position, start = traded()
+    position.fund += 1
+    assert list(verify(position, start)) == ['fund']
+
+
+def replayed(market):
+    return market(6000, seed=3, volatility=0.003)
+
+
+def backtested(market, commision, chunk=500):
+    timestamps, prices, exposures = replayed(market)
+    position = Position(fund=1e4, commision=commision.copy())
+    snapshots = Snapshots(every=2000)
+    snapshots.take(position)
+    for start in range(0, len(prices), chunk):
+        end = start + chunk
+        backtest(position, timestamps[start:end], prices[start:end], exposures[start:end])
+        snapshots.take(position)
+    return position, snapshots
+
+
+def test_recover_restores_the_position(market, commision):
+    position, snapshots = backtested(market, commision)
+    assert verify(position, snapshots.snapshots[0]) == {}
+    broken = Position(**position.dict())
+    broken.fund = 0
+    broken.fee = 0
+    broken.inv.inventory = []
+    broken.strategy_exposure = 9
+    # Without the later snapshots the trades after the second one are replayed
+    assert Snapshots(snapshots=snapshots.snapshots[:2]).recover(broken) > 0
+    assert broken == position
+
+
+def test_rollback_equals_a_run_stopped_there(market, commision):
+    position, snapshots = backtested(market, commision)
+    timestamps, prices, exposures = replayed(market)
+    expected = Position(fund=1e4, commision=commision.copy())
+    backtest(expected, timestamps[:4322], prices[:4322], exposures[:4322])
+    assert snapshots.rollback(position, timestamps[4321]) == expected
+
+
+def test_recost_equals_a_fresh_backtest(market, commision):
+    position, snapshots = backtested(market, commision)
+    assert recost(position, commision.copy(), snapshots.snapshots[0]) == position
+    timestamps, prices, exposures = replayed(market)
+    expected = Position(fund=1e4, commision=TradePercentage(0.0001))
+    backtest(expected, timestamps, prices, exposures)
+    cheaper = recost(position, TradePercentage(0.0001), snapshots.snapshots[0])
+    assert cheaper == expected
+    assert cheaper.fee < position.fee
+
+
+def test_rollback_with_tz_aware_timestamps(market):
+    timestamps, prices, exposures = market(600, seed=3, volatility=0.003)
+    timestamps = timestamps.tz_localize('UTC')
+    position = Position(fund=1e4)
+    snapshots = Snapshots(every=2)
+    snapshots.take(position)
+    for start in range(0, 600, 100):
+        end = start + 100
+        backtest(position, timestamps[start:end], prices[start:end], exposures[start:end])
+        snapshots.take(position)
+    expected = Position(fund=1e4)
+    backtest(expected, timestamps[:321], prices[:321], exposures[:321])
+    assert snapshots.rollback(position, timestamps[320]) == expected
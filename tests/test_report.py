@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+import portfolio
+from portfolio.report import CHARTS, report_data, render_report, _figure
+
+PACKAGE_PARENT = os.path.dirname(os.path.dirname(os.path.abspath(portfolio.__file__)))
+
+
+def imported_modules(statement):
+    ''' Modules loaded by ``statement`` in a fresh interpreter '''
+    code = 'import sys; {}; print("\\n".join(sorted(sys.modules)))'.format(statement)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PACKAGE_PARENT, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.run([sys.executable, '-c', code], env=env, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return set(output.split())
+
+
+def test_importing_trade_loads_neither_matplotlib_nor_statistics():
+    modules = imported_modules('import portfolio.trade')
+    assert 'portfolio.trade' in modules
+    assert not any(name == 'matplotlib' or name.startswith('matplotlib.') for name in modules)
+    assert 'portfolio.statistics' not in modules
+    assert 'portfolio.statistics' in imported_modules('import portfolio; portfolio.Statistics')
+
+
+def test_render_report_draws_every_chart_on_agg(tmp_path, statistics):
+    pytest.importorskip('matplotlib')
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    assert isinstance(_figure((2, 2)).canvas, FigureCanvasAgg)
+    data = report_data(statistics(bars=2000, symbols=2), points=300)
+    assert len(data['equity']) <= 301
+    paths = render_report(data, str(tmp_path / 'report'))
+    assert [os.path.basename(path) for path in paths] == ['{}.png'.format(chart) for chart in CHARTS]
+    for path in paths:
+        with open(path, 'rb') as image:
+            assert image.read(8) == b'\x89PNG\r\n\x1a\n'
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from portfolio.resample import STREAM_PATHS, bootstrap_trades, bootstrap_returns, trade_paths
+
+
+def trades(n=150, seed=0):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({'realized_gross_profit': rng.normal(5, 50, n), 'total_fee': rng.uniform(0, 2, n)})
+
+
+def equity(days=400, seed=0):
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2020', periods=days * 6, freq='4H')
+    return pd.Series(1e4 * np.exp(np.cumsum(rng.normal(0.0001, 0.004, len(index)))), index=index)
+
+
+def assert_same_metrics(result, expected):
+    assert list(result) == list(expected)
+    for name in expected:
+        np.testing.assert_array_equal(result[name], expected[name])
+
+
+@pytest.mark.parametrize('method', ['bootstrap', 'permute'])
+def test_bootstrap_trades_depend_only_on_the_seed(method):
+    kwargs = dict(fund=1e4, days=365, n_paths=1050, method=method, processes=1, raw=True)
+    expected = bootstrap_trades(trades(), seed=5, batch_size=1000, **kwargs)
+    assert len(expected['cagr']) == 1050
+    assert_same_metrics(bootstrap_trades(trades(), seed=5, batch_size=1000, **kwargs), expected)
+    for batch_size in (1, STREAM_PATHS, 250, 5000):
+        assert_same_metrics(bootstrap_trades(trades(), seed=5, batch_size=batch_size, **kwargs), expected)
+    other = bootstrap_trades(trades(), seed=6, batch_size=1000, **kwargs)
+    assert not np.array_equal(other['max_drawdown'], expected['max_drawdown'])
+
+
+def test_bootstrap_returns_depend_only_on_the_seed():
+    kwargs = dict(n_paths=430, block=10, processes=1, raw=True)
+    expected = bootstrap_returns(equity(), seed=1, batch_size=1000, **kwargs)
+    for batch_size in (STREAM_PATHS, 300):
+        assert_same_metrics(bootstrap_returns(equity(), seed=1, batch_size=batch_size, **kwargs), expected)
+    assert_same_metrics(bootstrap_returns(equity(), seed=1, batch_size=200, n_paths=430, block=10, processes=2,
+                                          raw=True), expected)
+
+
+def test_permuted_paths_end_at_the_total_profit():
+    profits = trades()['realized_gross_profit'].values
+    values = trade_paths(profits, 1e4, 50, 'permute', np.random.RandomState(0))
+    np.testing.assert_allclose(values[-1], 1e4 + profits.sum())
+    summary = bootstrap_trades(trades(), 1e4, 365, n_paths=300, method='permute', processes=1)
+    assert summary.loc['net_profit', 'std'] == pytest.approx(0, abs=1e-9)
+    with pytest.raises(ValueError):
+        bootstrap_trades(trades(), 1e4, 365, n_paths=10, method='shuffle', processes=1)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('talib')
+pytest.importorskip('structlog')
+
+from portfolio.signals import Indicator, IndicatorCache
+
+
+def prices(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return 100 * np.exp(np.cumsum(rng.normal(0, 0.01, n)))
+
+
+def test_indicator_without_unstable_period_is_computed_in_full(tmp_path):
+    close = prices(500)
+    sma = Indicator('SMA', timeperiod=20)
+    assert not sma.incremental()
+    cache = IndicatorCache(directory=str(tmp_path))
+    cache.get('BTCUSD', sma, close[:400])
+    values = cache.get('BTCUSD', sma, close)
+    assert (cache.misses, cache.tails) == (2, 0)
+    np.testing.assert_array_equal(values, sma.compute({'close': close}))
+    assert len(list(tmp_path.glob('*.npy'))) == 1
+
+
+def test_indicator_with_warmup_computes_the_tail_only():
+    close = prices(2000)
+    rsi = Indicator('RSI', timeperiod=14, warmup=300)
+    assert rsi.incremental()
+    cache = IndicatorCache()
+    cache.get('BTCUSD', rsi, close[:1900])
+    values = cache.get('BTCUSD', rsi, close)
+    assert cache.get('BTCUSD', rsi, close) is values
+    assert (cache.misses, cache.tails, cache.hits) == (1, 1, 1)
+    np.testing.assert_allclose(values, rsi.compute({'close': close}), rtol=1e-9, equal_nan=True)
+
+
+def test_multiple_output_indicator():
+    close = prices(300)
+    macd = Indicator('MACD', output='macdhist')
+    values = IndicatorCache().get('BTCUSD', macd, close)
+    assert len(values) == 300 and np.isfinite(values[-1])
+
+
+def test_memory_keeps_the_latest_values_of_a_series():
+    close = prices(600)
+    rsi = Indicator('RSI', timeperiod=14, warmup=300)
+    cache = IndicatorCache()
+    for end in (400, 500, 600):
+        cache.get('BTCUSD', rsi, close[:end])
+    assert (cache.misses, cache.tails) == (1, 2)
+    assert len(cache.memory) == 1
+
+
+def test_unstable_period_is_part_of_the_key():
+    import talib
+    if not hasattr(talib, 'set_unstable_period'):
+        pytest.skip('TA-Lib without unstable period setters')
+    close = prices(500)
+    ema = Indicator('EMA', timeperiod=10)
+    assert not ema.incremental()
+    cache = IndicatorCache()
+    previous = talib.get_unstable_period('EMA')
+    try:
+        talib.set_unstable_period('EMA', 0)
+        stable = cache.get('BTCUSD', ema, close)
+        talib.set_unstable_period('EMA', 50)
+        unstable = cache.get('BTCUSD', ema, close)
+        np.testing.assert_array_equal(unstable, ema.compute({'close': close}))
+    finally:
+        talib.set_unstable_period('EMA', previous)
+    assert cache.misses == 2
+    assert np.isnan(unstable[:59]).all() and np.isfinite(stable[9:59]).all()
@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('h5py')
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+from portfolio.records import ColumnLog
+from portfolio.trade import Position, LOG_SCHEMAS
+from portfolio.backtest import backtest
+from portfolio.replay import STATE
+from portfolio.spill import HDF5Log
+from portfolio.statistics import Statistics
+
+
+def assert_same_statistics(stat, expected):
+    pd.testing.assert_series_equal(stat.equity, expected.equity)
+    pd.testing.assert_frame_equal(stat.nav_summary(), expected.nav_summary())
+    pd.testing.assert_frame_equal(stat.trade_summary(), expected.trade_summary())
+    pd.testing.assert_frame_equal(stat.trade_excursions(), expected.trade_excursions())
+
+
+def test_hdf5_log_sets_up_the_column_log_state(tmp_path):
+    log = HDF5Log(LOG_SCHEMAS['trade_log'], str(tmp_path / 'log.h5'), 'S0/trade_log')
+    assert isinstance(log, ColumnLog)
+    assert log.fields == [name for name, kind in LOG_SCHEMAS['trade_log']]
+    assert len(log) == 0 and log._pending == []
+    log.close()
+
+
+def test_spill_statistics_and_resume_equal_an_in_memory_run(tmp_path, market, config, commision):
+    path = str(tmp_path / 'backtest.h5')
+    timestamps, prices, exposures = market(2000, hold=5, seed=7)
+    half = 1200
+    expected = Position(fund=1e4, commision=commision.copy())
+    backtest(expected, timestamps[:half], prices[:half], exposures[:half])
+
+    position = Position(fund=1e4, commision=commision.copy())
+    position.spill(path, 'S0', logs=tuple(LOG_SCHEMAS))
+    backtest(position, timestamps[:half], prices[:half], exposures[:half])
+    assert isinstance(position.balance_log, HDF5Log)
+    assert_same_statistics(Statistics(config(timestamps[:half]), {'S0': position}),
+                           Statistics(config(timestamps[:half]), {'S0': expected}))
+    state = position.dict(include=set(STATE))
+    position.close_logs()
+
+    # A new process rebuilds the position from its state and appends to the same groups
+    resumed = Position(**state)
+    resumed.spill(path, 'S0', logs=tuple(LOG_SCHEMAS), resume=True)
+    assert len(resumed.balance_log) == half
+    backtest(expected, timestamps[half:], prices[half:], exposures[half:])
+    backtest(resumed, timestamps[half:], prices[half:], exposures[half:])
+    assert resumed == expected
+    assert_same_statistics(Statistics(config(timestamps), {'S0': resumed}),
+                           Statistics(config(timestamps), {'S0': expected}))
+    resumed.close_logs()
+    reopened = HDF5Log(LOG_SCHEMAS['balance_log'], path, 'S0/balance_log', resume=True)
+    np.testing.assert_array_equal(reopened.column('nav'), expected.balance_log.column('nav'))
+    reopened.close()
@@ -0,0 +1,209 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+from portfolio.statistics import (window_starts, rolling_metrics, annualized_return, sharpe_ratio, drawdowns,
+                                  max_drawdown, matrix_metrics, periodic_returns, calendar_table, TOTAL, Statistics)
+from portfolio.trade import Position
+from portfolio.backtest import backtest
+
+
+def brute_force_excursions(stat):
+    ''' MAE and MFE of every trade_profit row from the bars held since the side was entered '''
+    trades = stat.trade_profit
+    found = []
+    for j in range(len(trades)):
+        balance = stat.positions[trades['level_0'].iloc[j]].get_balance_log()
+        exit_bar = balance.index.searchsorted(trades.index[j])
+        side = 1 if trades['trade'].iloc[j] == 'LONG' else -1
+        entry_bar = exit_bar
+        while entry_bar > 0 and np.sign(balance['amount'].iloc[entry_bar - 1]) == side:
+            entry_bar -= 1
+        window = balance['price'].iloc[entry_bar:exit_bar + 1]
+        enter = trades['enter_price'].iloc[j]
+        adverse = (enter - window.min()) / enter if side == 1 else (window.max() - enter) / enter
+        favorable = (window.max() - enter) / enter if side == 1 else (enter - window.min()) / enter
+        found.append((max(adverse, 0), max(favorable, 0)))
+    return np.array(found).reshape(-1, 2)
+
+
+def test_trade_excursions_equal_brute_force(statistics):
+    stat = statistics()
+    excursions = stat.trade_excursions()
+    assert len(excursions) == len(stat.trade_profit) > 100
+    expected = brute_force_excursions(stat)
+    np.testing.assert_allclose(excursions['mae'].values, expected[:, 0])
+    np.testing.assert_allclose(excursions['mfe'].values, expected[:, 1])
+
+
+def test_cached_results_follow_new_trades(statistics):
+    stat = statistics(bars=500, symbols=2)
+    position = stat.positions['S0']
+    timestamp = position.get_balance_log().index[-1] + pd.Timedelta(hours=1)
+    position.allocate(0.0, 100.0, timestamp=timestamp)
+    trades = len(stat.trade_profit)
+    bars = len(stat.equity)
+    position.allocate(1.0, 100.0, timestamp=timestamp)
+    position.allocate(0.0, 101.0, timestamp=timestamp)
+    position.end_date(timestamp, 101.0)
+    assert len(stat.trade_profit) == trades + 1
+    assert len(stat.trade_excursions()) == trades + 1
+    assert len(stat.equity) == bars + 1
+
+
+@pytest.mark.parametrize('window', [5, np.int64(24), '3D'], ids=repr)
+def test_window_starts_equal_a_scan(market, window):
+    index = market(300)[0]
+    starts = window_starts(index, window)
+    for end in range(len(index)):
+        if isinstance(window, str):
+            expected = next(i for i in range(end + 1) if index[i] > index[end] - pd.Timedelta(window))
+        else:
+            expected = max(end - int(window) + 1, 0)
+        assert starts[end] == expected, end
+
+
+@pytest.mark.parametrize('window', [5, np.int64(24), '3D'], ids=repr)
+def test_rolling_metrics_equal_the_scalar_metrics_of_each_window(market, window):
+    timestamps, prices, _ = market(400, seed=4)
+    equity = pd.Series(prices, index=timestamps)
+    rolling = rolling_metrics(equity, [window], rff=0.01)[window]
+    starts = window_starts(equity.index, window)
+    for end in range(2, len(equity), 3):
+        bars = equity.iloc[starts[end]:end + 1]
+        if len(bars) < 3:
+            continue
+        row = rolling.iloc[end]
+        assert row['return'] == pytest.approx(annualized_return(bars), rel=1e-9)
+        assert row['volatility'] == pytest.approx(bars.pct_change().std() * np.sqrt(365), rel=1e-9)
+        assert row['sharpe'] == pytest.approx(sharpe_ratio(bars, rff=0.01), rel=1e-9)
+        # Drawdown of the last bar from the window peak, never past the window's maximum drawdown
+        assert row['drawdown'] == pytest.approx(drawdowns(bars)[-1], abs=1e-12)
+        assert row['drawdown'] <= max_drawdown(bars) + 1e-12
+
+
+def brute_force_drawdown(values):
+    ''' (maximum drawdown, peak bar, trough bar) with the peak at the first bar reaching the running maximum '''
+    dd = drawdowns(pd.Series(values))
+    end = int(np.argmax(dd))
+    return dd[end], int(np.argmax(values[:end + 1])), end
+
+
+def test_matrix_metrics_equal_the_scalar_metrics_of_each_curve(market):
+    curves = pd.DataFrame({'S{}'.format(seed): market(700, seed=seed)[1] for seed in range(6)},
+                          index=market(700)[0])
+    # Returns exactly to its earlier peak before the deeper drawdown
+    curves['Peak'] = np.r_[np.linspace(100, 110, 100), np.linspace(110, 105, 100), np.linspace(105, 110, 100),
+                           np.linspace(110, 90, 400)]
+    summary = matrix_metrics(curves, rff=0.01)
+    positions = matrix_metrics(curves.values, rff=0.01)
+    assert list(summary.index) == list(curves.columns)
+    for j, column in enumerate(curves):
+        ts = curves[column]
+        r = ts.pct_change().dropna()
+        mdd, start, end = brute_force_drawdown(ts.values)
+        row = summary.loc[column]
+        assert row['Maximum Drawdown %'] == pytest.approx(max_drawdown(ts) * 100, rel=1e-12)
+        assert row['Maximum Drawdown %'] == pytest.approx(mdd * 100, rel=1e-12)
+        assert (row['Drawdown Start'], row['Drawdown End']) == (ts.index[start], ts.index[end])
+        assert row['Drawdown Duration'] == ts.index[end] - ts.index[start]
+        assert (positions.loc[j, 'Drawdown Start'], positions.loc[j, 'Drawdown End']) == (start, end)
+        assert row['Annual Return %'] == pytest.approx(annualized_return(ts) * 100, rel=1e-9)
+        assert row['Sharpe Ratio'] == pytest.approx(sharpe_ratio(ts, rff=0.01), rel=1e-9)
+        downside = np.sqrt(np.mean(np.minimum(r, 0) ** 2)) * np.sqrt(365)
+        assert row['Sortino Ratio'] == pytest.approx((annualized_return(ts) - 0.01) / downside, rel=1e-9)
+    assert summary.loc['Peak', 'Drawdown Start'] == curves.index[99]
+
+
+def test_symbol_summary_equals_the_scalar_metrics_of_each_symbol(statistics):
+    stat = statistics(bars=1000, symbols=4)
+    summary = stat.symbol_summary(rff=0.02)
+    navs = stat.symbol_nav()
+    assert list(summary.index) == list(stat.positions)
+    for symbol in stat.positions:
+        nav = navs[symbol]
+        assert summary.loc[symbol, 'Maximum Drawdown %'] == pytest.approx(max_drawdown(nav) * 100, rel=1e-12)
+        assert summary.loc[symbol, 'Annual Return %'] == pytest.approx(annualized_return(nav) * 100, rel=1e-9)
+        assert summary.loc[symbol, 'Sharpe Ratio'] == pytest.approx(sharpe_ratio(nav, rff=0.02), rel=1e-9)
+        mdd, start, end = brute_force_drawdown(nav.values)
+        assert (summary.loc[symbol, 'Drawdown Start'], summary.loc[symbol, 'Drawdown End']) == (nav.index[start],
+                                                                                               nav.index[end])
+
+
+def gapped_navs(seed=0):
+    ''' Two nav series on 6-hour bars, the second starting later, both missing a whole month '''
+    rng = np.random.RandomState(seed)
+    index = pd.date_range('2020-01-03 09:00', '2021-03-20', freq='6H')
+    index = index[(index < '2020-05-01') | (index >= '2020-06-01')]
+    first = pd.Series(1e4 * np.exp(np.cumsum(rng.normal(0, 0.005, len(index)))), index=index)
+    second = first.iloc[500:].sample(frac=0.7, random_state=seed).sort_index() * 0.5
+    return first, second
+
+
+def resampled_returns(series, freq):
+    ''' Chained returns of pandas' resampled closes, the first against the first bar '''
+    closes = series.resample(freq).last()
+    previous = closes.ffill().shift(1).fillna(series.iloc[0])
+    return (closes / previous - 1).values
+
+
+@pytest.mark.parametrize('freq,alias', [('daily', 'D'), ('weekly', 'W'), ('monthly', 'M'), ('quarterly', 'Q'),
+                                        ('yearly', 'A'), ('BM', 'BM'), ('30D', '30D')])
+def test_periodic_returns_equal_pandas_resample(freq, alias):
+    first, second = gapped_navs()
+    navs = {'A': (first.index.values, first.values), 'B': (second.index.values, second.values)}
+    returns = periodic_returns(navs, freq, fixed_cash=100.0)
+    np.testing.assert_allclose(returns['A'].values, resampled_returns(first, alias), rtol=1e-12)
+    # The total holds B at its first nav before it starts and at its last nav in periods it has no bar
+    both = pd.concat([first, second], axis=1).ffill().bfill()
+    total = both.sum(axis=1) + 100.0
+    expected = resampled_returns(total, alias)
+    expected[np.isnan(first.resample(alias).last().values)] = np.nan
+    np.testing.assert_allclose(returns[TOTAL].values, expected, rtol=1e-12)
+    if alias in ('D', 'W', 'M', 'BM'):
+        assert np.isnan(returns['A'].values).any()
+
+
+def test_calendar_table_compounds_each_row():
+    first, _ = gapped_navs()
+    returns = periodic_returns({'A': (first.index.values, first.values)}, 'monthly', total=False)['A']
+    table = calendar_table(returns)
+    assert list(table.index) == [2020, 2021]
+    assert list(table.columns) == list(range(1, 13)) + [TOTAL]
+    assert np.isnan(table.loc[2020, 5]) and np.isnan(table.loc[2021, 12])
+    assert table.loc[2020, 3] == returns[pd.Period('2020-03', 'M')]
+    for year in table.index:
+        assert table.loc[year, TOTAL] == pytest.approx(np.nanprod(1 + table.loc[year].drop(TOTAL)) - 1)
+    daily = calendar_table(periodic_returns({'A': (first.index.values, first.values)}, 'daily')['A'])
+    assert daily.index.names == ['year', 'month'] and list(daily.columns)[-1] == TOTAL
+
+
+@pytest.mark.parametrize('freq', ['H', '2M', 'BM', '30D'])
+def test_calendar_table_rejects_periods_without_a_layout(freq):
+    first, _ = gapped_navs()
+    returns = periodic_returns({'A': (first.index.values, first.values)}, freq)['A']
+    with pytest.raises(ValueError):
+        calendar_table(returns)
+
+
+def test_monthly_return_matches_the_business_month_frame(market, config):
+    ''' monthly_return used to read the equity at asfreq('BM'); it agrees on business-day bars at midnight '''
+    _, prices, exposures = market(500, hold=4, seed=8)
+    timestamps = pd.bdate_range('2020-01-01', periods=500)
+    positions = {'S0': Position(fund=1e4)}
+    backtest(positions['S0'], timestamps, prices, exposures)
+    stat = Statistics(config(timestamps), positions)
+    df = stat.equity.to_frame(name='returns')
+    df['year'] = df.index.year
+    df['month'] = df.index.month
+    end_date_of_month = df.asfreq('BM').set_index(['year', 'month'])
+    first_date_of_month = df.asfreq('BMS').set_index(['year', 'month'])
+    expected = end_date_of_month.pct_change()
+    expected.iloc[0, 0] = end_date_of_month['returns'].iloc[0] / first_date_of_month['returns'].iloc[0] - 1
+    result = stat.monthly_return()
+    assert list(result.columns) == ['returns'] and result.index.names == ['year', 'month']
+    # The last month is not over yet, asfreq('BM') has no row for it
+    pd.testing.assert_frame_equal(result.iloc[:len(expected)], expected, check_index_type=False, rtol=1e-12)
@@ -0,0 +1,122 @@
+import pytest
+
+pytest.importorskip('google.cloud.datastore')
+
+from portfolio.positions import Portfolio
+from portfolio.storage import MemoryBackend, DatastoreBackend, DeltaStore, PortfolioManager
+
+
+def test_portfolios_are_saved_under_their_own_keys():
+    backend = MemoryBackend()
+    manager = PortfolioManager(backend)
+    manager.register('p1', Portfolio(100, {'BTCUSD': 1.0}))
+    manager.register('p2', Portfolio(200, {'BTCUSD': 1.0}))
+    assert manager.save_all() == {'p1': True, 'p2': True}
+    assert sorted(backend.data) == ['Positions/p1', 'Positions/p2']
+
+    loaded = PortfolioManager(backend, {'p1': Portfolio(0, {}), 'p2': Portfolio(0, {})})
+    assert loaded.load_all() == {'p1': True, 'p2': True}
+    assert loaded.portfolios['p1'].fund == 100
+    assert loaded.portfolios['p2'].fund == 200
+
+
+class FakeClient(object):
+    ''' Datastore client keeping entities in a dict, with the lookup and commit limits '''
+    def __init__(self):
+        from google.cloud import datastore
+        self.datastore = datastore
+        self.entities = {}
+        self.calls = []
+
+    def key(self, kind, name):
+        return self.datastore.Key(kind, name, project='test')
+
+    def get(self, key):
+        return self.get_multi([key])[0] if key.flat_path in self.entities else None
+
+    def get_multi(self, keys):
+        assert len(keys) <= 1000
+        self.calls.append(('get', len(keys)))
+        return [self.entities[key.flat_path] for key in keys if key.flat_path in self.entities]
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        assert len(entities) <= 500
+        self.calls.append(('put', len(entities)))
+        self.entities.update((entity.key.flat_path, entity) for entity in entities)
+
+    def delete_multi(self, keys):
+        assert len(keys) <= 500
+        self.calls.append(('delete', len(keys)))
+        for key in keys:
+            self.entities.pop(key.flat_path, None)
+
+
+def test_datastore_multi_calls_are_split_to_the_limits():
+    client = FakeClient()
+    backend = DatastoreBackend(client)
+    keys = ['k{}'.format(i) for i in range(1201)]
+    backend.put_multi([(key, i) for i, key in enumerate(keys)])
+    assert backend.get_multi(keys) == list(range(1201))
+    backend.delete_multi(keys)
+    assert client.calls == [('put', 500), ('put', 500), ('put', 201), ('get', 1000), ('get', 201),
+                            ('delete', 500), ('delete', 500), ('delete', 201)]
+    assert client.entities == {}
+
+
+def traded_portfolio(bars):
+    portfolio = Portfolio(1000.0, {'BTCUSD': 1.0})
+    position = portfolio.positions['BTCUSD']
+    for i in range(bars):
+        position.allocate(0.5 if i % 2 else 1.0, 100.0 + i)
+    return portfolio
+
+
+def test_delta_store_saving_before_load_deletes_the_previous_segments():
+    backend = MemoryBackend()
+    portfolio = traded_portfolio(35)
+    DeltaStore(backend, 'strategy', segment_rows=10).save(portfolio)
+    assert sorted(key for key in backend.data if '/trade_log/' in key) == [
+        'strategy/BTCUSD/trade_log/{}'.format(start) for start in (0, 10, 20, 30)]
+
+    DeltaStore(backend, 'strategy', segment_rows=20).save(portfolio)
+    assert sorted(key for key in backend.data if '/trade_log/' in key) == [
+        'strategy/BTCUSD/trade_log/0', 'strategy/BTCUSD/trade_log/20']
+    loaded = Portfolio(0.0, {})
+    assert DeltaStore(backend, 'strategy').load(loaded)
+    assert loaded.positions['BTCUSD'] == portfolio.positions['BTCUSD']
+
+
+def test_manager_loads_and_saves_the_entities_of_portfolio_save():
+    client = FakeClient()
+    saved = traded_portfolio(5)
+    saved.client, saved.datastore_key = client, ('Positions', 'p1')
+    saved.save()
+
+    backend = DatastoreBackend(client, 'Positions', properties=True)
+    manager = PortfolioManager(backend, {'p1': Portfolio(0.0, {})}, kind=None)
+    assert manager.load_all() == {'p1': True}
+    assert manager.portfolios['p1'].positions['BTCUSD'] == saved.positions['BTCUSD']
+
+    manager.portfolios['p1'].fund = 500.0
+    assert manager.save_all() == {'p1': True}
+    reloaded = Portfolio(0.0, {})
+    reloaded.client = client
+    assert reloaded.load('Positions', 'p1') is not None
+    assert reloaded.fund == 500.0
+
+
+def test_portfolio_save_of_a_serialized_result_and_load_of_a_missing_key():
+    client = FakeClient()
+    portfolio = traded_portfolio(4)
+    portfolio.client = client
+    assert portfolio.load('Positions', 'missing') is None
+    assert portfolio.datastore_key == ('Positions', 'missing')
+    result = Portfolio.serialize(traded_portfolio(7))
+    portfolio.save(result)
+    reloaded = Portfolio(0.0, {})
+    reloaded.client = client
+    assert reloaded.load('Positions', 'missing') == result
+    assert reloaded.positions['BTCUSD'] == traded_portfolio(7).positions['BTCUSD']
@@ -0,0 +1,41 @@
+import pickle
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('pydantic')
+pytest.importorskip('structlog')
+
+from portfolio.sweep import SharedArray, sweep
+
+
+def momentum(prices, window):
+    ''' Long above the moving average of ``window`` bars, short below '''
+    average = pd.Series(prices).rolling(window, min_periods=1).mean().values
+    return np.sign(prices - average)
+
+
+def test_shared_array_maps_the_file_read_only(tmp_path):
+    values = np.arange(12, dtype=float).reshape(3, 4)
+    shared = pickle.loads(pickle.dumps(SharedArray.create(values, str(tmp_path / 'values'))))
+    mapped = shared.open()
+    assert isinstance(mapped, np.memmap)
+    assert not mapped.flags.writeable
+    np.testing.assert_array_equal(mapped, values)
+
+
+def test_process_sweep_equals_a_serial_sweep(market, config):
+    prices = {'S{}'.format(i): market(500, seed=i)[1] for i in range(2)}
+    timestamps = market(500)[0]
+    config = config(timestamps)
+    params = [{'window': window} for window in (5, 10, 20, 40, 80)]
+    serial = sweep(momentum, params, config, timestamps, prices, fund=10000.0, processes=1)
+    calls = []
+    parallel = sweep(momentum, params, config, timestamps, prices, fund=10000.0, processes=2, chunksize=2,
+                     progress=lambda done, total: calls.append((done, total)))
+    assert calls == [(1, 3), (2, 3), (3, 3)]
+    assert [result[0] for result in parallel] == params
+    for (params1, nav1, trades1), (params2, nav2, trades2) in zip(serial, parallel):
+        pd.testing.assert_series_equal(pd.Series(nav1), pd.Series(nav2))
+        for row1, row2 in zip(trades1, trades2):
+            pd.testing.assert_series_equal(pd.Series(row1), pd.Series(row2))
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pydantic')
+
+from portfolio.trade import Commission, TieredVolume
+
+
+def fills(n=5000, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.uniform(10, 100, n), rng.normal(0, 5, n)
+
+
+def test_batch_fees_equal_scalar_fees(commision):
+    prices, amounts = fills()
+    scalar = commision.copy()
+    charged = [scalar.charge(p, a) for p, a in zip(prices.tolist(), amounts.tolist())]
+    # calculate_batch quotes the same consecutive fills without charging them
+    batch = commision.copy()
+    assert np.allclose(batch.calculate_batch(prices, amounts), charged, rtol=1e-12)
+    assert batch == commision
+    assert np.allclose(batch.charge_batch(prices, amounts), charged, rtol=1e-12)
+    assert Commission.from_dict(batch.dict()) == batch
+    if isinstance(scalar, TieredVolume):
+        assert batch.volume == pytest.approx(scalar.volume, rel=1e-12)
@@ -1,30 +1,208 @@
 ''' This trade modules provides classes to keep track portfolios
 
 '''
-from pydantic import BaseModel
-from typing import List, Dict, Set, Tuple
+from pydantic import BaseModel, validator
+from typing import Dict
 import datetime
+import numpy as np
 import pandas as pd
 import math
+from .records import ColumnLog, FLOAT, CATEGORY, DATETIME, to_datetimes
+from .online import OnlineMetrics
 PRECISION = 1e-6
 
 ########################################################################
-#### TradePercentage (Commision)
+#### Commission models
+#### ``calculate(price, amount)`` prices one fill and
+#### ``calculate_batch(prices, amounts)`` arrays of fills in one NumPy
+#### call. ``charge``/``charge_batch`` are used for executed fills and
+#### also update stateful models (e.g. the traded volume of
+#### TieredVolume), ``calculate`` only quotes. Models serialize with
+#### dict() and Commission.from_dict.
 ####
 #### Usage:
 #### commision = TradePercentage(0.01)
 #### commision.calculate(price, amount)
+#### commision.calculate_batch(prices, amounts)
+#### Commission.from_dict(commision.dict())
 ########################################################################
 class Commission(object):
-    pass
+    def calculate(self, price, amount):
+        return float(self.calculate_batch(np.array([price], dtype=float), np.array([amount], dtype=float))[0])
+
+    def calculate_batch(self, prices, amounts):
+        raise NotImplementedError
+
+    def charge(self, price, amount):
+        return self.calculate(price, amount)
+
+    def charge_batch(self, prices, amounts):
+        return self.calculate_batch(prices, amounts)
+
+    def params(self):
+        return {}
+
+    def dict(self):
+        result = {'model': type(self).__name__}
+        result.update(self.params())
+        return result
+
+    @staticmethod
+    def from_dict(value):
+        value = dict(value)
+        return COMMISSIONS[value.pop('model')](**value)
+
+    def copy(self):
+        return Commission.from_dict(self.dict())
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={!r}'.format(k, v) for k, v in self.params().items()))
+
+    def __eq__(self, other):
+        return isinstance(other, Commission) and self.dict() == other.dict()
 
 class TradePercentage(Commission):
     def __init__(self, percentage):
         assert (percentage < 1)
-        self.__percentage = percentage
+        self.percentage = percentage
+
+    def params(self):
+        return {'percentage': self.percentage}
 
     def calculate(self, price, amount):
-        return price * abs(amount) * self.__percentage
+        return price * abs(amount) * self.percentage
+
+    def calculate_batch(self, prices, amounts):
+        return np.asarray(prices, dtype=float) * np.abs(amounts) * self.percentage
+
+    charge = calculate
+    charge_batch = calculate_batch
+
+class FixedPlusPercentage(Commission):
+    ''' ``fixed`` per fill plus ``percentage`` of the traded value '''
+    def __init__(self, fixed, percentage):
+        assert (percentage < 1)
+        self.fixed = fixed
+        self.percentage = percentage
+
+    def params(self):
+        return {'fixed': self.fixed, 'percentage': self.percentage}
+
+    def calculate(self, price, amount):
+        return self.fixed + price * abs(amount) * self.percentage if amount != 0 else 0.0
+
+    def calculate_batch(self, prices, amounts):
+        amounts = np.asarray(amounts, dtype=float)
+        return np.where(amounts != 0, self.fixed + np.asarray(prices, dtype=float) * np.abs(amounts) * self.percentage, 0.0)
+
+class MakerTaker(Commission):
+    ''' Percentage of the traded value, ``maker`` for fills adding liquidity and ``taker`` (the default) otherwise '''
+    def __init__(self, maker, taker):
+        assert (maker < 1 and taker < 1)
+        self.maker = maker
+        self.taker = taker
+
+    def params(self):
+        return {'maker': self.maker, 'taker': self.taker}
+
+    def calculate(self, price, amount, maker=False):
+        return price * abs(amount) * (self.maker if maker else self.taker)
+
+    def calculate_batch(self, prices, amounts, maker=False):
+        return np.asarray(prices, dtype=float) * np.abs(amounts) * np.where(maker, self.maker, self.taker)
+
+class MinimumFee(Commission):
+    ''' Fee of the ``base`` model but at least ``minimum`` per fill '''
+    def __init__(self, base, minimum):
+        self.base = Commission.from_dict(base) if isinstance(base, dict) else base
+        self.minimum = minimum
+
+    def params(self):
+        return {'base': self.base.dict(), 'minimum': self.minimum}
+
+    def calculate(self, price, amount):
+        return max(self.base.calculate(price, amount), self.minimum) if amount != 0 else 0.0
+
+    def calculate_batch(self, prices, amounts):
+        amounts = np.asarray(amounts, dtype=float)
+        return np.where(amounts != 0, np.maximum(self.base.calculate_batch(prices, amounts), self.minimum), 0.0)
+
+    def charge(self, price, amount):
+        return max(self.base.charge(price, amount), self.minimum) if amount != 0 else 0.0
+
+    def charge_batch(self, prices, amounts):
+        amounts = np.asarray(amounts, dtype=float)
+        return np.where(amounts != 0, np.maximum(self.base.charge_batch(prices, amounts), self.minimum), 0.0)
+
+class TieredVolume(Commission):
+    ''' Percentage of the traded value set by the cumulative traded value before the fill
+
+    Args:
+        tiers (list): (volume from, percentage) pairs sorted by volume, the first from 0
+        volume (float): value traded so far
+    '''
+    def __init__(self, tiers, volume=0.0):
+        self.tiers = [(float(start), float(percentage)) for start, percentage in tiers]
+        assert self.tiers and self.tiers[0][0] == 0
+        assert all(percentage < 1 for start, percentage in self.tiers)
+        self.volume = float(volume)
+        self._starts = np.array([start for start, percentage in self.tiers])
+        self._rates = np.array([percentage for start, percentage in self.tiers])
+
+    def params(self):
+        return {'tiers': self.tiers, 'volume': self.volume}
+
+    def rate(self, volume):
+        return self._rates[np.searchsorted(self._starts, volume, side='right') - 1]
+
+    def calculate(self, price, amount):
+        return price * abs(amount) * float(self.rate(self.volume))
+
+    def _volumes(self, prices, amounts):
+        ''' Traded values and the volume after each fill, accumulated in order from self.volume like charge '''
+        value = np.asarray(prices, dtype=float) * np.abs(amounts)
+        return value, np.cumsum(np.r_[self.volume, value])
+
+    def calculate_batch(self, prices, amounts):
+        ''' Fees of consecutive fills, each priced at the volume traded before it '''
+        value, volumes = self._volumes(prices, amounts)
+        return value * self.rate(volumes[:-1])
+
+    def charge(self, price, amount):
+        fee = self.calculate(price, amount)
+        self.volume += price * abs(amount)
+        return fee
+
+    def charge_batch(self, prices, amounts):
+        value, volumes = self._volumes(prices, amounts)
+        self.volume = float(volumes[-1])
+        return value * self.rate(volumes[:-1])
+
+COMMISSIONS = {model.__name__: model for model in (TradePercentage, FixedPlusPercentage, MakerTaker, MinimumFee, TieredVolume)}
+
+
+def charge_fills(commision, prices, amounts, exits, enter_prices):
+    ''' Charges consecutive fills to ``commision``, same results as one charge call per fill
+
+    Returns:
+        (array, array): fee of every fill, and for the ``exits`` fills the quote at their
+        ``enter_prices`` right after their charge (the second half of the total_fee of close/cover)
+    '''
+    prices = np.asarray(prices, dtype=float)
+    amounts = np.abs(np.asarray(amounts, dtype=float))
+    exits = np.asarray(exits, dtype=np.intp)
+    enter_prices = np.asarray(enter_prices, dtype=float)
+    quote = commision.copy()
+    fees = commision.charge_batch(prices, amounts)
+    if quote == commision:
+        # Charging left the model unchanged, every quote sees the same state
+        return fees, commision.calculate_batch(enter_prices, amounts[exits])
+    quotes, fills, done = np.empty(len(exits)), list(zip(prices.tolist(), amounts.tolist())), 0
+    for j, i in enumerate(exits.tolist()):
+        for price, amount in fills[done:i + 1]:
+            quote.charge(price, amount)
+        quotes[j], done = quote.calculate(enter_prices[j], amount), i + 1
+    return fees, quotes
 
 ########################################################################
 #### Inventory
@@ -36,28 +214,54 @@ class TradePercentage(Commission):
 #### close: inv.close(<amount>, <price>)
 #### cover: inv.cover(<amount>, <price>)
 ########################################################################
-class Inventory(BaseModel):
-    inventory: List = []
-    islong: bool = True
+class Inventory(object):
+    ''' Single lot of the held amount (always positive) at its average price '''
+    __slots__ = ('amount', 'price', 'islong')
+
+    def __init__(self, inventory=(), islong=True):
+        self.inventory = inventory
+        self.islong = bool(islong)
+
+    @property
+    def inventory(self):
+        ''' [(amount, price)] or [] if nothing is held, as it used to be stored '''
+        if self.amount != 0:
+            return [(self.amount, self.price)]
+        return []
+
+    @inventory.setter
+    def inventory(self, inventory):
+        if len(inventory) > 0:
+            self.amount, self.price = float(inventory[0][0]), float(inventory[0][1])
+        else:
+            self.amount, self.price = 0.0, 0.0
+
+    def dict(self):
+        return {'inventory': self.inventory, 'islong': self.islong}
+
+    def __repr__(self):
+        return 'Inventory(inventory={}, islong={})'.format(self.inventory, self.islong)
+
+    def __eq__(self, other):
+        return isinstance(other, Inventory) and self.dict() == other.dict()
 
     def go_short(self):
-        assert len(self.inventory) == 0
+        assert self.amount == 0
         self.islong = False
 
     def go_long(self):
-        assert len(self.inventory) == 0
+        assert self.amount == 0
         self.islong = True
 
     def get_amount(self):
-        if len(self.inventory) > 0:
-            sign = 1 if self.islong else -1
-            return sign * self.inventory[0][0]
+        if self.amount != 0:
+            return self.amount if self.islong else -self.amount
         else:
             return 0
 
     def get_price(self):
-        if len(self.inventory) > 0:
-            return self.inventory[0][1]
+        if self.amount != 0:
+            return self.price
         else:
             return 0
 
@@ -65,30 +269,30 @@ class Inventory(BaseModel):
         ''' Entry amount must be positive'''
         assert amount > 0
         assert price > 0
-        if len(self.inventory) == 0:
-            self.inventory.append((amount, price))
+        if self.amount == 0:
+            self.amount, self.price = amount, price
         else:
-            new_amount = self.inventory[0][0] + amount
-            new_avg_price = (self.inventory[0][0] * self.inventory[0][1] + amount * price) / new_amount
-            self.inventory[0] = (new_amount, new_avg_price)
+            new_amount = self.amount + amount
+            self.price = (self.amount * self.price + amount * price) / new_amount
+            self.amount = new_amount
         return amount * price
 
     def _exit(self, amount:float, price:float):
         ''' Exit amount must be positive'''
         assert amount > 0
         assert price > 0
-        if len(self.inventory) > 0:
-            inventory_amount = abs(self.get_amount())
-            avg_price = self.get_price()
+        if self.amount != 0:
+            inventory_amount = abs(self.amount)
+            avg_price = self.price
             if self.islong:
                 realized_pnl = (price - avg_price) / avg_price
             else:
                 realized_pnl = (avg_price - price) / avg_price
             realized_profit_pt = amount * realized_pnl
             if math.isclose(inventory_amount, amount):
-                self.inventory = []
+                self.amount, self.price = 0.0, 0.0
             else:
-                self.inventory[0] = (inventory_amount - amount, avg_price)
+                self.amount = inventory_amount - amount
             return (realized_profit_pt, realized_pnl, avg_price, amount * price)
 
     def long(self, amount:float, price:float):
@@ -111,7 +315,90 @@ class Inventory(BaseModel):
 #### Position
 ########################################################################
 
-class Position(BaseModel):
+TRADE_LOG_SCHEMA = [
+    ('timestamp', DATETIME),
+    ('amount', FLOAT),
+    ('fee', FLOAT),
+    ('price', FLOAT),
+    ('trade', CATEGORY),
+    ('notes', CATEGORY),
+]
+
+TRADE_PROFIT_SCHEMA = [
+    ('timestamp', DATETIME),
+    ('amount', FLOAT),
+    ('exit_price', FLOAT),
+    ('enter_price', FLOAT),
+    ('realized_gross_profit', FLOAT),
+    ('realized_profit_pt', FLOAT),
+    ('realized_pnl', FLOAT),
+    ('total_fee', FLOAT),
+    ('trade', CATEGORY),
+]
+
+BALANCE_LOG_SCHEMA = [
+    ('fund', FLOAT),
+    ('amount', FLOAT),
+    ('strategy_exposure', FLOAT),
+    ('fee', FLOAT),
+    ('base_rate', FLOAT),
+    ('timestamp', DATETIME),
+    ('price', FLOAT),
+    ('gav', FLOAT),
+    ('nav', FLOAT),
+    ('exposure', FLOAT),
+]
+
+LOG_SCHEMAS = {
+    'trade_log': TRADE_LOG_SCHEMA,
+    'trade_profit': TRADE_PROFIT_SCHEMA,
+    'balance_log': BALANCE_LOG_SCHEMA,
+}
+
+class PositionModel(BaseModel):
+    ''' Validation schema of Position, only used when a Position is built '''
+    strategy_exposure: float = 0
+    base_rate: float = 1.0
+    fund: float = 0
+    fee: float = 0
+    leverage: float = 1
+    inv: Dict = {}
+    commision: Commission = None
+    trade_log: ColumnLog = None
+    trade_profit: ColumnLog = None
+    balance_log: ColumnLog = None
+    metrics: OnlineMetrics = None
+
+    class Config:
+        arbitrary_types_allowed=True
+
+    @validator('inv', pre=True, always=True)
+    def inventory(cls, value):
+        if isinstance(value, Inventory):
+            return value.dict()
+        return value or {}
+
+    @validator('commision', pre=True, always=True)
+    def default_commision(cls, value):
+        if isinstance(value, dict):
+            return Commission.from_dict(value)
+        return TradePercentage(0.001) if value is None else value
+
+    @validator('trade_log', 'trade_profit', 'balance_log', pre=True, always=True)
+    def column_log(cls, value, field):
+        ''' Logs are stored column-wise, lists of dicts (e.g. from Portfolio.load) are converted '''
+        if isinstance(value, ColumnLog):
+            return value
+        return ColumnLog(LOG_SCHEMAS[field.name], value or [])
+
+    @validator('metrics', pre=True)
+    def online_metrics(cls, value):
+        if isinstance(value, dict):
+            return OnlineMetrics(**value)
+        return value
+
+
+class Position(object):
     '''
     Keep records of a position of trading pairs
 
@@ -122,24 +409,49 @@ class Position(BaseModel):
         amount (float): Assets amounts
         target_exposure (float): Target exposure
         fee (float): Total fee incurred
-        trade_log (List): trade log
-        trade_profit (List): trade profit log
-        balance_log (List): balance log
-    '''
-    strategy_exposure: float = 0
-    base_rate: float = 1.0
-    fund: float = 0
-    fee: float = 0
-    leverage: float = 1
-    inv: Inventory = Inventory()
-    commision: Commission = TradePercentage(0.001)
-    trade_log: List = []
-    trade_profit: List = []
-    balance_log: List = []
-    timestamp_log: List = []
+        trade_log (ColumnLog): trade log
+        trade_profit (ColumnLog): trade profit log
+        balance_log (ColumnLog): balance log
+        metrics (OnlineMetrics): running nav metrics updated by end_date (None to disable)
 
-    class Config:
-        arbitrary_types_allowed=True
+    Fields are validated by PositionModel on construction and are plain
+    attributes afterwards, so trading does not go through pydantic.
+    '''
+    __slots__ = tuple(PositionModel.__fields__)
+
+    def __init__(self, **data):
+        model = PositionModel(**data)
+        for name in self.__slots__:
+            setattr(self, name, getattr(model, name))
+        self.inv = Inventory(**self.inv)
+
+    def dict(self, include=None, exclude=None):
+        ''' Fields as plain values, logs are returned as lists of dicts so serialized positions keep their format '''
+        result = {}
+        for name in self.__slots__:
+            if (include is not None and name not in include) or (exclude is not None and name in exclude):
+                continue
+            value = getattr(self, name)
+            if name in LOG_SCHEMAS:
+                value = value.records()
+            elif value is not None and name in ('inv', 'metrics', 'commision'):
+                value = value.dict()
+            result[name] = value
+        if (include is None or 'timestamp_log' in include) and (exclude is None or 'timestamp_log' not in exclude):
+            result['timestamp_log'] = self.timestamp_log
+        return result
+
+    @property
+    def timestamp_log(self):
+        ''' Timestamps of the balance log, kept for compatibility '''
+        column = self.balance_log.column('timestamp')
+        return to_datetimes(column).tolist() if column.dtype.kind == 'M' else column.tolist()
+
+    def __repr__(self):
+        return 'Position({})'.format(', '.join('{}={!r}'.format(k, v) for k, v in self.summary().items()))
+
+    def __eq__(self, other):
+        return isinstance(other, Position) and self.dict() == other.dict()
 
     def enough_amount(self, amount:float):
         return abs(amount) <= abs(self.get_amount()) + PRECISION
@@ -164,6 +476,85 @@ class Position(BaseModel):
         else:
             return 1 - cash / nav
 
+    @staticmethod
+    def cal_trade(cash, amount, price, old_exposure, new_exposure):
+        ''' Trade amounts of Position.allocate for one position, following the table of allocate
+        (cal_allocation is the vectorized version)
+
+        Returns:
+            None if allocate does not trade, otherwise (exit_amount, entry_amount): the amount to
+            close (old_exposure > 0) or cover (old_exposure < 0) first and the amount to long (> 0)
+            or short (< 0) afterwards, None for a leg that does not trade (no zero-size legs)
+        '''
+        if math.isclose(old_exposure, new_exposure):
+            return None
+        exposure = Position.cal_exposure(cash, amount, price)
+        nav = Position.cal_nav(cash, amount, price)
+        exit_amount, entry_amount = None, None
+        if old_exposure > 0:
+            if math.isclose(new_exposure, 0):
+                exit_amount = abs(amount)
+            elif new_exposure > 0 and new_exposure > old_exposure:
+                entry_amount = abs(nav * (new_exposure - exposure) / price)
+            elif new_exposure > 0 and new_exposure < old_exposure:
+                exit_amount = abs(nav * (new_exposure - exposure) / price)
+            elif new_exposure < 0:
+                exit_amount = abs(amount)
+                entry_amount = -abs(nav * new_exposure / price)
+        elif math.isclose(old_exposure, 0):
+            if new_exposure > 0:
+                entry_amount = abs(nav * new_exposure / price)
+            elif new_exposure < 0:
+                entry_amount = -abs(nav * new_exposure / price)
+        elif old_exposure < 0:
+            if math.isclose(new_exposure, 0):
+                exit_amount = abs(amount)
+            elif new_exposure < 0 and new_exposure > old_exposure:
+                exit_amount = abs(nav * (exposure - new_exposure) / price)
+            elif new_exposure < 0 and new_exposure < old_exposure:
+                entry_amount = -abs(nav * (exposure - new_exposure) / price)
+            elif new_exposure > 0:
+                exit_amount = abs(amount)
+                entry_amount = abs(nav * new_exposure / price)
+        # Nothing to exit when nothing is held (e.g. a partial exit already cleared by isclose)
+        if amount == 0 or exit_amount == 0:
+            exit_amount = None
+        if entry_amount == 0:
+            entry_amount = None
+        return exit_amount, entry_amount
+
+    @staticmethod
+    def cal_allocation(cash, amount, price, old_exposure, new_exposure):
+        ''' Vectorized trade amounts of Position.allocate (Position.cal_trade) over arrays of positions
+
+        Returns:
+            changed (array): False where allocate would return without trading
+            exit_amount (array): amount to close (old_exposure > 0) or cover (old_exposure < 0) first,
+                0 when nothing is held
+            entry_amount (array): amount to long (> 0) or short (< 0) afterwards
+        '''
+        cash, amount, price, old_exposure, new_exposure = [
+            np.asarray(value, dtype=float) for value in (cash, amount, price, old_exposure, new_exposure)]
+        nav = cash + amount * price
+        with np.errstate(divide='ignore', invalid='ignore'):
+            exposure = np.where((amount == 0) | (nav <= 0), 0.0, 1 - cash / nav)
+            step = np.abs(nav * (new_exposure - exposure) / price)
+            fresh = np.abs(nav * new_exposure / price)
+        # math.isclose with its default tolerances
+        close = np.abs(old_exposure - new_exposure) <= 1e-9 * np.maximum(np.abs(old_exposure), np.abs(new_exposure))
+        changed = ~close & ~np.isnan(new_exposure)
+        was_long, was_short, was_flat = old_exposure > 0, old_exposure < 0, old_exposure == 0
+        flips = (was_long & (new_exposure <= 0)) | (was_short & (new_exposure >= 0))
+        exit_amount = np.where(flips, np.abs(amount),
+                      np.where((was_long & (new_exposure < old_exposure)) | (was_short & (new_exposure > old_exposure)), step, 0.0))
+        entry_amount = np.where(was_long & (new_exposure > old_exposure), step,
+                       np.where(was_short & (new_exposure < old_exposure), -step,
+                       np.where((was_flat | flips) & (new_exposure > 0), fresh,
+                       np.where((was_flat | flips) & (new_exposure < 0), -fresh, 0.0))))
+        changed &= was_long | was_short | was_flat
+        exit_amount = np.where(amount == 0, 0.0, exit_amount)
+        return changed, np.where(changed, exit_amount, 0.0), np.where(changed, entry_amount, 0.0)
+
     def get_amount(self):
         return self.inv.get_amount()
 
@@ -178,7 +569,7 @@ class Position(BaseModel):
             self.inv.go_long()
         amount = abs(amount)
         cash_changed = self.inv.long(abs(amount), price)
-        fee_to_pay = self.commision.calculate(price, amount)
+        fee_to_pay = self.commision.charge(price, amount)
         # Updates records
         self.fund += -1 * abs(cash_changed)
         self.fee += fee_to_pay
@@ -197,7 +588,7 @@ class Position(BaseModel):
         amount = abs(amount)
         cash_changed = self.inv.short(abs(amount), price)
         cash_changed = abs(cash_changed)
-        fee_to_pay = self.commision.calculate(price, amount)
+        fee_to_pay = self.commision.charge(price, amount)
         # Updates records
         self.fund += cash_changed
         self.fee += fee_to_pay
@@ -213,7 +604,7 @@ class Position(BaseModel):
         amount = abs(amount)
         realized_profit_pt, realized_pnl, avg_price, cash_changed = self.inv.close(abs(amount), price)
         realized_gross_profit = realized_profit_pt * self.base_rate * avg_price
-        fee_to_pay = self.commision.calculate(price, amount)
+        fee_to_pay = self.commision.charge(price, amount)
         total_fee = fee_to_pay + self.commision.calculate(avg_price, amount)
         cash_changed = abs(cash_changed)
         # Updates records
@@ -241,7 +632,7 @@ class Position(BaseModel):
         amount = abs(amount)
         realized_profit_pt, realized_pnl, avg_price, cash_changed = self.inv.cover(abs(amount), price)
         realized_gross_profit = realized_profit_pt * self.base_rate * avg_price
-        fee_to_pay = self.commision.calculate(price, amount)
+        fee_to_pay = self.commision.charge(price, amount)
         total_fee = fee_to_pay + self.commision.calculate(avg_price, amount)
         cash_changed = -1 * abs(cash_changed)
         # Updates records
@@ -271,6 +662,37 @@ class Position(BaseModel):
     def set_commision(self, commision: Commission):
         self.commision = commision
 
+    def spill(self, path, group='', logs=('balance_log',), resume=False, **kwargs):
+        ''' Moves ``logs`` to chunked, compressed HDF5 datasets under ``group`` of ``path`` (needs h5py),
+        replacing what the group held unless ``resume``. Call close_logs() when done.
+        '''
+        from .spill import HDF5Log
+        for name in logs:
+            log = HDF5Log(LOG_SCHEMAS[name], path, '{}/{}'.format(group, name), resume=resume, **kwargs)
+            if len(getattr(self, name)) > 0:
+                log.extend(getattr(self, name).columns())
+            setattr(self, name, log)
+
+    def flush_logs(self):
+        ''' Writes the staged rows of spilled logs to disk '''
+        for name in LOG_SCHEMAS:
+            log = getattr(self, name)
+            if hasattr(log, 'flush'):
+                log.flush()
+
+    def close_logs(self):
+        ''' Flushes and closes the files of spilled logs (close() is the trade) '''
+        for name in LOG_SCHEMAS:
+            log = getattr(self, name)
+            if hasattr(log, 'close'):
+                log.close()
+
+    def track_metrics(self):
+        ''' Starts updating running nav metrics on every end_date '''
+        if self.metrics is None:
+            self.metrics = OnlineMetrics()
+        return self.metrics
+
     def extract_fund(self):
         fund = self.fund
         self.fund = 0
@@ -297,76 +719,156 @@ class Position(BaseModel):
 | -ve          | less -ve     | old_exposure < 0 and new_exposure < 0 and new_exposure > old_exposure | nav * (exposure -  new_exposure ) / price |
 | -ve          | +ve          | old_exposure < 0 and new_exposure > 0                                 | amount then nav * (new_exposure) / price  |
         '''
-        old_exposure = self.strategy_exposure
-        amount = self.inv.get_amount()
-        exposure = Position.cal_exposure(self.fund, amount, price)
-        nav = Position.cal_nav(self.fund, amount, price)
+        trade = Position.cal_trade(self.fund, self.inv.get_amount(), price, self.strategy_exposure, new_exposure)
 
         # Return if old_exposure is very close to new_exposure
-        if math.isclose(old_exposure, new_exposure):
+        if trade is None:
             return None
 
-        # Different case
-        if old_exposure > 0:
-            if  math.isclose(new_exposure, 0):
-                amount_changed = amount
-                self.close(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure > 0 and new_exposure > old_exposure:
-                amount_changed = nav * (new_exposure - exposure) / price
-                self.long(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure > 0 and new_exposure < old_exposure:
-                amount_changed = nav * (new_exposure - exposure) / price
-                self.close(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure < 0:
-                # Close 
-                amount_changed = amount
-                self.close(amount_changed, price, timestamp=timestamp, notes=notes)
-                # Short
-                amount_changed = nav * new_exposure / price
-                self.short(amount_changed, price, timestamp=timestamp, notes=notes)
-        elif math.isclose(old_exposure, 0):
-            if new_exposure > 0:
-                amount_changed = nav * (new_exposure) / price
-                self.long(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure < 0:
-                amount_changed = nav * (new_exposure) / price
-                self.short(amount_changed, price, timestamp=timestamp, notes=notes)
-        elif old_exposure < 0:
-            if math.isclose(new_exposure, 0):
-                amount_changed = amount
-                self.cover(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure < 0 and new_exposure > old_exposure:
-                amount_changed = nav * (exposure - new_exposure) / price 
-                self.cover(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure < 0 and new_exposure < old_exposure:
-                amount_changed = nav * (exposure - new_exposure) / price 
-                self.short(amount_changed, price, timestamp=timestamp, notes=notes)
-            elif new_exposure > 0:
-                # Cover
-                amount_changed = amount
-                self.cover(amount_changed, price, timestamp=timestamp, notes=notes)
-                # Long
-                amount_changed = nav * (new_exposure) / price
-                self.long(amount_changed, price, timestamp=timestamp, notes=notes)
+        exit_amount, entry_amount = trade
+        if exit_amount is not None:
+            if self.strategy_exposure > 0:
+                self.close(exit_amount, price, timestamp=timestamp, notes=notes)
+            else:
+                self.cover(exit_amount, price, timestamp=timestamp, notes=notes)
+        if entry_amount is not None:
+            if entry_amount > 0:
+                self.long(entry_amount, price, timestamp=timestamp, notes=notes)
+            else:
+                self.short(entry_amount, price, timestamp=timestamp, notes=notes)
         # Update the strategy exposure
         self.strategy_exposure = new_exposure
         return
 
     def end_date(self, timestamp, price):
-        summary = self.summary()
-        summary.update({'timestamp':timestamp})
-        summary.update({'price':price})
-        summary.update({'gav': self.get_gav(price)})
-        summary.update({'nav': self.get_nav(price)})
-        summary.update({'exposure': Position.cal_exposure(summary['fund'], summary['amount'], price)})
+        amount = self.inv.get_amount()
+        gav = Position.cal_nav(self.fund, amount, price)
+        summary = {
+            'fund':self.fund,
+            'amount':amount,
+            'strategy_exposure':self.strategy_exposure,
+            'fee':self.fee,
+            'base_rate':self.base_rate,
+            'timestamp':timestamp,
+            'price':price,
+            'gav':gav,
+            'nav':gav - self.fee,
+            'exposure':Position.cal_exposure(self.fund, amount, price)}
         self.balance_log.append(summary)
-        self.timestamp_log.append(timestamp)
+        if self.metrics is not None:
+            self.metrics.update(summary['nav'])
 
     def get_trade_profit(self):
-        return pd.DataFrame(self.trade_profit)
+        return self.trade_profit.to_frame()
 
     def get_trade_log(self):
-        return pd.DataFrame(self.trade_log)
+        return self.trade_log.to_frame()
 
     def get_balance_log(self):
-        return pd.DataFrame(self.balance_log, index=self.timestamp_log)
\ No newline at end of file
+        return self.balance_log.to_frame(index=pd.Index(self.balance_log.column('timestamp')))
+
+    def get_balance_series(self, name):
+        ''' Single float column of the balance log, without building the whole frame '''
+        return pd.Series(self.balance_log.column(name), index=pd.Index(self.balance_log.column('timestamp')), name=name)
+
+    def log_version(self):
+        ''' Changes whenever a trade or an end_date is recorded (logs are append-only) '''
+        return (len(self.trade_log), len(self.trade_profit), len(self.balance_log))
+
+
+def allocate_positions(positions, new_exposures, prices, timestamp=None, notes=""):
+    ''' Position.allocate of many positions at once
+
+    Trade amounts, inventories, cash and realized profits are computed as vectors
+    with the same float operations as allocate, then written back to every position
+    with its trade_log and trade_profit rows. Only commissions are called per trade.
+    A NaN exposure holds the current exposure. The write-back and the log rows stay
+    one Python step per traded position, so this is about as fast as calling allocate
+    on each position; it gives one call and one table of the trades, not a speedup.
+
+    Returns:
+        dict: trade columns (position index, trade, amount, price, fee) in execution order
+    '''
+    price = np.asarray(prices, dtype=float)
+    new_exposure = np.asarray(new_exposures, dtype=float)
+    old_exposure = np.array([pos.strategy_exposure for pos in positions], dtype=float)
+    fund = np.array([pos.fund for pos in positions], dtype=float)
+    held = np.array([pos.inv.amount for pos in positions], dtype=float)
+    avg_price = np.array([pos.inv.price for pos in positions], dtype=float)
+    amount = np.where(old_exposure < 0, -held, held)
+    changed, exit_amount, entry_amount = Position.cal_allocation(fund, amount, price, old_exposure, new_exposure)
+    assert np.all(price[changed] > 0)
+
+    # Exit leg: close (long) or cover (short)
+    exits = exit_amount > 0
+    was_long = old_exposure > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        realized_pnl = np.where(was_long, (price - avg_price) / avg_price, (avg_price - price) / avg_price)
+        realized_profit_pt = exit_amount * realized_pnl
+    remaining = np.where(np.abs(held - exit_amount) <= 1e-9 * np.maximum(held, exit_amount), 0.0, held - exit_amount)
+    remaining = np.where(exits, remaining, held)
+    exit_cash = exit_amount * price
+    fund = np.where(exits, np.where(was_long, fund + exit_cash, fund + -exit_cash), fund)
+
+    # Entry leg: long (> 0) or short (< 0), on top of what is left
+    entries = entry_amount != 0
+    entry_size = np.abs(entry_amount)
+    total = remaining + entry_size
+    with np.errstate(divide='ignore', invalid='ignore'):
+        new_price = np.where(remaining == 0, price, (remaining * avg_price + entry_size * price) / total)
+    entry_cash = entry_size * price
+    fund = np.where(entries, np.where(entry_amount > 0, fund + -entry_cash, fund + entry_cash), fund)
+    held = np.where(entries, total, remaining)
+    avg_price = np.where(entries, new_price, np.where(remaining == 0, 0.0, avg_price))
+
+    rows = np.flatnonzero(changed)
+    exit_fee = [0.0] * len(rows)
+    entry_fee = [0.0] * len(rows)
+    columns = [array[rows].tolist() for array in (
+        price, new_exposure, fund, held, avg_price, exit_amount, entry_amount,
+        realized_pnl, realized_profit_pt, remaining, was_long)]
+    for j, (i, p, exposure, f, h, avg, x, e, pnl, profit_pt, left, islong) in enumerate(zip(rows.tolist(), *columns)):
+        pos = positions[i]
+        inv = pos.inv
+        commision = pos.commision
+        if x > 0:
+            entered = inv.price
+            fee_to_pay = exit_fee[j] = commision.charge(p, x)
+            pos.fee += fee_to_pay
+            if islong:
+                pos.trade_log.append({'timestamp':timestamp, 'amount':-x, 'fee':fee_to_pay, 'price':p, 'trade':'CLOSE', 'notes':notes})
+            else:
+                pos.trade_log.append({'timestamp':timestamp, 'amount':x, 'fee':fee_to_pay, 'price':p, 'trade':'COVER', 'notes':notes})
+            pos.trade_profit.append({
+                'timestamp':timestamp,
+                'amount':x if islong else -x,
+                'exit_price':p,
+                'enter_price':entered,
+                'realized_gross_profit':profit_pt * pos.base_rate * entered,
+                'realized_profit_pt':profit_pt,
+                'realized_pnl':pnl,
+                'total_fee': fee_to_pay + commision.calculate(entered, x),
+                'trade':'LONG' if islong else 'SHORT'})
+        if e != 0:
+            if left == 0:
+                inv.islong = e > 0
+            fee_to_pay = entry_fee[j] = commision.charge(p, abs(e))
+            pos.fee += fee_to_pay
+            pos.trade_log.append({'timestamp':timestamp, 'amount':e, 'fee':fee_to_pay, 'price':p, 'trade':'LONG' if e > 0 else 'SHORT', 'notes':notes})
+        pos.fund = f
+        inv.amount = h
+        inv.price = avg
+        pos.strategy_exposure = exposure
+
+    # Exit then entry rows of every position, in position order
+    exits, entries = exits[rows], entries[rows]
+    order = np.argsort(np.r_[2 * np.flatnonzero(exits), 2 * np.flatnonzero(entries) + 1], kind='mergesort')
+    exit_amount, entry_amount = exit_amount[rows][exits], entry_amount[rows][entries]
+    was_long = was_long[rows][exits]
+    return {
+        'position': np.r_[rows[exits], rows[entries]][order],
+        'trade': np.r_[np.where(was_long, 'CLOSE', 'COVER'), np.where(entry_amount > 0, 'LONG', 'SHORT')].astype(object)[order],
+        'amount': np.r_[np.where(was_long, -exit_amount, exit_amount), entry_amount][order],
+        'price': np.r_[price[rows][exits], price[rows][entries]][order],
+        'fee': np.r_[np.array(exit_fee)[exits], np.array(entry_fee)[entries]][order],
+    }